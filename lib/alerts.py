@@ -0,0 +1,213 @@
+import os
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from google.transit import gtfs_realtime_pb2
+
+from .feeds import NAMESPACE_SEPARATOR, namespaced
+
+# 翻訳が複数あるとき優先する言語
+ALERT_LANGUAGE = os.getenv("GTFS_LANGUAGE", "ja")
+
+_CAUSES = {value: name for name, value in gtfs_realtime_pb2.Alert.Cause.items()}
+_EFFECTS = {value: name for name, value in gtfs_realtime_pb2.Alert.Effect.items()}
+
+
+class InformedEntity(NamedTuple):
+    # 指定された項目がすべて一致する便・停留所が対象
+    agency_id: str | None
+    route_id: str | None
+    trip_id: str | None
+    stop_id: str | None
+
+
+class Alert(NamedTuple):
+    alert_id: str
+    active_periods: tuple[tuple[int | None, int | None], ...]
+    informed: tuple[InformedEntity, ...]
+    cause: str | None
+    effect: str | None
+    header: str | None
+    description: str | None
+    url: str | None
+    # 読み込んだフィードの feed_id。agency_id はそのフィードの便にだけ当てはめる
+    namespace: str = ""
+
+    def active(self, at: int) -> bool:
+        # 期間がなければ常に有効。終わりは含まない
+        if not self.active_periods:
+            return True
+        return any(
+            (start is None or start <= at) and (end is None or at < end)
+            for start, end in self.active_periods
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            key: value
+            for key, value in (
+                ("alert_id", self.alert_id),
+                ("cause", self.cause),
+                ("effect", self.effect),
+                ("header", self.header),
+                ("description", self.description),
+                ("url", self.url),
+            )
+            if value is not None
+        }
+
+
+class AlertIndex:
+    """
+    Alert を対象の trip_id・route_id・stop_id から引けるようにした索引。
+
+    InformedEntity は stop_id があれば停留所の索引に、なければもっとも細かい項目
+    (trip_id, route_id の順) の索引に入れ、引くときに残りの項目も一致するか確かめる。
+    どれも持たない (事業者全体の) ものは、同じフィードのすべての便に当てはめる。
+    事業者はフィードまでしか区別しない (便から agency_id を引かない)。
+    """
+
+    def __init__(self, alerts: Iterable[Alert] = ()) -> None:
+        self.alerts = tuple(alerts)
+        by_trip = defaultdict(list)
+        by_stop = defaultdict(list)
+        by_route = defaultdict(list)
+        self.general: list[tuple[int, Alert, InformedEntity]] = []
+        # 同じ Alert が複数の索引に入るので、フィード上の順序で並べ直すための番号も持つ
+        for order, alert in enumerate(self.alerts):
+            for entity in alert.informed:
+                entry = (order, alert, entity)
+                # 便と停留所の両方を指定したものは、その便のその停留所にだけ出す
+                if entity.stop_id:
+                    by_stop[entity.stop_id].append(entry)
+                elif entity.trip_id:
+                    by_trip[entity.trip_id].append(entry)
+                elif entity.route_id:
+                    by_route[entity.route_id].append(entry)
+                else:
+                    self.general.append(entry)
+        self.by_trip = dict(by_trip)
+        self.by_stop = dict(by_stop)
+        self.by_route = dict(by_route)
+
+    def __len__(self) -> int:
+        return len(self.alerts)
+
+    def for_trip(
+        self,
+        trip_id: str,
+        route_id: str | None,
+        at: int,
+    ) -> list[Alert]:
+        # 便・系統・事業者全体に対する Alert (停留所を指定したものは for_stop で引く)
+        candidates = [
+            *self.by_trip.get(trip_id, ()),
+            *(self.by_route.get(route_id, ()) if route_id else ()),
+            *self.general,
+        ]
+        return _matching(candidates, at, trip_id, route_id, None)
+
+    def for_stop(
+        self,
+        stop_id: str,
+        trip_id: str,
+        route_id: str | None,
+        at: int,
+    ) -> list[Alert]:
+        return _matching(self.by_stop.get(stop_id, ()), at, trip_id, route_id, stop_id)
+
+
+def _matching(
+    candidates: Iterable[tuple[int, Alert, InformedEntity]],
+    at: int,
+    trip_id: str,
+    route_id: str | None,
+    stop_id: str | None,
+) -> list[Alert]:
+    found: dict[int, Alert] = {}
+    for order, alert, entity in candidates:
+        if order in found or not alert.active(at):
+            continue
+        if entity.trip_id and entity.trip_id != trip_id:
+            continue
+        if entity.route_id and entity.route_id != route_id:
+            continue
+        if entity.stop_id and entity.stop_id != stop_id:
+            continue
+        if entity.agency_id and not _in_feed(trip_id, alert.namespace):
+            continue
+        found[order] = alert
+    return [found[order] for order in sorted(found)]
+
+
+def _in_feed(trip_id: str, namespace: str) -> bool:
+    # フィードが 1 つだけ (namespace が空) なら区別しない
+    return not namespace or trip_id.startswith(f"{namespace}{NAMESPACE_SEPARATOR}")
+
+
+def _translated(text: gtfs_realtime_pb2.TranslatedString) -> str | None:
+    # ALERT_LANGUAGE、言語の指定がないもの、最初のものの順に選ぶ
+    translations = list(text.translation)
+    if not translations:
+        return None
+    for language in (ALERT_LANGUAGE, ""):
+        for translation in translations:
+            if translation.language == language:
+                return translation.text
+    return translations[0].text
+
+
+def _alert(
+    alert_id: str,
+    alert: gtfs_realtime_pb2.Alert,
+    namespace: str = "",
+) -> Alert:
+    informed = []
+    for entity in alert.informed_entity:
+        trip = entity.trip if entity.HasField("trip") else None
+        route_id = entity.route_id if entity.HasField("route_id") else None
+        if route_id is None and trip is not None and trip.HasField("route_id"):
+            route_id = trip.route_id
+        informed.append(
+            InformedEntity(
+                namespaced(namespace, entity.agency_id)
+                if entity.HasField("agency_id")
+                else None,
+                namespaced(namespace, route_id),
+                namespaced(namespace, trip.trip_id)
+                if trip is not None and trip.HasField("trip_id")
+                else None,
+                namespaced(namespace, entity.stop_id)
+                if entity.HasField("stop_id")
+                else None,
+            ),
+        )
+    return Alert(
+        namespaced(namespace, alert_id),
+        tuple(
+            (
+                period.start if period.HasField("start") else None,
+                period.end if period.HasField("end") else None,
+            )
+            for period in alert.active_period
+        ),
+        tuple(informed),
+        _CAUSES[alert.cause] if alert.HasField("cause") else None,
+        _EFFECTS[alert.effect] if alert.HasField("effect") else None,
+        _translated(alert.header_text),
+        _translated(alert.description_text),
+        _translated(alert.url),
+        namespace,
+    )
+
+
+def parse_alerts(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    namespace: str = "",
+) -> list[Alert]:
+    return [
+        _alert(entity.id, entity.alert, namespace)
+        for entity in feed.entity
+        if entity.HasField("alert")
+    ]
@@ -0,0 +1,263 @@
+import datetime
+import mmap
+import struct
+import threading
+import zlib
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+
+from google.transit import gtfs_realtime_pb2
+
+from .feeds import AGENCY_TIMEZONE
+
+# ファイルの先頭。形式を変えたら末尾の版を上げる
+MAGIC = b"NWRA\x01"
+# 記録ごとの見出し: 圧縮した本文の長さ, 取得した時刻, キーの長さ, 種類。続けてキーと本文
+RECORD_HEADER = struct.Struct(">IdHB")
+SUFFIX = ".rta"
+# 取得したフィードそのまま
+FULL = 0
+# 前の記録から追加・変更された FeedEntity と、削除された id (is_deleted) だけのフィード
+DIFFERENTIAL = 1
+# 同じ取得先でこの件数ごとに FULL を書き、そこから先だけで再生できるようにする
+KEYFRAME_INTERVAL = 240
+
+# FeedMessage の header (1) と entity (2) のタグ
+_HEADER_TAG = b"\x0a"
+_ENTITY_TAG = b"\x12"
+
+
+class ArchiveRecord(NamedTuple):
+    key: str  # "<feed_id>/<種類>"
+    fetched_at: float
+    content: bytes  # GTFS-Realtime のバイト列
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:  # noqa: PLR2004
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _field(tag: bytes, payload: bytes) -> bytes:
+    return tag + _varint(len(payload)) + payload
+
+
+def _entities(message: gtfs_realtime_pb2.FeedMessage) -> dict[str, bytes] | None:
+    # id -> シリアライズした FeedEntity。id が重複していれば差分を取れないので None
+    entities = {
+        entity.id: entity.SerializeToString(deterministic=True)
+        for entity in message.entity
+    }
+    return entities if len(entities) == len(message.entity) else None
+
+
+class SnapshotArchive:
+    """
+    取得した GTFS-Realtime を、事業者のタイムゾーンの日付ごとのファイルに追記していく。
+
+    記録は長さ付きで zlib で圧縮して並べるだけで、書いたものは変更しない (開き直した
+    ファイルの末尾に書きかけの記録があれば、それだけは切り捨てる)。
+    取得先ごとに KEYFRAME_INTERVAL 件に 1 件だけフィード全体を書き、それ以外は
+    前の記録から変わった FeedEntity だけを書く (GTFS-Realtime の DIFFERENTIAL と同じ形)。
+    ファイルごとに全体の記録から始まるので、1 日分だけを読んで再生できる。
+    読むときは read_archive() でファイルを mmap し、先頭から順にたどる。
+    ポーラーの複数のスレッドから呼ばれるので追記はロックで直列にする。
+    """
+
+    def __init__(self, directory: str | Path, level: int = 1) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.level = level
+        self._lock = threading.Lock()
+        self._file: BinaryIO | None = None
+        self._path: Path | None = None
+        # 取得先ごとの (最後に書いた FeedEntity, 最後の FULL からの件数)
+        self._previous: dict[str, tuple[dict[str, bytes], int]] = {}
+
+    def path_for(self, date: datetime.date) -> Path:
+        return self.directory / f"{date:%Y%m%d}{SUFFIX}"
+
+    def append(
+        self,
+        key: str,
+        fetched_at: float,
+        content: bytes,
+        message: gtfs_realtime_pb2.FeedMessage | None = None,
+    ) -> None:
+        # message は content を解析済みなら渡す (解析し直さずに済む)
+        if message is None:
+            message = gtfs_realtime_pb2.FeedMessage()
+            message.ParseFromString(content)
+        entities = _entities(message)
+        path = self.path_for(
+            datetime.datetime.fromtimestamp(fetched_at, AGENCY_TIMEZONE).date(),
+        )
+        with self._lock:
+            if path != self._path:
+                self._open(path)
+            previous, count = self._previous.get(key, (None, KEYFRAME_INTERVAL))
+            if entities is None or previous is None or count >= KEYFRAME_INTERVAL:
+                kind, payload, count = FULL, content, 0
+            else:
+                kind, payload = DIFFERENTIAL, _differential(message, previous, entities)
+            self._previous[key] = (
+                (entities, count + 1) if entities is not None else (None, 0)
+            )
+            compressed = zlib.compress(payload, self.level)
+            encoded_key = key.encode()
+            self._file.write(
+                RECORD_HEADER.pack(len(compressed), fetched_at, len(encoded_key), kind)
+                + encoded_key
+                + compressed,
+            )
+            # 読む側がいつ mmap しても記録が途中で切れないよう、1 件ごとに書き出す
+            self._file.flush()
+
+    def _open(self, path: Path) -> None:
+        if self._file is not None:
+            self._file.close()
+        complete = _complete_length(path) if path.exists() else 0
+        self._file = path.open("ab")
+        self._path = path
+        # 追記中にプロセスが止まっていれば、書きかけの記録を切り捨ててから続ける
+        if self._file.tell() > complete:
+            print(f"Truncating a torn record at the end of {path}")  # noqa: T201
+            self._file.truncate(complete)
+        # 新しいファイルは取得先ごとに全体の記録から始める
+        self._previous.clear()
+        if complete == 0:
+            self._file.write(MAGIC)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            self._path = None
+            self._previous.clear()
+
+
+def _complete_length(path: Path) -> int:
+    # 最後の完全な記録までのバイト数。MAGIC も書き終わっていなければ 0
+    with path.open("rb") as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        magic = f.read(len(MAGIC))
+        if size < len(MAGIC) and MAGIC.startswith(magic):
+            return 0
+        if magic != MAGIC:
+            msg = f"{path} is not a realtime archive"
+            raise ValueError(msg)
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= size:
+            length, _, key_length, _ = RECORD_HEADER.unpack(
+                f.read(RECORD_HEADER.size),
+            )
+            end = offset + RECORD_HEADER.size + key_length + length
+            if end > size:
+                break
+            offset = f.seek(end)
+        return offset
+
+
+def _differential(
+    message: gtfs_realtime_pb2.FeedMessage,
+    previous: dict[str, bytes],
+    entities: dict[str, bytes],
+) -> bytes:
+    header = gtfs_realtime_pb2.FeedHeader()
+    header.CopyFrom(message.header)
+    header.incrementality = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    parts = [_field(_HEADER_TAG, header.SerializeToString())]
+    parts.extend(
+        _field(_ENTITY_TAG, entity)
+        for entity_id, entity in entities.items()
+        if previous.get(entity_id) != entity
+    )
+    for entity_id in previous.keys() - entities.keys():
+        deleted = gtfs_realtime_pb2.FeedEntity(id=entity_id, is_deleted=True)
+        parts.append(_field(_ENTITY_TAG, deleted.SerializeToString()))
+    return b"".join(parts)
+
+
+def _apply_differential(payload: bytes, entities: dict[str, bytes]) -> bytes:
+    # entities を更新し、フィード全体のバイト列を組み立てる
+    differential = gtfs_realtime_pb2.FeedMessage()
+    differential.ParseFromString(payload)
+    for entity in differential.entity:
+        if entity.is_deleted:
+            entities.pop(entity.id, None)
+        else:
+            entities[entity.id] = entity.SerializeToString(deterministic=True)
+    header = differential.header
+    header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    return b"".join(
+        [
+            _field(_HEADER_TAG, header.SerializeToString()),
+            *(_field(_ENTITY_TAG, entity) for entity in entities.values()),
+        ],
+    )
+
+
+def read_archive(
+    path: str | Path,
+    key: str | None = None,
+    full: bool = True,  # noqa: FBT001, FBT002
+) -> Iterator[ArchiveRecord]:
+    """
+    アーカイブのファイルの記録を古い順に返す。key を指定するとその取得先だけ。
+
+    full なら DIFFERENTIAL の記録もフィード全体に戻して返す (取得したときと同じ内容)。
+    False なら変わった FeedEntity だけのフィード (header.incrementality が DIFFERENTIAL)
+    のまま返すので、変化だけを集計する場合は組み立てと解析の手間を省ける。
+    書きかけの最後の記録 (追記中にプロセスが止まった場合) は読み飛ばす。
+    """
+    entities_by_key: dict[str, dict[str, bytes]] = {}
+    with Path(path).open("rb") as f:
+        if f.seek(0, 2) == 0:
+            return
+        with (
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+            memoryview(data) as view,
+        ):
+            if view[: len(MAGIC)] != MAGIC:
+                msg = f"{path} is not a realtime archive"
+                raise ValueError(msg)
+            offset = len(MAGIC)
+            size = len(view)
+            while offset + RECORD_HEADER.size <= size:
+                length, fetched_at, key_length, kind = RECORD_HEADER.unpack_from(
+                    view,
+                    offset,
+                )
+                key_start = offset + RECORD_HEADER.size
+                end = key_start + key_length + length
+                if end > size:
+                    break
+                offset = end
+                record_key = bytes(view[key_start : key_start + key_length]).decode()
+                if key is not None and record_key != key:
+                    continue
+                payload = zlib.decompress(view[key_start + key_length : end])
+                if not full:
+                    yield ArchiveRecord(record_key, fetched_at, payload)
+                elif kind == FULL:
+                    message = gtfs_realtime_pb2.FeedMessage()
+                    message.ParseFromString(payload)
+                    entities = _entities(message)
+                    if entities is not None:
+                        entities_by_key[record_key] = entities
+                    else:
+                        entities_by_key.pop(record_key, None)
+                    yield ArchiveRecord(record_key, fetched_at, payload)
+                elif record_key in entities_by_key:
+                    yield ArchiveRecord(
+                        record_key,
+                        fetched_at,
+                        _apply_differential(payload, entities_by_key[record_key]),
+                    )
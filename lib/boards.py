@@ -0,0 +1,123 @@
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Mapping
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True)
+class Board:
+    """掲示板の設定。表示する停留所と、現在時刻から何分先までを何件出すか。"""
+
+    stop_ids: tuple[str, ...]
+    minutes: int = 45
+    limit: int = 50
+
+
+DEFAULT_BOARDS: dict[str, Board] = {
+    "default": Board(
+        stop_ids=(
+            # 22030 広島市立大学前
+            "22030 1",
+            "22030 2",
+            "22030 52",
+            # 24140 沼田料金所前
+            "24140 1",
+            "24140 2",
+        ),
+    ),
+}
+
+
+def load_boards(path: str | None = None) -> dict[str, Board]:
+    """
+    掲示板の設定を JSON から読み込む。path がなければ DEFAULT_BOARDS を使う。
+
+    {"<board_id>": {"stop_ids": ["22030 1", ...], "minutes": 45, "limit": 50}}
+    """
+    if not path:
+        return dict(DEFAULT_BOARDS)
+    with Path(path).open("r") as f:
+        raw = json.load(f)
+    return {
+        board_id: Board(
+            stop_ids=tuple(config["stop_ids"]),
+            minutes=config.get("minutes", Board.minutes),
+            limit=config.get("limit", Board.limit),
+        )
+        for board_id, config in raw.items()
+    }
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    """
+    組み立て済みの掲示板。
+
+    リアルタイムの版が進んだときに変わった便だけをマージし直せるよう、
+    マージ前の時刻表 (static_data) と停車順 (patterns) も持っておく。
+    """
+
+    etag: str
+    body: bytes
+    version: int  # マージに使ったリアルタイムのスナップショットの版
+    static_data: dict
+    patterns: Mapping[str, tuple]
+    result: dict
+
+
+class ResponseCache:
+    """
+    組み立て済みのレスポンス本文と ETag を保持する LRU キャッシュ。
+
+    キーは掲示板と時間帯。リアルタイムの版が進んだかどうかは呼び出し側が
+    CachedResponse.version を見て判断する。静的データの入れ替え時は invalidate() を呼び、
+    無効化した世代より古いセッションで組み立てたものは put() しても保持しない。
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, CachedResponse] = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> CachedResponse | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self,
+        key: Hashable,
+        entry: CachedResponse,
+        generation: int = 0,
+    ) -> CachedResponse:
+        # generation は組み立てに使ったセッションの世代
+        with self._lock:
+            if generation < self._generation:
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation = max(self._generation, generation)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
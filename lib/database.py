@@ -1,11 +1,21 @@
 import csv
+import hashlib
+import io
+import json
 import os
 import sqlite3
+import time
 import zipfile
+import zlib
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from contextlib import closing
+from itertools import batched
 from pathlib import Path
 
 import dotenv
-import requests
+
+from .dynamic import fetch_dynamic_feed
+from .feeds import NAMESPACE_SEPARATOR, load_feeds, namespaced
 
 insertable: list[str] = [
     "agency",
@@ -15,63 +25,603 @@ insertable: list[str] = [
     # "fare_attributes",
     # "fare_rules",
     "feed_info",
+    "frequencies",
     "routes",
     "routes_jp",
     # "shapes",
     "stop_times",
     "stops",
+    "transfers",
     "trips",
 ]
 
+# 検証時に 1 行以上あることを要求するテーブル
+required_tables: list[str] = [
+    "agency",
+    "routes",
+    "stop_times",
+    "stops",
+    "trips",
+]
+
+# 差分更新で、表ごと入れ直さずに変わった行のまとまりだけを入れ直すテーブル
+# テーブル -> 行をまとめる列 (主キーの先頭の列)。
+# まとまりごとの要約を static_digests に持つ
+diffed_tables: dict[str, str] = {
+    "stop_times": "trip_id",
+}
+
+BATCH_SIZE = 50_000
+# static_changes に残す取り込みの数
+CHANGE_HISTORY = 64
+
+# 複数のフィードを入れるときに "<feed_id>:" を付ける ID の列
+namespaced_columns: set[str] = {
+    "agency_id",
+    "block_id",
+    "contains_id",
+    "destination_id",
+    "fare_id",
+    "from_route_id",
+    "from_stop_id",
+    "from_trip_id",
+    "jp_office_id",
+    "jp_parent_route_id",
+    "office_id",
+    "origin_id",
+    "parent_station",
+    "route_id",
+    "service_id",
+    "shape_id",
+    "stop_id",
+    "to_route_id",
+    "to_stop_id",
+    "to_trip_id",
+    "trip_id",
+    "zone_id",
+}
+
+# 一括投入中だけ使う設定。journal を持たないので中断したファイルは作り直すこと
+BULK_LOAD_PRAGMAS: dict[str, str] = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": "-262144",  # KiB 指定 (256 MiB)
+    "temp_store": "MEMORY",
+}
+
+
+def _departure_secs(value: str) -> int | None:
+    # "HH:MM:SS" を秒へ。24:00:00 を超える時刻もそのまま扱う
+    if not value:
+        return None
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+# 取り込み時に算出して追加する列: テーブル -> (追加する列, 元の列, 変換関数)
+derived_columns: dict[str, tuple[str, str, Callable[[str], int | None]]] = {
+    "stop_times": ("departure_secs", "departure_time", _departure_secs),
+}
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
 
-def initialize_database(path: str = "./lib/database.sql") -> None:
-    with sqlite3.connect("nowhere.db") as conn:
+
+def initialize_database(
+    path: str = "./lib/database.sql",
+    db_path: str = "nowhere.db",
+) -> None:
+    with sqlite3.connect(db_path) as conn:
         cursor = conn.cursor()
         with Path(path).open("r") as f:
             sql_script = f.read()
         cursor.executescript(sql_script)
+        # スキーマの版。update_database() は違う版の DB には差分を入れずに作り直す
+        cursor.execute(f"PRAGMA user_version = {schema_version(path)}")
         conn.commit()
 
 
-def insert_static() -> None:
+def schema_version(path: str = "./lib/database.sql") -> int:
+    return zlib.crc32(Path(path).read_bytes()) & 0x7FFFFFFF
+
+
+def _drop_secondary_indexes(conn: sqlite3.Connection, table: str) -> list[str]:
+    # 自動生成の主キー索引 (sql が NULL) 以外を落とし、作り直し用の SQL を返す
+    rows = conn.execute(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,),
+    ).fetchall()
+    for name, _ in rows:
+        conn.execute(f"DROP INDEX {_quote(name)}")
+    return [sql for _, sql in rows]
+
+
+def _namespace_rows(
+    rows: Iterable[list[str]],
+    headers: list[str],
+    namespace: str,
+) -> Iterable[list[str]]:
+    positions = [i for i, header in enumerate(headers) if header in namespaced_columns]
+    # agency_id は省略 (空) でも事業者を区別するために付ける
+    agency = headers.index("agency_id") if "agency_id" in headers else -1
+    prefix = f"{namespace}{NAMESPACE_SEPARATOR}"
+    for row in rows:
+        row = list(row)  # noqa: PLW2901
+        for i in positions:
+            if row[i] or i == agency:
+                row[i] = prefix + row[i]
+        yield row
+
+
+def _load_table(
+    conn: sqlite3.Connection,
+    table: str,
+    rows: Iterable[list[str]],
+    headers: list[str],
+    namespace: str = "",
+) -> int:
+    if namespace:
+        rows = _namespace_rows(rows, headers, namespace)
+    if table in derived_columns:
+        column, source, convert = derived_columns[table]
+        position = headers.index(source)
+        headers = [*headers, column]
+        rows = ([*row, convert(row[position])] for row in rows)
+    columns = ",".join(_quote(header) for header in headers)
+    placeholders = ",".join("?" for _ in headers)
+    sql = f"INSERT INTO {_quote(table)} ({columns}) VALUES ({placeholders})"
+    count = 0
+    for batch in batched(rows, BATCH_SIZE, strict=False):
+        conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def _digested(
+    rows: Iterable[list[str]],
+    headers: list[str],
+    column: str,
+    digests: dict[str, hashlib.blake2b],
+) -> Iterator[list[str]]:
+    # 行を流しながら、column の値ごとに行の要約を digests に積む
+    position = headers.index(column)
+    for row in rows:
+        digest = digests.get(row[position])
+        if digest is None:
+            digest = digests[row[position]] = hashlib.blake2b(digest_size=16)
+        digest.update("\x1f".join(row).encode() + b"\x1e")
+        yield row
+
+
+def _store_digests(
+    conn: sqlite3.Connection,
+    table: str,
+    namespace: str,
+    digests: Mapping[str, hashlib.blake2b],
+) -> None:
+    conn.execute(
+        "DELETE FROM static_digests WHERE feed_id = ? AND table_name = ?",
+        (namespace, table),
+    )
+    conn.executemany(
+        "INSERT INTO static_digests (feed_id, table_name, group_key, digest) "
+        "VALUES (?, ?, ?, ?)",
+        [(namespace, table, key, digest.digest()) for key, digest in digests.items()],
+    )
+
+
+def _insert_member(
+    conn: sqlite3.Connection,
+    zip_ref: zipfile.ZipFile,
+    table: str,
+    namespace: str = "",
+) -> int:
+    # diffed_tables のテーブルは、次の差分更新のためにまとまりごとの要約も残す
+    digests = {}
+    with zip_ref.open(f"{table}.txt") as raw:
+        csv_reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig"))
+        headers = next(csv_reader)
+        rows = csv_reader
+        if table in diffed_tables:
+            rows = _digested(rows, headers, diffed_tables[table], digests)
+        count = _load_table(conn, table, rows, headers, namespace)
+    if table in diffed_tables:
+        _store_digests(conn, table, namespace, digests)
+    return count
+
+
+def insert_static(
+    zip_path: str = "static.zip",
+    db_path: str = "nowhere.db",
+    namespace: str = "",
+) -> dict[str, float]:
+    """
+    GTFS の zip から insertable のテーブルを展開せずに読み込んで一括投入する。
+
+    namespace を指定すると ID の列を "<namespace>:<元の ID>" にして入れる。
+
+    Returns:
+        テーブル名をキーとした 1 秒あたりの投入行数。
+    """
     allowed_tables = set(insertable)
-    with sqlite3.connect("nowhere.db") as conn:
-        cursor = conn.cursor()
+    rates: dict[str, float] = {}
+    with sqlite3.connect(db_path) as conn, zipfile.ZipFile(zip_path) as zip_ref:
+        for pragma, value in BULK_LOAD_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        members = set(zip_ref.namelist())
         for table in insertable:
             if table not in allowed_tables:
                 msg = f"Unexpected table name: {table!r}"
                 raise ValueError(msg)
-            safe_table = '"' + table.replace('"', '""') + '"'
-            with Path(f"static/{table}.txt").open("r") as f:
-                csv_reader = csv.reader(f)
-                headers = next(csv_reader)
-                for row in csv_reader:
-                    placeholders = ",".join("?" for _ in row)
-                    cursor.execute(
-                        f"INSERT INTO {safe_table} ({','.join(headers)}) VALUES ({placeholders})",
-                        row,
-                    )
+            member = f"{table}.txt"
+            if member not in members:
+                print(f"Skipped {table}: {member} is not in {zip_path}")  # noqa: T201
+                continue
+            started = time.perf_counter()
+            index_sqls = _drop_secondary_indexes(conn, table)
+            count = _insert_member(conn, zip_ref, table, namespace)
+            for index_sql in index_sqls:
+                conn.execute(index_sql)
+            elapsed = time.perf_counter() - started
+            rates[table] = count / elapsed if elapsed else float(count)
+            print(  # noqa: T201
+                f"Inserted {count} rows into {table} in {elapsed:.2f}s "
+                f"({rates[table]:.0f} rows/s)",
+            )
         conn.commit()
+    return rates
+
+
+def validate_database(db_path: str) -> None:
+    # 差し替え前に最低限の整合性と必須テーブルの中身を確認する
+    with sqlite3.connect(db_path) as conn:
+        (result,) = conn.execute("PRAGMA quick_check").fetchone()
+        if result != "ok":
+            msg = f"Integrity check failed for {db_path}: {result}"
+            raise ValueError(msg)
+        for table in required_tables:
+            (exists,) = conn.execute(
+                f"SELECT EXISTS (SELECT 1 FROM {_quote(table)})",
+            ).fetchone()
+            if not exists:
+                msg = f"Table {table!r} is empty in {db_path}"
+                raise ValueError(msg)
+
+
+def zip_fingerprints(zip_path: str) -> dict[str, str | None]:
+    # insertable のテーブルごとのメンバーの CRC32 と大きさ。中央ディレクトリだけを読む
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        members = {info.filename: info for info in zip_ref.infolist()}
+    return {
+        table: f"{info.CRC:08x}:{info.file_size}"
+        if (info := members.get(f"{table}.txt")) is not None
+        else None
+        for table in insertable
+    }
+
+
+def last_generation(db_path: str) -> int:
+    # static_changes の最後の取り込みの番号。記録のない DB やスキーマが古い DB なら 0
+    if not Path(db_path).exists():
+        return 0
+    try:
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            (generation,) = conn.execute(
+                "SELECT MAX(generation) FROM static_changes",
+            ).fetchone()
+    except sqlite3.Error:
+        return 0
+    return generation or 0
+
+
+def _record_import(
+    conn: sqlite3.Connection,
+    fingerprints: Mapping[tuple[str, str], str | None],
+    changed: Iterable[str],
+    generation: int,
+) -> None:
+    conn.execute("DELETE FROM static_fingerprints")
+    conn.executemany(
+        "INSERT INTO static_fingerprints (feed_id, table_name, fingerprint) "
+        "VALUES (?, ?, ?)",
+        [(feed_id, table, value) for (feed_id, table), value in fingerprints.items()],
+    )
+    # 前の取り込みの記録も残し、何回か差し替えを見逃した StaticStore が
+    # その間に変わったテーブルをまとめて読めるようにする
+    conn.execute(
+        "DELETE FROM static_changes WHERE generation <= ?",
+        (generation - CHANGE_HISTORY,),
+    )
+    conn.executemany(
+        "INSERT INTO static_changes (generation, table_name) VALUES (?, ?)",
+        [(generation, table) for table in sorted(changed)],
+    )
+
+
+def stored_fingerprints(
+    db_path: str,
+    schema_path: str = "./lib/database.sql",
+) -> dict[tuple[str, str], str | None] | None:
+    # 前回の取り込みの (feed_id, テーブル) -> 指紋。
+    # 記録のない DB やスキーマが古い DB なら None
+    if not Path(db_path).exists():
+        return None
+    try:
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version != schema_version(schema_path):
+                return None
+            rows = conn.execute(
+                "SELECT feed_id, table_name, fingerprint FROM static_fingerprints",
+            ).fetchall()
+    except sqlite3.Error:
+        return None
+    return {(feed_id, table): value for feed_id, table, value in rows} or None
+
+
+def build_database(
+    zip_path: str | Mapping[str, str] = "static.zip",
+    db_path: str = "nowhere.db",
+    schema_path: str = "./lib/database.sql",
+) -> dict[str, float]:
+    """
+    稼働中の DB の隣に新しい DB を作り、検証してから rename で差し替える。
+
+    zip_path に feed_id -> zip のパスを渡すと、すべてのフィードを feed_id の名前空間で
+    1 つの DB に入れる。読み込み中や検証失敗時も db_path は古いデータのまま残る。
+    API 側は StaticStore がファイルの差し替えを検知して接続を開き直す。
+    """
+    zip_paths = {"": zip_path} if isinstance(zip_path, str) else zip_path
+    building_path = f"{db_path}.new"
+    Path(building_path).unlink(missing_ok=True)
+    initialize_database(schema_path, building_path)
+    rates = {}
+    fingerprints = {}
+    for feed_id, path in zip_paths.items():
+        rates.update(insert_static(path, building_path, namespace=feed_id))
+        fingerprints.update(
+            ((feed_id, table), value) for table, value in zip_fingerprints(path).items()
+        )
+    # 取り込みの番号は差し替える前の DB の続きから振る (すべてのテーブルが変わった扱い)
+    generation = last_generation(db_path) + 1
+    with sqlite3.connect(building_path) as conn:
+        _record_import(conn, fingerprints, insertable, generation)
+    validate_database(building_path)
+    Path(building_path).replace(db_path)
+    print(f"Swapped {building_path} into {db_path}")  # noqa: T201
+    return rates
+
+
+def _partition_column(conn: sqlite3.Connection, table: str) -> str | None:
+    # フィードごとの行を見分ける列 (名前空間を付ける ID の列のうち最初のもの)
+    for _, column, *_ in conn.execute(f"PRAGMA table_info({_quote(table)})"):
+        if column in namespaced_columns:
+            return column
+    return None
+
+
+def _feed_rows(namespace: str, partition: str | None) -> tuple[str, tuple]:
+    # namespace のフィードの行だけを選ぶ WHERE 句とその値。フィードが 1 つなら全行
+    if not namespace or partition is None:
+        return "", ()
+    prefix = f"{namespace}{NAMESPACE_SEPARATOR}"
+    return f"WHERE substr({_quote(partition)}, 1, {len(prefix)}) = ?", (prefix,)
+
+
+def _diff_table(
+    conn: sqlite3.Connection,
+    zip_ref: zipfile.ZipFile,
+    table: str,
+    namespace: str,
+) -> tuple[int, int]:
+    """
+    zip のメンバーを行のまとまり (diffed_tables の列の値) ごとに要約して前回と比べ、
+    変わったまとまりとなくなったまとまりの行だけを消し、変わった・増えたものを入れる。
+
+    メンバーは要約と投入で 2 回読む。索引は落とさない (変わる行は少ないのが普通)。
+
+    Returns:
+        削除した行数と追加した行数。
+    """
+    column = diffed_tables[table]
+    previous = dict(
+        conn.execute(
+            "SELECT group_key, digest FROM static_digests "
+            "WHERE feed_id = ? AND table_name = ?",
+            (namespace, table),
+        ),
+    )
+    member = f"{table}.txt"
+    digests = {}
+    with zip_ref.open(member) as raw:
+        csv_reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig"))
+        headers = next(csv_reader)
+        for _ in _digested(csv_reader, headers, column, digests):
+            pass
+    changed = {
+        key for key, digest in digests.items() if previous.get(key) != digest.digest()
+    }
+    stale = changed | (previous.keys() - digests.keys())
+    deleted = 0
+    for batch in batched(sorted(stale), 500, strict=False):
+        placeholders = ",".join("?" for _ in batch)
+        deleted += conn.execute(
+            f"DELETE FROM {_quote(table)} WHERE {_quote(column)} IN ({placeholders})",
+            [namespaced(namespace, key) for key in batch],
+        ).rowcount
+    position = headers.index(column)
+    with zip_ref.open(member) as raw:
+        csv_reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig"))
+        next(csv_reader)
+        added = _load_table(
+            conn,
+            table,
+            (row for row in csv_reader if row[position] in changed),
+            headers,
+            namespace,
+        )
+    _store_digests(conn, table, namespace, digests)
+    return deleted, added
+
+
+def _reload_table(
+    conn: sqlite3.Connection,
+    zip_paths: Mapping[str, str],
+    table: str,
+    feed_ids: Iterable[str],
+) -> int:
+    # feed_ids のフィードの行を消して入れ直す
+    quoted = _quote(table)
+    partition = _partition_column(conn, table)
+    index_sqls = _drop_secondary_indexes(conn, table)
+    if partition is None:
+        # フィードの行を見分けられないので、全行を消して全フィードから入れ直す
+        conn.execute(f"DELETE FROM {quoted}")
+        feed_ids = list(zip_paths)
+    else:
+        feed_ids = list(feed_ids)
+        for feed_id in feed_ids:
+            where, params = _feed_rows(feed_id, partition)
+            conn.execute(f"DELETE FROM {quoted} {where}", params)
+    count = 0
+    for feed_id in feed_ids:
+        with zipfile.ZipFile(zip_paths[feed_id]) as zip_ref:
+            if f"{table}.txt" in zip_ref.namelist():
+                count += _insert_member(conn, zip_ref, table, feed_id)
+    for index_sql in index_sqls:
+        conn.execute(index_sql)
+    return count
+
+
+def update_database(
+    zip_path: str | Mapping[str, str] = "static.zip",
+    db_path: str = "nowhere.db",
+    schema_path: str = "./lib/database.sql",
+) -> set[str]:
+    """
+    稼働中の DB を複製し、前回から中身が変わったテーブルだけを入れ直して差し替える。
+
+    zip のメンバーの CRC32 と大きさを static_fingerprints と比べて、変わっていない
+    テーブルには触れない。diffed_tables のテーブルは便などのまとまりごとに前回と
+    比べ、変わったまとまりの行だけを入れ直す。変わったテーブルは取り込みの番号と
+    一緒に static_changes に書き足し、StaticStore は前に見た番号から後に変わった
+    テーブルを読んでいるキャッシュだけを無効化する。記録のない DB、
+    スキーマ (database.sql) が変わった DB、フィードの組が変わった場合は
+    build_database() で作り直す。
+
+    Returns:
+        中身が変わったテーブル名。空なら DB は差し替えない。
+    """
+    zip_paths = {"": zip_path} if isinstance(zip_path, str) else zip_path
+    fingerprints = {
+        (feed_id, table): value
+        for feed_id, path in zip_paths.items()
+        for table, value in zip_fingerprints(path).items()
+    }
+    previous = stored_fingerprints(db_path, schema_path)
+    if previous is None or {feed_id for feed_id, _ in previous} != set(zip_paths):
+        build_database(zip_paths, db_path, schema_path)
+        return set(insertable)
+    changed_keys = {
+        key
+        for key, value in fingerprints.items()
+        if key not in previous or previous[key] != value
+    }
+    changed = {table for _, table in changed_keys}
+    if not changed:
+        print(f"Static feeds are unchanged; kept {db_path}")  # noqa: T201
+        return changed
+
+    building_path = f"{db_path}.new"
+    Path(building_path).unlink(missing_ok=True)
+    with (
+        closing(sqlite3.connect(db_path)) as source,
+        closing(sqlite3.connect(building_path)) as conn,
+    ):
+        source.backup(conn)
+    with sqlite3.connect(building_path) as conn:
+        for pragma, value in BULK_LOAD_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        for table in insertable:
+            if table not in changed:
+                continue
+            started = time.perf_counter()
+            feed_ids = [
+                feed_id for feed_id in zip_paths if (feed_id, table) in changed_keys
+            ]
+            reload_ids = []
+            applied = []
+            for feed_id in feed_ids:
+                if (
+                    table in diffed_tables
+                    and fingerprints[feed_id, table] is not None
+                    and previous.get((feed_id, table)) is not None
+                ):
+                    with zipfile.ZipFile(zip_paths[feed_id]) as zip_ref:
+                        deleted, added = _diff_table(conn, zip_ref, table, feed_id)
+                    applied.append(f"-{deleted} +{added} rows")
+                else:
+                    reload_ids.append(feed_id)
+            if reload_ids:
+                count = _reload_table(conn, zip_paths, table, reload_ids)
+                applied.append(f"reloaded {count} rows")
+            print(  # noqa: T201
+                f"Applied changes to {table} in {time.perf_counter() - started:.2f}s "
+                f"({', '.join(applied)})",
+            )
+        _record_import(conn, fingerprints, changed, last_generation(db_path) + 1)
+    validate_database(building_path)
+    Path(building_path).replace(db_path)
+    print(f"Swapped {building_path} into {db_path}: {', '.join(sorted(changed))}")  # noqa: T201
+    return changed
 
 
 def download_static_files(url: str, dest_path: str) -> bool:
+    """
+    静的 GTFS の zip を dest_path に保存する。
+
+    前回の ETag と Last-Modified を "<dest_path>.json" に残して条件付きで取得し、
+    更新がなければ (304) 手元の zip をそのまま使う。
+    """
+    validators_path = Path(f"{dest_path}.json")
+    validators = {}
+    if Path(dest_path).exists() and validators_path.exists():
+        with validators_path.open("r") as f:
+            validators = json.load(f)
     try:
-        # Download the Files
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()  # Raise an error for HTTP errors
+        content, etag, last_modified = fetch_dynamic_feed(
+            url,
+            etag=validators.get("etag"),
+            last_modified=validators.get("last_modified"),
+            timeout=60,
+        )
+        if content is None:
+            print(f"Static files at {url} are not modified; kept {dest_path}")  # noqa: T201
+            return True
         with Path(dest_path).open("wb") as f:
-            f.write(response.content)
+            f.write(content)
+        with validators_path.open("w") as f:
+            json.dump({"etag": etag, "last_modified": last_modified}, f)
         print(f"Downloaded static files to {dest_path}")
-        with zipfile.ZipFile(dest_path, "r") as zip_ref:
-            zip_ref.extractall("static")
-        print("Extracted static files to 'static' directory")
     except Exception as e:
         print(f"Error downloading static files: {e}")
+        return False
+    return True
 
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
-    gtfs_static_url = os.getenv("GTFS_STATIC_URL")
-    initialize_database()
-    download_static_files(gtfs_static_url, "static.zip")
-    insert_static()
+    feeds = load_feeds(os.getenv("FEEDS_PATH"))
+    zip_paths = {
+        feed_id: f"static-{feed_id}.zip" if feed_id else "static.zip"
+        for feed_id, feed in feeds.items()
+        if feed.static_url
+    }
+    # 1 つでも取得に失敗したら、欠けた DB で差し替えないよう何もしない
+    if all(
+        download_static_files(feeds[feed_id].static_url, path)
+        for feed_id, path in zip_paths.items()
+    ):
+        update_database(zip_paths)
@@ -28,6 +28,9 @@ DROP TABLE IF EXISTS stop_times ;
 DROP TABLE IF EXISTS stops ;
 DROP TABLE IF EXISTS transfers ;
 DROP TABLE IF EXISTS translations ;
+DROP TABLE IF EXISTS static_fingerprints ;
+DROP TABLE IF EXISTS static_changes ;
+DROP TABLE IF EXISTS static_digests ;
 
 PRAGMA foreign_keys = ON;
 
@@ -104,6 +107,10 @@ CREATE TABLE calendar_dates (
 	exception_type	VARCHAR(2)	-- 利用タイプ
 );
 
+-- 日付ごとの運行・運休サービス検索用
+CREATE INDEX calendar_dates_date_exception
+	ON calendar_dates (date, exception_type, service_id);
+
 -- 便情報
 CREATE TABLE trips (
 	trip_id			VARCHAR(64) PRIMARY KEY,	-- 便ID
@@ -141,9 +148,10 @@ CREATE TABLE office_jp (
 CREATE TABLE frequencies (
 	trip_id		VARCHAR(64),	-- 便ID
 	start_time	VARCHAR(12),	-- 開始時刻(HH:MM:SS形式)
-	end_time	VARCHAR(12),	-- 開始時刻(HH:MM:SS形式)
+	end_time	VARCHAR(12),	-- 終了時刻(HH:MM:SS形式)
 	headway_secs	INT,		-- 運行間隔(秒)
 	exact_times	INT,		-- 案内精度
+	PRIMARY KEY (trip_id, start_time),
 	FOREIGN KEY (trip_id)
 	REFERENCES trips (trip_id)
 );
@@ -160,10 +168,19 @@ CREATE TABLE stop_times (
 	drop_off_type		VARCHAR(2),	-- 降車区分
 	shape_dist_traveled	INT,		-- 通算距離(単位はメートル(m))
 	timepoint		INT,	-- 発着時間精度(日本では使用しない)
+	departure_secs		INT,		-- 出発時刻(秒, 24時以降もそのまま, 取り込み時に算出)
 	FOREIGN KEY (stop_id)
 	REFERENCES stops (stop_id)
 );
 
+-- 停留所ごとの発車時刻検索用(get_bus_schedule_flexible が表を引かずに済むよう列を含める)
+CREATE INDEX stop_times_stop_departure
+	ON stop_times (stop_id, departure_secs, trip_id, departure_time, stop_headsign);
+
+-- 便ごとの停車順(遅延の伝播に使う)
+CREATE INDEX stop_times_trip_sequence
+	ON stop_times (trip_id, stop_sequence, stop_id);
+
 -- 停留所・標柱情報
 CREATE TABLE stops (
 	stop_id			VARCHAR(64) PRIMARY KEY,	-- 停留所・標柱ID
@@ -186,8 +203,12 @@ CREATE TABLE stops (
 CREATE TABLE transfers (
 	from_stop_id		VARCHAR(64),	-- 乗継元標柱ID
 	to_stop_id		VARCHAR(64),	-- 乗継先標柱ID
+	from_route_id		VARCHAR(64),	-- 乗継元経路ID
+	to_route_id		VARCHAR(64),	-- 乗継先経路ID
+	from_trip_id		VARCHAR(64),	-- 乗継元便ID
+	to_trip_id		VARCHAR(64),	-- 乗継先便ID
 	transfer_type		VARCHAR(2),	-- 乗継ぎタイプ
-	min_transfer_type	INT UNSIGNED	-- 乗継時間
+	min_transfer_time	INT UNSIGNED	-- 乗継時間(秒)
 );
 
 -- 運賃属性情報
@@ -239,3 +260,28 @@ CREATE TABLE translations (
 	lang		VARCHAR(8) NOT NULL,	-- 言語
 	translation	TEXT NOT NULL		-- 翻訳先言語
 );
+
+-- 取り込んだ zip のメンバーの指紋(差分更新で変わったテーブルを見分ける)
+CREATE TABLE static_fingerprints (
+	feed_id		VARCHAR(64),	-- フィードID(フィードが 1 つなら空)
+	table_name	VARCHAR(64),	-- テーブル名
+	fingerprint	TEXT,		-- メンバーの CRC32 と大きさ(zip になければ NULL)
+	PRIMARY KEY (feed_id, table_name)
+);
+
+-- 差分更新するテーブルの、行のまとまり(stop_times なら便)ごとの要約
+CREATE TABLE static_digests (
+	feed_id		VARCHAR(64),	-- フィードID(フィードが 1 つなら空)
+	table_name	VARCHAR(64),	-- テーブル名
+	group_key	VARCHAR(64),	-- まとまりの値(名前空間を付ける前の ID)
+	digest		BLOB,		-- まとまりの行の BLAKE2b
+	PRIMARY KEY (feed_id, table_name, group_key)
+);
+
+-- 取り込みごとに中身が変わったテーブル(StaticStore が無効化するキャッシュを選ぶ)
+-- 直近の CHANGE_HISTORY 回分だけ残す
+CREATE TABLE static_changes (
+	generation	INTEGER,	-- 取り込みの通し番号(差し替えるたびに 1 つ増える)
+	table_name	VARCHAR(64),	-- テーブル名
+	PRIMARY KEY (generation, table_name)
+);
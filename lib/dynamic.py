@@ -1,36 +1,277 @@
 import json
 import os
-from pathlib import Path
-import requests
+from collections.abc import Mapping
+from http import HTTPStatus
+from typing import NamedTuple
 
 import dotenv
+import requests
 from google.protobuf.json_format import MessageToDict
 from google.transit import gtfs_realtime_pb2
 
+from .alerts import AlertIndex, parse_alerts
+from .feeds import namespaced, run_trip_ids
+from .vehicles import VehicleIndex, VehiclePosition, parse_vehicle_positions
+
+# schedule_relationship の列挙値 -> 名前 (MessageToDict と同じ表記)
+_STOP_RELATIONSHIPS = {
+    value: name
+    for name, value in gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship.items()
+}
+_TRIP_RELATIONSHIPS = {
+    value: name
+    for name, value in gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship.items()
+}
+
+
+class StopTimeEvent(NamedTuple):
+    delay: int | None
+    time: int | None
+    uncertainty: int | None
+
+
+class StopTimeUpdate(NamedTuple):
+    stop_id: str | None
+    stop_sequence: int | None
+    arrival: StopTimeEvent | None
+    departure: StopTimeEvent | None
+    schedule_relationship: str | None
+
+
+class TripRecord(NamedTuple):
+    trip_id: str
+    schedule_relationship: str | None
+    timestamp: int | None
+    stops: dict[str, StopTimeUpdate]  # stop_id -> 更新
+    updates: tuple[StopTimeUpdate, ...]  # フィード上の順序のまま
+    start_date: str | None = None  # 便の運行日 (YYYYMMDD)。なければ運行日を問わない
+
+
+class RealtimeIndex(NamedTuple):
+    """
+    TripUpdate を trip_id -> stop_id で引けるようにした索引。
+
+    マージに使う項目だけを protobuf から直接取り出して保持する。
+    同じフィード (または同じ事業者の別のフィード) の VehiclePosition と Alert の索引も
+    一緒に持ち、掲示板の便から直接引けるようにする。
+    """
 
-def download_dynamic_files(url: str, dest_path: str) -> str | None:
-    # Download the Files
-    response = requests.get(url, timeout=10)
+    timestamp: int
+    trips: dict[str, TripRecord]
+    vehicles: VehicleIndex = VehicleIndex()
+    alerts: AlertIndex = AlertIndex()
+
+
+def fetch_dynamic_feed(
+    url: str,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    http: requests.Session | None = None,
+    timeout: float = 10,
+) -> tuple[bytes | None, str | None, str | None]:
+    # 条件付き GET で取得し、更新がなければ本文を None で返す。ファイルには書かない
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = (http or requests).get(url, headers=headers, timeout=timeout)
+    if response.status_code == HTTPStatus.NOT_MODIFIED:
+        return None, etag, last_modified
     response.raise_for_status()  # Raise an error for HTTP errors
-    with Path(dest_path).open("wb") as f:
-        f.write(response.content)
-    return dest_path
+    return (
+        response.content,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
 
 
-def parse_gtfs_realtime(trip_updates_path: str) -> dict:
+def load_feed_message(content: bytes) -> gtfs_realtime_pb2.FeedMessage:
     feed = gtfs_realtime_pb2.FeedMessage()
-    with Path(trip_updates_path).open("rb") as response:
-        feed.ParseFromString(response.read())
-        res = MessageToDict(feed, preserving_proto_field_name=True)
-    return res
+    feed.ParseFromString(content)
+    return feed
+
+
+def _stop_time_event(
+    event: gtfs_realtime_pb2.TripUpdate.StopTimeEvent,
+) -> StopTimeEvent:
+    return StopTimeEvent(
+        event.delay if event.HasField("delay") else None,
+        event.time if event.HasField("time") else None,
+        event.uncertainty if event.HasField("uncertainty") else None,
+    )
+
+
+def _stop_time_update(
+    stop_update: gtfs_realtime_pb2.TripUpdate.StopTimeUpdate,
+    namespace: str = "",
+) -> StopTimeUpdate:
+    return StopTimeUpdate(
+        namespaced(namespace, stop_update.stop_id)
+        if stop_update.HasField("stop_id")
+        else None,
+        stop_update.stop_sequence if stop_update.HasField("stop_sequence") else None,
+        _stop_time_event(stop_update.arrival)
+        if stop_update.HasField("arrival")
+        else None,
+        _stop_time_event(stop_update.departure)
+        if stop_update.HasField("departure")
+        else None,
+        _STOP_RELATIONSHIPS[stop_update.schedule_relationship]
+        if stop_update.HasField("schedule_relationship")
+        else None,
+    )
+
+
+def _trip_record(
+    trip_update: gtfs_realtime_pb2.TripUpdate,
+    namespace: str = "",
+) -> TripRecord:
+    trip = trip_update.trip
+    updates = [
+        _stop_time_update(stop_update, namespace)
+        for stop_update in trip_update.stop_time_update
+    ]
+    return TripRecord(
+        namespaced(namespace, trip.trip_id),
+        _TRIP_RELATIONSHIPS[trip.schedule_relationship]
+        if trip.HasField("schedule_relationship")
+        else None,
+        trip_update.timestamp if trip_update.HasField("timestamp") else None,
+        {update.stop_id: update for update in updates if update.stop_id},
+        tuple(updates),
+        trip.start_date if trip.HasField("start_date") else None,
+    )
+
+
+def _trip_keys(trip: gtfs_realtime_pb2.TripDescriptor, trip_id: str) -> list[str]:
+    # 始発時刻のある便は frequencies.txt の便の 1 本として、運行日のある便はその運行日の
+    # 便としても引けるようにする。最後のものがいちばん絞られた trip_id
+    if not trip_id:
+        return [trip_id]
+    return run_trip_ids(
+        trip_id,
+        trip.start_time if trip.HasField("start_time") else None,
+        trip.start_date if trip.HasField("start_date") else None,
+    )
+
+
+def build_realtime_index(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    namespace: str = "",
+) -> RealtimeIndex:
+    """
+    namespace を指定すると trip_id と stop_id を静的データと同じ名前空間に入れる。
+
+    便は run_trip_ids() のすべての trip_id で引ける (始発時刻 start_time のある便は
+    frequency_trip_id() でも、運行日 start_date のある便は dated_trip_id() でも)。
+    運行日まで合わせて引くには run_record() を使う。
+    """
+    trips: dict[str, TripRecord] = {}
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        record = _trip_record(entity.trip_update, namespace)
+        for key in _trip_keys(entity.trip_update.trip, record.trip_id):
+            trips[key] = record
+    return RealtimeIndex(
+        feed.header.timestamp,
+        trips,
+        VehicleIndex(parse_vehicle_positions(feed, namespace)),
+        AlertIndex(parse_alerts(feed, namespace)),
+    )
+
+
+class RealtimeDelta(NamedTuple):
+    index: RealtimeIndex
+    fingerprints: dict[str, int]  # trip_id -> TripUpdate のバイト列のハッシュ
+    # 前回から TripUpdate か VehiclePosition が追加・変更・削除された trip_id
+    changed: frozenset[str]
+    # Alert は系統や停留所単位でも効くので、変わったら便を絞らずに作り直させる
+    alerts_changed: bool = False
+
+
+def _vehicle_fingerprint(position: VehiclePosition) -> int:
+    # マージで掲示板に載せるものだけ。取得の時刻 (timestamp) だけが進んでも便は変わらない
+    return hash(
+        (
+            position.vehicle_id,
+            position.latitude,
+            position.longitude,
+            position.bearing,
+            position.stop_id,
+            position.current_stop_sequence,
+            position.current_status,
+        ),
+    )
+
+
+def update_realtime_index(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    previous: RealtimeIndex,
+    fingerprints: Mapping[str, int],
+    namespace: str = "",
+) -> RealtimeDelta:
+    """
+    前回の索引との差分だけを作り直して新しい索引を作る。
+
+    TripUpdate ごとにシリアライズしたバイト列のハッシュを前回と比べ、同じなら前回の
+    TripRecord をそのまま使う。変わった便だけを Python のオブジェクトに変換する。
+    VehiclePosition と Alert は件数が少ないので毎回作り直し、前回と比べて差分を出す。
+    VehiclePosition は位置・停留所・状態だけを比べ、時刻だけ進んだ車両の便は変わったと
+    みなさない (組み立て済みの掲示板の車両の timestamp は次に便が変わるまで前のまま)。
+    """
+    trips: dict[str, TripRecord] = {}
+    new_fingerprints: dict[str, int] = {}
+    changed: set[str] = set()
+    previous_trips = previous.trips
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip_update = entity.trip_update
+        trip_id = namespaced(namespace, trip_update.trip.trip_id)
+        # 同じ trip_id の便が何本も走る頻度ベースの便や別の運行日の便は 1 本ごとに比べる
+        keys = _trip_keys(trip_update.trip, trip_id)
+        key = keys[-1]
+        fingerprint = hash(trip_update.SerializeToString(deterministic=True))
+        new_fingerprints[key] = fingerprint
+        record = previous_trips.get(key)
+        if record is None or fingerprints.get(key) != fingerprint:
+            record = _trip_record(trip_update, namespace)
+            changed.update(keys)
+        for key in keys:
+            trips[key] = record
+    changed.update(trip_id for trip_id in previous_trips if trip_id not in trips)
+
+    vehicles = VehicleIndex(parse_vehicle_positions(feed, namespace))
+    previous_vehicles = previous.vehicles.by_trip
+    changed.update(
+        trip_id
+        for trip_id, position in vehicles.by_trip.items()
+        if trip_id not in previous_vehicles
+        or _vehicle_fingerprint(previous_vehicles[trip_id])
+        != _vehicle_fingerprint(position)
+    )
+    changed.update(
+        trip_id for trip_id in previous_vehicles if trip_id not in vehicles.by_trip
+    )
+    alerts = AlertIndex(parse_alerts(feed, namespace))
+    return RealtimeDelta(
+        RealtimeIndex(feed.header.timestamp, trips, vehicles, alerts),
+        new_fingerprints,
+        frozenset(changed),
+        alerts_changed=alerts.alerts != previous.alerts.alerts,
+    )
+
+
+def parse_gtfs_realtime(content: bytes) -> dict:
+    # 確認用に、取得したバイト列をそのまま辞書にする
+    return MessageToDict(load_feed_message(content), preserving_proto_field_name=True)
 
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
     gtfs_dynamic_url = os.getenv("GTFS_DYNAMIC_URL")
-    download_dynamic_files(
-        gtfs_dynamic_url,
-        "trip_updates.bin",
-    )
-    result = parse_gtfs_realtime("trip_updates.bin")
+    content, _, _ = fetch_dynamic_feed(gtfs_dynamic_url)
+    result = parse_gtfs_realtime(content)
     print(json.dumps(result, ensure_ascii=False, indent=4))
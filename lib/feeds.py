@@ -0,0 +1,171 @@
+import json
+import os
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Protocol
+from zoneinfo import ZoneInfo
+
+# 複数のフィードを 1 つの DB に入れるときの ID の区切り。"<feed_id>:<元の ID>"
+NAMESPACE_SEPARATOR = ":"
+# frequencies.txt の便の 1 本 1 本の trip_id の区切り。"<trip_id>@<始発時刻>"
+FREQUENCY_SEPARATOR = "@"
+# 同じ掲示板に別の運行日の同じ便が載るときの区切り。"<trip_id>#<運行日 YYYYMMDD>"
+SERVICE_DATE_SEPARATOR = "#"
+# リアルタイムの時刻を表示するタイムゾーン。agency.txt の agency_timezone に合わせる
+AGENCY_TIMEZONE = ZoneInfo(os.getenv("GTFS_TIMEZONE", "Asia/Tokyo"))
+
+
+@dataclass(frozen=True)
+class Feed:
+    """
+    事業者ごとの静的 GTFS と GTFS-Realtime の組。
+
+    feed_id が空のフィードは ID をそのまま使う (フィードが 1 つだけの従来の動作)。
+    """
+
+    feed_id: str
+    static_url: str | None = None
+    # TripUpdates。VehiclePositions や Alerts も同じフィードに入っていれば一緒に読む
+    realtime_url: str | None = None
+    vehicle_positions_url: str | None = None
+    alerts_url: str | None = None
+    # Realtime の 1 回の取得にかけてよい秒数
+    timeout: float = 10.0
+
+    def realtime_sources(self) -> list[tuple[str, str]]:
+        # (種類, URL)。設定されているものだけ
+        return [
+            (source, url)
+            for source, url in (
+                ("trip_updates", self.realtime_url),
+                ("vehicle_positions", self.vehicle_positions_url),
+                ("alerts", self.alerts_url),
+            )
+            if url
+        ]
+
+
+def namespaced(namespace: str, value: str | None) -> str | None:
+    if not namespace or not value:
+        return value
+    return f"{namespace}{NAMESPACE_SEPARATOR}{value}"
+
+
+def frequency_trip_id(trip_id: str, start_time: str) -> str | None:
+    """
+    frequencies.txt で運行する便の 1 本を表す trip_id。
+
+    GTFS-Realtime の TripDescriptor の trip_id と start_time からも同じものを作る。
+    始発時刻の "8:00:00" のような表記ゆれはそろえ、時刻として読めなければ None。
+    """
+    parts = start_time.split(":")
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):  # noqa: PLR2004
+        return None
+    hours, minutes, seconds = map(int, parts)
+    return f"{trip_id}{FREQUENCY_SEPARATOR}{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def dated_trip_id(trip_id: str, service_date: str) -> str:
+    # 運行日 (YYYYMMDD) を付けた trip_id。GTFS-Realtime の start_date の便と同じもの
+    return f"{trip_id}{SERVICE_DATE_SEPARATOR}{service_date}"
+
+
+def base_trip_id(trip_id: str) -> str:
+    # dated_trip_id() や frequency_trip_id() の trip_id から元の便の trip_id を取り出す
+    head, separator, tail = trip_id.rpartition(SERVICE_DATE_SEPARATOR)
+    if separator and len(tail) == 8 and tail.isdigit():  # noqa: PLR2004
+        trip_id = head
+    head, separator, tail = trip_id.rpartition(FREQUENCY_SEPARATOR)
+    if separator and frequency_trip_id(head, tail) is not None:
+        return head
+    return trip_id
+
+
+def run_trip_ids(
+    trip_id: str,
+    start_time: str | None = None,
+    start_date: str | None = None,
+) -> list[str]:
+    """
+    GTFS-Realtime の TripDescriptor の便を引くための trip_id。後ろほど 1 本に絞られる。
+
+    start_time があれば frequency_trip_id() を、start_date があればそれぞれの
+    dated_trip_id() を加える。
+    """
+    trip_ids = [trip_id]
+    if start_time:
+        instance = frequency_trip_id(trip_id, start_time)
+        if instance is not None:
+            trip_ids.append(instance)
+    if start_date:
+        trip_ids.extend([dated_trip_id(value, start_date) for value in trip_ids])
+    return trip_ids
+
+
+class _Run(Protocol):
+    # TripRecord と VehiclePosition
+    @property
+    def start_date(self) -> str | None: ...
+
+
+def run_record[T: _Run](
+    records: Mapping[str, T],
+    trip_id: str,
+    service_date: str | None,
+    *,
+    undated: bool = True,
+) -> T | None:
+    """
+    run_trip_ids() の trip_id で引ける索引から、service_date の運行日の便の記録を引く。
+
+    start_date の違う記録は使わない。start_date のない記録は undated のときだけ使う
+    (同じ便が別の運行日にも載っている掲示板では、最初の 1 本だけに付ける)。
+    """
+    if service_date:
+        record = records.get(dated_trip_id(trip_id, service_date))
+        if record is not None:
+            return record
+    record = records.get(trip_id)
+    if record is None or service_date is None:
+        return record
+    if record.start_date is None:
+        return record if undated else None
+    return record if record.start_date == service_date else None
+
+
+def load_feeds(path: str | None = None) -> dict[str, Feed]:
+    """
+    フィードの設定を JSON から読み込む。
+
+    {"<feed_id>": {"static_url": "...", "realtime_url": "...",
+                   "vehicle_positions_url": "...", "alerts_url": "...", "timeout": 10}}
+
+    path がなければ GTFS_STATIC_URL、GTFS_DYNAMIC_URL、GTFS_VEHICLE_POSITIONS_URL、
+    GTFS_ALERTS_URL を feed_id "" のフィードとして使う。
+    複数のフィードを使う場合、停留所などの ID は "<feed_id>:<元の ID>" になるので、
+    掲示板の設定 (BOARDS_PATH) の stop_ids もその形で書く。
+    """
+    if not path:
+        return {
+            "": Feed(
+                "",
+                static_url=os.getenv("GTFS_STATIC_URL"),
+                realtime_url=os.getenv("GTFS_DYNAMIC_URL"),
+                vehicle_positions_url=os.getenv("GTFS_VEHICLE_POSITIONS_URL"),
+                alerts_url=os.getenv("GTFS_ALERTS_URL"),
+            ),
+        }
+    with Path(path).open("r") as f:
+        raw = json.load(f)
+    return {
+        feed_id: Feed(
+            feed_id,
+            static_url=config.get("static_url"),
+            realtime_url=config.get("realtime_url"),
+            vehicle_positions_url=config.get("vehicle_positions_url"),
+            alerts_url=config.get("alerts_url"),
+            timeout=config.get("timeout", Feed.timeout),
+        )
+        for feed_id, config in raw.items()
+    }
@@ -0,0 +1,76 @@
+import math
+from collections import defaultdict
+from collections.abc import Iterable
+
+# 空間の索引の 1 マスの大きさ (度)。緯度方向で約 1.1 km
+BUCKET_DEGREES = 0.01
+EARTH_RADIUS_METERS = 6_371_000
+
+
+def _bucket(latitude: float, longitude: float) -> tuple[int, int]:
+    return (
+        math.floor(latitude / BUCKET_DEGREES),
+        math.floor(longitude / BUCKET_DEGREES),
+    )
+
+
+def distance_meters(
+    latitude: float,
+    longitude: float,
+    other_latitude: float,
+    other_longitude: float,
+) -> float:
+    # 数 km 以内の比較にしか使わないので正距円筒図法の近似で十分
+    x = math.radians(other_longitude - longitude) * math.cos(
+        math.radians((latitude + other_latitude) / 2),
+    )
+    y = math.radians(other_latitude - latitude)
+    return math.hypot(x, y) * EARTH_RADIUS_METERS
+
+
+class GridIndex[T]:
+    """
+    位置を持つ値を BUCKET_DEGREES 四方のマスに分けて持つ索引。
+
+    near() は周りのマスだけを調べる。作った後は変更しない。
+    """
+
+    def __init__(self, items: Iterable[tuple[float, float, T]] = ()) -> None:
+        buckets: defaultdict[tuple[int, int], list[tuple[float, float, T]]] = (
+            defaultdict(list)
+        )
+        for latitude, longitude, item in items:
+            buckets[_bucket(latitude, longitude)].append((latitude, longitude, item))
+        self.buckets = dict(buckets)
+
+    def near(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_meters: float,
+    ) -> list[tuple[float, T]]:
+        # radius_meters 以内の値を (距離, 値) の近い順で返す
+        lat_cells = math.ceil(
+            radius_meters / (math.radians(BUCKET_DEGREES) * EARTH_RADIUS_METERS),
+        )
+        lon_cells = math.ceil(
+            lat_cells / max(math.cos(math.radians(latitude)), 0.01),
+        )
+        row, column = _bucket(latitude, longitude)
+        found = []
+        for bucket_row in range(row - lat_cells, row + lat_cells + 1):
+            for bucket_column in range(column - lon_cells, column + lon_cells + 1):
+                for item_latitude, item_longitude, item in self.buckets.get(
+                    (bucket_row, bucket_column),
+                    (),
+                ):
+                    distance = distance_meters(
+                        latitude,
+                        longitude,
+                        item_latitude,
+                        item_longitude,
+                    )
+                    if distance <= radius_meters:
+                        found.append((distance, item))
+        found.sort(key=lambda item: item[0])
+        return found
@@ -0,0 +1,696 @@
+import datetime
+import math
+import threading
+from array import array
+from collections import defaultdict
+from collections.abc import Callable, Iterable, Mapping
+from typing import NamedTuple
+
+from sqlalchemy.orm import Session
+
+from .dynamic import RealtimeIndex
+from .feeds import frequency_trip_id, run_record
+from .merger import position_delays
+from .static import secs_to_gtfs_time, secs_to_time, service_days
+from .static_models import Transfers
+from .stops import StopIndex
+from .store import session_generation
+from .timetable import Timetable
+
+# 徒歩で乗り換える停留所どうしの距離の上限 (m) と歩く速さ (m/s)
+MAX_WALK_METERS = 400
+WALKING_SPEED = 1.2
+# 徒歩の乗り換えに足す余裕 (秒)。transfers.txt に時間があればそちらを使う
+TRANSFER_BUFFER_SECS = 60
+# 乗る便の数の上限 (乗り換えはこれより 1 少ない)
+MAX_ROUNDS = 5
+# 出発からこの秒数より後の到着は探さない
+MAX_JOURNEY_SECS = 4 * 3600
+# リアルタイムを使うとき、時刻表でこれだけ前に出た便まで遅れて来るものとして探す (秒)
+REALTIME_LOOKBACK_SECS = 30 * 60
+
+_INFINITY = 2**31 - 1
+
+
+class Leg(NamedTuple):
+    from_stop: int
+    to_stop: int
+    departure_secs: int  # target_date の 0 時からの秒
+    arrival_secs: int
+    trip: int  # 徒歩なら -1
+    trip_start: int  # frequencies.txt の便なら 1 本ごとの始発の秒。ほかは -1
+    board_position: int  # 便の停車パターン上の乗る位置と降りる位置。徒歩なら -1
+    alight_position: int
+    delay: int | None  # リアルタイムの遅延 (乗る停留所)。なければ None
+
+
+class Journey(NamedTuple):
+    departure_secs: int
+    arrival_secs: int
+    legs: tuple[Leg, ...]
+
+    @property
+    def transfers(self) -> int:
+        return max(sum(leg.trip >= 0 for leg in self.legs) - 1, 0)
+
+
+class _Days(NamedTuple):
+    # 探索する運行日ごとの、運行する便の印と発車秒に足すずれ
+    active: bytearray
+    shift: int
+
+
+class _Boarding(NamedTuple):
+    position: int  # 系統の中の便の順位
+    shift: int
+    delays: list[int | None] | None
+    departure: int
+    board_position: int
+    board_stop: int
+
+
+def load_footpaths(
+    session: Session,
+    timetable: Timetable,
+    stop_index: StopIndex,
+) -> dict[int, dict[int, int]]:
+    """
+    停留所 (Timetable の番号) -> 徒歩で移れる停留所 -> 秒。
+
+    MAX_WALK_METERS 以内の標柱どうしを歩く速さから求め、transfers.txt に
+    時間 (transfer_type 2) があれば置き換え、乗り継げない組 (3) は除く。
+    便や経路を指定した乗り継ぎは扱わない。
+    """
+    footpaths: defaultdict[int, dict[int, int]] = defaultdict(dict)
+    stop_number = timetable.stops.get
+    for stop in stop_index.stops:
+        origin = stop_number(stop.stop_id)
+        if origin is None:
+            continue
+        for distance, other in stop_index.grid.near(
+            stop.latitude,
+            stop.longitude,
+            MAX_WALK_METERS,
+        ):
+            target = stop_number(other.stop_id)
+            if target is not None and target != origin:
+                footpaths[origin][target] = (
+                    math.ceil(distance / WALKING_SPEED) + TRANSFER_BUFFER_SECS
+                )
+
+    rows = session.query(
+        Transfers.from_stop_id,
+        Transfers.to_stop_id,
+        Transfers.transfer_type,
+        Transfers.min_transfer_time,
+    ).filter(
+        Transfers.from_route_id.is_(None) | (Transfers.from_route_id == ""),
+        Transfers.to_route_id.is_(None) | (Transfers.to_route_id == ""),
+        Transfers.from_trip_id.is_(None) | (Transfers.from_trip_id == ""),
+        Transfers.to_trip_id.is_(None) | (Transfers.to_trip_id == ""),
+    )
+    for from_stop_id, to_stop_id, transfer_type, min_transfer_time in rows:
+        origin = stop_number(from_stop_id)
+        target = stop_number(to_stop_id)
+        if origin is None or target is None or origin == target:
+            continue
+        if transfer_type == "3":
+            footpaths[origin].pop(target, None)
+        elif transfer_type == "2" and min_transfer_time:
+            footpaths[origin][target] = int(min_transfer_time)
+        else:
+            footpaths[origin].setdefault(target, TRANSFER_BUFFER_SECS)
+    return dict(footpaths)
+
+
+class JourneyPlanner:
+    """
+    Timetable の上で RAPTOR (ラウンドごとに系統を走査する経路探索) を行う。
+
+    停車する停留所の並びが同じ便を 1 つの系統にまとめ、系統ごとに便を発車順に並べた
+    時刻の表 (便 x 停留所) を 1 本の array に持つ。追い越しのある便は別の系統に分け、
+    どの停留所でも便の順序が発車順になるようにしておくので、乗れる最初の便は二分探索で
+    見つかる。停留所から系統、停留所から徒歩の乗り換えも CSR 形式の array で引く。
+    運行日ごとの運行する便の印は最初に使ったときに作って使い回す。
+
+    時刻は発車時刻 (departure_secs) だけを使い、到着も同じ時刻とみなす。
+    """
+
+    def __init__(
+        self,
+        timetable: Timetable,
+        footpaths: Mapping[int, Mapping[int, int]],
+    ) -> None:
+        self.timetable = timetable
+        stop_count = len(timetable.stops.values)
+        self.pattern_stop_offsets = array("i", [0])
+        self.pattern_stops = array("i")
+        self.pattern_trip_offsets = array("i", [0])
+        self.pattern_trips = array("i")
+        self.pattern_starts = array("i")
+        self.pattern_time_offsets = array("i")
+        self.times = array("i")
+        for stops, trips in self._patterns().items():
+            for group in _fifo_groups(sorted(trips)):
+                self.pattern_time_offsets.append(len(self.times))
+                self.pattern_stops.extend(stops)
+                self.pattern_stop_offsets.append(len(self.pattern_stops))
+                for times, trip, start in group:
+                    self.pattern_trips.append(trip)
+                    self.pattern_starts.append(start)
+                    self.times.extend(times)
+                self.pattern_trip_offsets.append(len(self.pattern_trips))
+
+        # 停留所 -> (系統, 系統の中の位置)
+        serving: list[list[tuple[int, int]]] = [[] for _ in range(stop_count)]
+        for pattern in range(len(self.pattern_time_offsets)):
+            begin = self.pattern_stop_offsets[pattern]
+            end = self.pattern_stop_offsets[pattern + 1]
+            for position, stop in enumerate(self.pattern_stops[begin:end]):
+                serving[stop].append((pattern, position))
+        self.stop_pattern_offsets = array("i", [0])
+        self.stop_patterns = array("i")
+        self.stop_positions = array("i")
+        for entries in serving:
+            for pattern, position in entries:
+                self.stop_patterns.append(pattern)
+                self.stop_positions.append(position)
+            self.stop_pattern_offsets.append(len(self.stop_patterns))
+
+        self.footpath_offsets = array("i", [0])
+        self.footpath_stops = array("i")
+        self.footpath_secs = array("i")
+        for stop in range(stop_count):
+            for target, secs in sorted(footpaths.get(stop, {}).items()):
+                self.footpath_stops.append(target)
+                self.footpath_secs.append(secs)
+            self.footpath_offsets.append(len(self.footpath_stops))
+
+        self._active: dict[frozenset[int], bytearray] = {}
+        self._lock = threading.Lock()
+
+    def _patterns(self) -> dict[tuple[int, ...], list[tuple[array, int, int]]]:
+        # 停車する停留所の並び -> (停留所ごとの発車秒, 便, 始発の秒)。
+        # frequencies.txt の便は 1 日分の 1 本 1 本に展開する
+        timetable = self.timetable
+        periods = timetable.frequencies.periods
+        st_stop, st_secs = timetable.st_stop, timetable.st_departure_secs
+        patterns = defaultdict(list)
+        for trip in range(len(timetable.trips.values)):
+            if timetable.trip_routes[trip] < 0:
+                continue
+            rows = timetable.pattern_rows[
+                timetable.trip_offsets[trip] : timetable.trip_offsets[trip + 1]
+            ]
+            if len(rows) < 2 or st_secs[rows[0]] < 0:  # noqa: PLR2004
+                continue
+            # 時刻のない停留所 (timepoint でない) と戻る時刻は直前の時刻で埋める
+            times = array("i")
+            previous = st_secs[rows[0]]
+            for row in rows:
+                previous = max(st_secs[row], previous)
+                times.append(previous)
+            runs = patterns[tuple(st_stop[row] for row in rows)]
+            trip_periods = periods.get(timetable.trips.values[trip])
+            if trip_periods is None:
+                runs.append((times, trip, -1))
+                continue
+            for period in trip_periods:
+                for start in range(
+                    period.start_secs,
+                    period.end_secs,
+                    period.headway_secs,
+                ):
+                    runs.append(
+                        (
+                            array("i", (secs - times[0] + start for secs in times)),
+                            trip,
+                            start,
+                        ),
+                    )
+        return patterns
+
+    def _active_trips(self, services: frozenset[int]) -> bytearray:
+        active = self._active.get(services)
+        if active is None:
+            trip_services = self.timetable.trip_services
+            active = bytearray(
+                trip_services[trip] in services for trip in range(len(trip_services))
+            )
+            with self._lock:
+                if len(self._active) > 16:  # noqa: PLR2004
+                    self._active.clear()
+                self._active[services] = active
+        return active
+
+    def stop_numbers(self, stop_ids: Iterable[str]) -> list[int]:
+        stop_number = self.timetable.stops.get
+        return [
+            stop
+            for stop in map(stop_number, dict.fromkeys(stop_ids))
+            if stop is not None
+        ]
+
+    def plan(
+        self,
+        origins: Iterable[int],
+        destinations: Iterable[int],
+        target_date: datetime.datetime,
+        departure_secs: int,
+        *,
+        realtime: RealtimeIndex | None = None,
+        max_rounds: int = MAX_ROUNDS,
+    ) -> list[Journey]:
+        """
+        origins のどれかを departure_secs 以降に出て destinations のどれかへ着く経路。
+
+        乗る便の数ごとに、それより少ない便では着けない早さで着くものだけを返す
+        (到着時刻と乗り換えの回数のパレート最適)。realtime を渡すと便の遅延を反映する。
+        """
+        destinations = frozenset(destinations)
+        days = [
+            _Days(self._active_trips(self.timetable.active_services(day)), shift)
+            for day, shift in service_days(
+                target_date,
+                departure_secs + MAX_JOURNEY_SECS,
+            )
+        ]
+        delays = _DelayLookup(self.timetable, realtime, target_date)
+
+        best = [_INFINITY] * len(self.timetable.stops.values)
+        labels: list[dict[int, int]] = [{}]
+        parents: list[dict[int, Leg | None]] = [{}]
+        for stop in origins:
+            best[stop] = labels[0][stop] = departure_secs
+            parents[0][stop] = None
+        limit = departure_secs + MAX_JOURNEY_SECS
+        marked = self._walk(list(labels[0]), labels[0], parents[0], best, limit)
+        marked.update(labels[0])
+
+        for _ in range(max_rounds):
+            if not marked:
+                break
+            previous = best.copy()
+            label: dict[int, int] = {}
+            parent: dict[int, Leg | None] = {}
+            limit = min(
+                limit,
+                min((best[stop] for stop in destinations), default=_INFINITY),
+            )
+            reached = []
+            for pattern, position in self._queue(marked).items():
+                limit = self._scan(
+                    pattern,
+                    position,
+                    previous,
+                    best,
+                    label,
+                    parent,
+                    reached,
+                    destinations,
+                    limit,
+                    days,
+                    delays,
+                )
+            marked = set(reached)
+            marked.update(self._walk(reached, label, parent, best, limit))
+            labels.append(label)
+            parents.append(parent)
+
+        return self._journeys(labels, parents, destinations, departure_secs)
+
+    def _queue(self, marked: Iterable[int]) -> dict[int, int]:
+        # 印の付いた停留所を通る系統と、その中でいちばん手前の位置
+        queue: dict[int, int] = {}
+        offsets, patterns, positions = (
+            self.stop_pattern_offsets,
+            self.stop_patterns,
+            self.stop_positions,
+        )
+        for stop in marked:
+            for i in range(offsets[stop], offsets[stop + 1]):
+                pattern = patterns[i]
+                if positions[i] < queue.get(pattern, _INFINITY):
+                    queue[pattern] = positions[i]
+        return queue
+
+    def _scan(
+        self,
+        pattern: int,
+        start: int,
+        previous: list[int],
+        best: list[int],
+        label: dict[int, int],
+        parent: dict[int, Leg | None],
+        reached: list[int],
+        destinations: frozenset[int],
+        limit: int,
+        days: list[_Days],
+        delays: "_DelayLookup",
+    ) -> int:
+        # 系統を start から終点までたどり、乗っている便で着ける停留所の到着を更新する
+        stop_base = self.pattern_stop_offsets[pattern]
+        count = self.pattern_stop_offsets[pattern + 1] - stop_base
+        time_base = self.pattern_time_offsets[pattern]
+        trip_base = self.pattern_trip_offsets[pattern]
+        stops, times, trips = self.pattern_stops, self.times, self.pattern_trips
+        starts = self.pattern_starts
+        boarding: _Boarding | None = None
+        for position in range(start, count):
+            stop = stops[stop_base + position]
+            # 乗っている便がこの停留所に着く時刻。通過 (SKIPPED) なら降りられない
+            arrival = _INFINITY
+            if boarding is not None:
+                delay = boarding.delays[position] if boarding.delays else 0
+                if delay is not None:
+                    arrival = (
+                        times[time_base + boarding.position * count + position]
+                        + boarding.shift
+                        + delay
+                    )
+                    if arrival < best[stop] and arrival < limit:
+                        best[stop] = label[stop] = arrival
+                        parent[stop] = Leg(
+                            boarding.board_stop,
+                            stop,
+                            boarding.departure,
+                            arrival,
+                            trips[trip_base + boarding.position],
+                            starts[trip_base + boarding.position],
+                            boarding.board_position,
+                            position,
+                            boarding.delays[boarding.board_position]
+                            if boarding.delays
+                            else None,
+                        )
+                        reached.append(stop)
+                        if stop in destinations:
+                            limit = arrival
+            # 前のラウンドでここに着いていれば、より早い便に乗り換えられるか調べる
+            ready = previous[stop]
+            if ready < arrival:
+                candidate = self._earliest(pattern, position, ready, days, delays)
+                if candidate is not None and candidate[2] < arrival:
+                    trip_position, shift, departure, trip_delays = candidate
+                    boarding = _Boarding(
+                        trip_position,
+                        shift,
+                        trip_delays,
+                        departure,
+                        position,
+                        stop,
+                    )
+        return limit
+
+    def _earliest(
+        self,
+        pattern: int,
+        position: int,
+        ready: int,
+        days: list[_Days],
+        delays: "_DelayLookup",
+    ) -> tuple[int, int, int, list[int | None] | None] | None:
+        # ready 以降に position から乗れる最初の便: (系統の中の順位, ずれ, 発車秒, 遅延)
+        count = (
+            self.pattern_stop_offsets[pattern + 1] - self.pattern_stop_offsets[pattern]
+        )
+        time_base = self.pattern_time_offsets[pattern]
+        trip_base = self.pattern_trip_offsets[pattern]
+        trip_count = self.pattern_trip_offsets[pattern + 1] - trip_base
+        times, trips = self.times, self.pattern_trips
+        lookback = REALTIME_LOOKBACK_SECS if delays.enabled else 0
+        found = None
+        for active, shift in days:
+            # 発車順に並んでいるので二分探索で最初の候補を探す
+            target = ready - shift - lookback
+            low, high = 0, trip_count
+            while low < high:
+                middle = (low + high) // 2
+                if times[time_base + middle * count + position] < target:
+                    low = middle + 1
+                else:
+                    high = middle
+            for trip_position in range(low, trip_count):
+                trip = trips[trip_base + trip_position]
+                if not active[trip]:
+                    continue
+                scheduled = times[time_base + trip_position * count + position] + shift
+                if found is not None and scheduled >= found[2]:
+                    break
+                trip_delays = delays.get(
+                    trip,
+                    self.pattern_starts[trip_base + trip_position],
+                    shift,
+                )
+                if trip_delays is False:
+                    continue
+                delay = trip_delays[position] if trip_delays else 0
+                if delay is None or scheduled + delay < ready:
+                    continue
+                found = (trip_position, shift, scheduled + delay, trip_delays or None)
+                if not delays.enabled:
+                    break
+        return found
+
+    def _walk(
+        self,
+        stops: Iterable[int],
+        label: dict[int, int],
+        parent: dict[int, Leg | None],
+        best: list[int],
+        limit: int,
+    ) -> set[int]:
+        # 便で着いた停留所 (ラウンド 0 は出発地) から歩いて移れる停留所の到着を更新する。
+        # 歩いて着いた停留所からさらには歩かない
+        walked = set()
+        offsets, targets, secs = (
+            self.footpath_offsets,
+            self.footpath_stops,
+            self.footpath_secs,
+        )
+        for origin in stops:
+            leg = parent.get(origin)
+            if leg is not None and leg.trip < 0:
+                continue
+            arrival = label[origin]
+            for i in range(offsets[origin], offsets[origin + 1]):
+                target = targets[i]
+                walked_arrival = arrival + secs[i]
+                if walked_arrival < best[target] and walked_arrival < limit:
+                    best[target] = label[target] = walked_arrival
+                    parent[target] = Leg(
+                        origin,
+                        target,
+                        arrival,
+                        walked_arrival,
+                        -1,
+                        -1,
+                        -1,
+                        -1,
+                        None,
+                    )
+                    walked.add(target)
+        return walked
+
+    def _journeys(
+        self,
+        labels: list[dict[int, int]],
+        parents: list[dict[int, Leg | None]],
+        destinations: frozenset[int],
+        departure_secs: int,
+    ) -> list[Journey]:
+        # ラウンド (乗った便の数) ごとに、前のラウンドより早く着くものだけを残す
+        journeys = []
+        earliest = _INFINITY
+        for round_index, label in enumerate(labels):
+            arrivals = [(label[stop], stop) for stop in destinations if stop in label]
+            if not arrivals or min(arrivals)[0] >= earliest:
+                continue
+            earliest, stop = min(arrivals)
+            legs = self._legs(parents, round_index, stop)
+            if len(legs) > 1 and legs[0].trip < 0:
+                # 最初に歩く区間は、乗る便にちょうど間に合うように出る
+                walk, first = legs[0], legs[1]
+                legs[0] = walk._replace(
+                    departure_secs=first.departure_secs
+                    - (walk.arrival_secs - walk.departure_secs),
+                    arrival_secs=first.departure_secs,
+                )
+            journeys.append(
+                Journey(
+                    legs[0].departure_secs if legs else departure_secs,
+                    earliest,
+                    tuple(legs),
+                ),
+            )
+        return journeys
+
+    @staticmethod
+    def _legs(
+        parents: list[dict[int, Leg | None]],
+        round_index: int,
+        stop: int,
+    ) -> list[Leg]:
+        # 到着から出発地へ親をたどる。便の区間は、乗った停留所に最後に着いた
+        # 前のラウンドへ戻る。そのラウンドの到着で乗っている
+        legs = []
+        while (leg := parents[round_index].get(stop)) is not None:
+            legs.append(leg)
+            stop = leg.from_stop
+            if leg.trip >= 0:
+                round_index -= 1
+                while stop not in parents[round_index]:
+                    round_index -= 1
+        legs.reverse()
+        return legs
+
+    def describe(self, journey: Journey) -> dict:
+        # API で返す形
+        timetable = self.timetable
+        strings = timetable.strings.values
+        stops = timetable.stops.values
+        legs = []
+        for leg in journey.legs:
+            item = {
+                "type": "walk" if leg.trip < 0 else "trip",
+                "from_stop_id": stops[leg.from_stop],
+                "from_stop_name": strings[timetable.stop_names[leg.from_stop]],
+                "departure_time": secs_to_time(leg.departure_secs),
+                "to_stop_id": stops[leg.to_stop],
+                "to_stop_name": strings[timetable.stop_names[leg.to_stop]],
+                "arrival_time": secs_to_time(leg.arrival_secs),
+            }
+            if leg.trip >= 0:
+                route = timetable.trip_routes[leg.trip]
+                row = timetable.pattern_rows[
+                    timetable.trip_offsets[leg.trip] + leg.board_position
+                ]
+                item.update(
+                    {
+                        "trip_id": _trip_id(timetable, leg.trip, leg.trip_start),
+                        "route_id": timetable.routes.values[route],
+                        "route_short_name": strings[timetable.route_short_names[route]],
+                        "route_long_name": strings[timetable.route_long_names[route]],
+                        "stop_headsign": strings[timetable.st_headsign[row]],
+                        "stops": leg.alight_position - leg.board_position,
+                    },
+                )
+                if leg.delay is not None:
+                    item["delay"] = leg.delay
+            legs.append(item)
+        return {
+            "departure_time": secs_to_time(journey.departure_secs),
+            "arrival_time": secs_to_time(journey.arrival_secs),
+            "duration": journey.arrival_secs - journey.departure_secs,
+            "transfers": journey.transfers,
+            "legs": legs,
+        }
+
+
+def _trip_id(timetable: Timetable, trip: int, start: int) -> str:
+    # frequencies.txt の便は 1 本ごとの trip_id (GTFS-Realtime の便と同じもの)
+    trip_id = timetable.trips.values[trip]
+    if start < 0:
+        return trip_id
+    return frequency_trip_id(trip_id, secs_to_gtfs_time(start)) or trip_id
+
+
+def _fifo_groups(
+    trips: list[tuple[array, int, int]],
+) -> list[list[tuple[array, int, int]]]:
+    # 出発順に並べた便を、どの停留所でも前の便より後に発車する組に分ける
+    groups: list[list[tuple[array, int, int]]] = []
+    for run in trips:
+        for group in groups:
+            last = group[-1][0]
+            if all(a <= b for a, b in zip(last, run[0], strict=True)):
+                group.append(run)
+                break
+        else:
+            groups.append([run])
+    return groups
+
+
+class _DelayLookup:
+    # 1 回の探索の中で、便ごとの停車パターン上の遅延を一度だけ求める
+    def __init__(
+        self,
+        timetable: Timetable,
+        realtime: RealtimeIndex | None,
+        target_date: datetime.datetime,
+    ) -> None:
+        self.timetable = timetable
+        self.trips = realtime.trips if realtime is not None else {}
+        self.enabled = bool(self.trips)
+        self.target_date = target_date
+        self._service_dates: dict[int, str] = {}
+        self._delays: dict[tuple[int, int, int], list[int | None] | bool | None] = {}
+
+    def get(self, trip: int, start: int, shift: int) -> list[int | None] | bool | None:
+        # 遅延のリスト。リアルタイムがなければ None、運休なら False
+        if not self.enabled:
+            return None
+        if (trip, start, shift) in self._delays:
+            return self._delays[trip, start, shift]
+        service_date = self._service_dates.get(shift)
+        if service_date is None:
+            service_date = self._service_dates[shift] = (
+                self.target_date + datetime.timedelta(seconds=shift)
+            ).strftime("%Y%m%d")
+        trip_id = _trip_id(self.timetable, trip, start)
+        # 別の運行日の便の TripUpdate は使わない
+        record = run_record(self.trips, trip_id, service_date)
+        if record is None:
+            delays = None
+        elif record.schedule_relationship == "CANCELED":
+            delays = False
+        else:
+            pattern = self.timetable.patterns([trip_id])[trip_id]
+            delays = position_delays(record, pattern)
+        self._delays[trip, start, shift] = delays
+        return delays
+
+
+class JourneyPlannerCache:
+    """
+    JourneyPlanner を一度だけ作って使い回す。
+
+    最初の問い合わせ時に作り、静的データを入れ替えたら invalidate() を呼ぶ。
+    無効化した世代より古いセッションで作ったものは保持しない。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは invalidate() しなくてよい
+    tables = (*Timetable.tables, "transfers")
+
+    def __init__(self) -> None:
+        self._planner: JourneyPlanner | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        session: Session,
+        timetable: Callable[[], Timetable],
+        stop_index: StopIndex,
+    ) -> JourneyPlanner:
+        planner = self._planner
+        if planner is None:
+            with self._lock:
+                planner = self._planner
+                if planner is None:
+                    loaded = timetable()
+                    planner = JourneyPlanner(
+                        loaded,
+                        load_footpaths(session, loaded, stop_index),
+                    )
+                    if session_generation(session) >= self._generation:
+                        self._planner = planner
+        return planner
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._planner = None
+            self._generation = max(self._generation, generation)
+
+
+journey_planners = JourneyPlannerCache()
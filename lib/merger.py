@@ -1,14 +1,43 @@
 import datetime
 import json
 import os
-from copy import deepcopy
+from collections.abc import Iterable, Iterator, Mapping
+from functools import lru_cache
 
 from dotenv import load_dotenv
-from .dynamic import download_dynamic_files, parse_gtfs_realtime
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from .static import get_bus_schedule_flexible
+from .alerts import Alert
+from .dynamic import (
+    RealtimeIndex,
+    StopTimeEvent,
+    StopTimeUpdate,
+    TripRecord,
+    build_realtime_index,
+    fetch_dynamic_feed,
+    load_feed_message,
+)
+from .feeds import AGENCY_TIMEZONE, base_trip_id, run_record
+from .metrics import REGISTRY, Counter
+from .static import (
+    TripPattern,
+    get_bus_schedule_flexible,
+    secs_to_time,
+    time_to_secs,
+    trip_patterns,
+)
+from .vehicles import VehiclePosition
+
+realtime_trips_matched = REGISTRY.register(
+    Counter(
+        "nowhere_realtime_trips_matched_total",
+        "Trips on served boards that had a realtime TripUpdate.",
+    ),
+)
+
+# 車両がこの状態で次の停留所が掲示板の停留所なら「まもなく到着」とする
+_APPROACHING_STATUSES = frozenset({"INCOMING_AT", "IN_TRANSIT_TO"})
 
 eng = create_engine("sqlite:///nowhere.db")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=eng)
@@ -22,83 +51,367 @@ stops_ids = [
 ]
 
 
-def merge_gtfs_realtime(static_data: dict, dynamic_data: dict) -> dict:
+@lru_cache(maxsize=65536)
+def _format_timestamp(timestamp: int) -> str:
+    # 同じフィードの時刻はリクエストをまたいで何度も整形されるのでキャッシュする
+    return datetime.datetime.fromtimestamp(timestamp, AGENCY_TIMEZONE).strftime(
+        "%H:%M:%S",
+    )
+
+
+def _event_dict(event: StopTimeEvent) -> dict:
+    # MessageToDict と同じキーの辞書にし、time は HH:MM:SS に整形する
+    result = {}
+    if event.delay is not None:
+        result["delay"] = event.delay
+    if event.time is not None:
+        result["time"] = _format_timestamp(event.time)
+    if event.uncertainty is not None:
+        result["uncertainty"] = event.uncertainty
+    return result
+
+
+def _merge_stop(stop: dict, realtime_info: StopTimeUpdate | None) -> dict:
+    if realtime_info is None:
+        return stop
+
+    merged_stop = dict(stop)
+    # departure / arrival 情報を追加
+    if realtime_info.departure is not None:
+        merged_stop["actual_departure"] = _event_dict(realtime_info.departure)
+    if realtime_info.arrival is not None:
+        merged_stop["realtime_arrival"] = _event_dict(realtime_info.arrival)
+
+    # stop_sequence と schedule_relationship を追加
+    if realtime_info.stop_sequence is not None:
+        merged_stop["stop_sequence"] = realtime_info.stop_sequence
+    if realtime_info.schedule_relationship is not None:
+        merged_stop["schedule_relationship"] = realtime_info.schedule_relationship
+    return merged_stop
+
+
+@lru_cache(maxsize=4096)
+def _pattern_positions(
+    pattern: TripPattern,
+) -> tuple[dict[int, int], dict[str, tuple[int, ...]]]:
+    # 停車パターン上の位置を stop_sequence と stop_id から引く表。同じ並びの便で共有する
+    positions_by_sequence = {}
+    positions_by_stop: dict[str, list[int]] = {}
+    for position, (stop_sequence, stop_id) in enumerate(pattern):
+        positions_by_sequence[stop_sequence] = position
+        positions_by_stop.setdefault(stop_id, []).append(position)
+    return positions_by_sequence, {
+        stop_id: tuple(positions) for stop_id, positions in positions_by_stop.items()
+    }
+
+
+def _update_delay(update: StopTimeUpdate) -> int | None:
+    # 後続の停留所へ引き継ぐ遅延。発車の遅延を優先する
+    if update.departure is not None and update.departure.delay is not None:
+        return update.departure.delay
+    if update.arrival is not None and update.arrival.delay is not None:
+        return update.arrival.delay
+    return None
+
+
+def _updates_at(
+    trip_record: TripRecord,
+    pattern: TripPattern,
+) -> dict[int, StopTimeUpdate]:
+    # 更新を停車パターン上の位置に対応付ける (stop_sequence を優先)
+    positions_by_sequence, positions_by_stop = _pattern_positions(pattern)
+    updates_at = {}
+    for update in trip_record.updates:
+        position = positions_by_sequence.get(update.stop_sequence)
+        if position is None and update.stop_id in positions_by_stop:
+            position = positions_by_stop[update.stop_id][0]
+        if position is not None:
+            updates_at[position] = update
+    return updates_at
+
+
+def _carried_delays(
+    trip_record: TripRecord,
+    pattern: TripPattern,
+) -> Iterator[tuple[int, StopTimeUpdate | None, int | None]]:
+    """
+    停車パターンを順にたどり、(位置, その位置の更新, その位置で効いている遅延) を返す。
+
+    遅延は直前の更新のものを引き継ぐ (GTFS-RT の仕様どおり)。最初の更新より前と
+    NO_DATA の後は None。SKIPPED の更新は引き継ぐ遅延を変えない。
+    """
+    updates_at = _updates_at(trip_record, pattern)
+    delay = None
+    for position in range(len(pattern)):
+        update = updates_at.get(position)
+        if update is not None:
+            if update.schedule_relationship == "NO_DATA":
+                delay = None
+            elif update.schedule_relationship != "SKIPPED":
+                update_delay = _update_delay(update)
+                if update_delay is not None:
+                    delay = update_delay
+        yield position, update, delay
+
+
+def position_delays(
+    trip_record: TripRecord,
+    pattern: TripPattern,
+) -> list[int | None]:
+    """
+    停車パターンの位置ごとの遅延秒。経路検索で便の時刻をずらすのに使う。
+
+    遅延のない位置 (最初の更新より前と NO_DATA の後) は 0 (時刻表どおり)、
+    SKIPPED の停留所は None (乗り降りできない)。
+    """
+    return [
+        None
+        if update is not None and update.schedule_relationship == "SKIPPED"
+        else delay or 0
+        for _, update, delay in _carried_delays(trip_record, pattern)
+    ]
+
+
+def _propagated_delays(
+    trip_record: TripRecord,
+    pattern: TripPattern,
+) -> dict[str, int]:
+    """
+    更新のない停留所に、直前の停留所の更新の遅延を引き継ぐ。
+
+    Returns:
+        更新を持たない停留所の stop_id をキーとした遅延秒。
+    """
+    delays = {}
+    for position, update, delay in _carried_delays(trip_record, pattern):
+        if update is None and delay is not None:
+            delays.setdefault(pattern[position][1], delay)
+    return delays
+
+
+def _propagate_stop(stop: dict, delay: int) -> dict:
+    merged_stop = dict(stop)
+    merged_stop["actual_departure"] = {
+        "delay": delay,
+        "time": secs_to_time(time_to_secs(stop["departure_scheduled_time"]) + delay),
+    }
+    merged_stop["delay_propagated"] = True
+    return merged_stop
+
+
+@lru_cache(maxsize=1024)
+def _alert_dict(alert: Alert) -> dict:
+    return alert.as_dict()
+
+
+def vehicle_dict(position: VehiclePosition) -> dict:
+    result = {
+        key: value
+        for key, value in (
+            ("vehicle_id", position.vehicle_id),
+            ("latitude", position.latitude),
+            ("longitude", position.longitude),
+            ("bearing", position.bearing),
+            ("stop_id", position.stop_id),
+        )
+        if value is not None
+    }
+    result["current_status"] = position.current_status
+    if position.timestamp is not None:
+        result["timestamp"] = _format_timestamp(position.timestamp)
+    return result
+
+
+def _vehicle_location(position: VehiclePosition, pattern: TripPattern) -> int | None:
+    # 車両が停車中か向かっている停留所の、停車パターン上の位置
+    positions_by_sequence, positions_by_stop = _pattern_positions(pattern)
+    location = positions_by_sequence.get(position.current_stop_sequence)
+    if location is None and position.stop_id in positions_by_stop:
+        location = positions_by_stop[position.stop_id][0]
+    return location
+
+
+def _merge_trip(
+    trip_data: dict,
+    trip_record: TripRecord,
+    pattern: TripPattern | None,
+) -> dict:
+    # 便の停留所に TripUpdate を結合する。pattern があれば更新のない停留所に遅延を引き継ぐ
+    realtime_stops = trip_record.stops
+    delays = {}
+    # 掲示板の停留所がすべて明示的に更新されていれば伝播は不要
+    if pattern is not None and any(
+        stop.get("stop_id") not in realtime_stops for stop in trip_data["stops"]
+    ):
+        delays = _propagated_delays(trip_record, pattern)
+
+    merged_stops = []
+    for stop in trip_data["stops"]:
+        stop_id = stop.get("stop_id")
+        if stop_id in realtime_stops:
+            merged_stops.append(_merge_stop(stop, realtime_stops[stop_id]))
+        elif stop_id in delays:
+            merged_stops.append(_propagate_stop(stop, delays[stop_id]))
+        else:
+            merged_stops.append(stop)
+    merged_trip = {**trip_data, "stops": merged_stops}
+    # 便全体の運休・臨時などは trip_info に載せる
+    if trip_record.schedule_relationship is not None and "trip_info" in trip_data:
+        merged_trip["trip_info"] = {
+            **trip_data["trip_info"],
+            "schedule_relationship": trip_record.schedule_relationship,
+        }
+    return merged_trip
+
+
+def _run(trip_id: str, trip_data: dict) -> tuple[str, str | None, bool]:
+    # 掲示板の便を run_record() で引く引数: (運行日を付けない trip_id, 運行日,
+    # 運行日のない記録を使うか)。dated_trip_id() がキーの 2 本目以降には使わない
+    trip_info = trip_data.get("trip_info", {})
+    run_id = trip_info.get("trip_id", trip_id)
+    return run_id, trip_info.get("service_date"), run_id == trip_id
+
+
+def _approach(
+    vehicle: VehiclePosition,
+    location: int,
+    positions: Iterable[int],
+) -> dict:
+    # 停車パターン上の positions の停留所に付ける stops_away と approaching
+    # 同じ停留所を 2 度通る系統では、車両より先にあるほうを使う
+    ahead = [position - location for position in positions if position >= location]
+    if not ahead:
+        return {}
+    return {
+        "stops_away": ahead[0],
+        "approaching": (
+            ahead[0] == 0 and vehicle.current_status in _APPROACHING_STATUSES
+        ),
+    }
+
+
+def _enrich_trip(
+    trip_data: dict,
+    trip_id: str,
+    realtime: RealtimeIndex,
+    patterns: Mapping[str, TripPattern] | None,
+) -> dict | None:
+    """
+    便に車両の位置と Alert を付ける。付けるものがなければ None。
+
+    各停留所には、車両が何停留所手前にいるか (stops_away) と、次に着くのがその停留所か
+    (approaching) を付ける。索引を引くだけなので、掲示板の行数に比例する時間で済む。
+    """
+    at = realtime.timestamp
+    route_id = trip_data.get("trip_info", {}).get("route_id")
+    run_id, service_date, undated = _run(trip_id, trip_data)
+    vehicle = run_record(
+        realtime.vehicles.by_trip,
+        run_id,
+        service_date,
+        undated=undated,
+    )
+    # Alert は頻度ベースの便の 1 本ではなく元の便に出る
+    alert_trip_id = base_trip_id(trip_id)
+    trip_alerts = realtime.alerts.for_trip(alert_trip_id, route_id, at)
+    stop_alerts = bool(realtime.alerts.by_stop)
+    if vehicle is None and not trip_alerts and not stop_alerts:
+        return None
+
+    location = None
+    pattern = patterns.get(trip_id) if patterns is not None else None
+    if vehicle is not None and pattern is not None:
+        location = _vehicle_location(vehicle, pattern)
+        positions_by_stop = _pattern_positions(pattern)[1]
+
+    enriched_stops = []
+    enriched = False
+    for stop in trip_data["stops"]:
+        stop_id = stop.get("stop_id")
+        extra = (
+            _approach(vehicle, location, positions_by_stop.get(stop_id, ()))
+            if location is not None
+            else {}
+        )
+        if stop_alerts:
+            alerts = realtime.alerts.for_stop(stop_id, alert_trip_id, route_id, at)
+            if alerts:
+                extra["alerts"] = [_alert_dict(alert) for alert in alerts]
+        if extra:
+            enriched = True
+            enriched_stops.append({**stop, **extra})
+        else:
+            enriched_stops.append(stop)
+
+    if vehicle is None and not trip_alerts and not enriched:
+        return None
+    enriched_trip = {**trip_data, "stops": enriched_stops}
+    if vehicle is not None:
+        enriched_trip["vehicle"] = vehicle_dict(vehicle)
+    if trip_alerts:
+        enriched_trip["alerts"] = [_alert_dict(alert) for alert in trip_alerts]
+    return enriched_trip
+
+
+def merge_gtfs_realtime(
+    static_data: dict,
+    realtime: RealtimeIndex,
+    patterns: Mapping[str, TripPattern] | None = None,
+) -> dict:
     """
     静的な GTFS データにリアルタイムの TripUpdate 情報を結合する関数。
 
+    static_data 自体は変更せず、リアルタイム情報のある便と停留所だけ新しい辞書を作る。
+    それ以外の便は static_data と同じオブジェクトを共有する。
+    patterns を渡すと、更新のない停留所にも直前の更新の遅延を引き継ぎ、
+    delay_propagated を付ける。realtime に VehiclePosition や Alert があれば、
+    便に vehicle と alerts を、停留所に stops_away・approaching・alerts を付ける。
+
     Args:
         static_data: 静的時刻表情報を含む辞書。キーは trip_id。
-        dynamic_data: GTFS-Realtime の TripUpdate を含む辞書。
+        realtime: build_realtime_index() で作った TripUpdate・車両・Alert の索引。
+        patterns: trip_id ごとの (stop_sequence, stop_id) の並び。TripPatternCache.get() の結果。
 
     Returns:
         リアルタイム情報が統合された新しい辞書。
     """
 
-    # static データを変更しないようにディープコピーを作成
-    merged_data = deepcopy(static_data)
-
-    # dynamic_data から entity リストを取得
-    if "entity" not in dynamic_data:
-        # entity がない場合は静的データをそのまま返す
-        return merged_data
-
-    static_keys = list(static_data.keys())
-
-    for i in dynamic_data["entity"]:
-        reading_static_key = i["trip_update"]["trip"]["trip_id"]
-        if reading_static_key in static_keys:
-            # 該当する静的データのtrip情報を取得
-            trip_data = merged_data[reading_static_key]
-
-            # stop_time_update を取得
-            stop_time_updates = i["trip_update"].get("stop_time_update", [])
-
-            # stop_time_update を stop_id でインデックス化
-            realtime_stops = {}
-            for stop_update in stop_time_updates:
-                stop_id = stop_update.get("stop_id")
-                if stop_id:
-                    realtime_stops[stop_id] = stop_update
-
-            # 静的データの stops に対してリアルタイム情報を差し込む
-            for stop in trip_data.get("stops", []):
-                stop_id = stop.get("stop_id")
-                if stop_id in realtime_stops:
-                    realtime_info = realtime_stops[stop_id]
-
-                    # departure 情報を追加
-                    if "departure" in realtime_info:
-                        stop["actual_departure"] = realtime_info["departure"]
-                        if "time" in realtime_info["departure"]:
-                            stop["actual_departure"]["time"] = (
-                                datetime.datetime.strftime(
-                                    datetime.datetime.fromtimestamp(
-                                        int(realtime_info["departure"]["time"]),
-                                    ),
-                                    "%H:%M:%S",
-                                )
-                            )
-
-                    # arrival 情報を追加
-                    if "arrival" in realtime_info:
-                        stop["realtime_arrival"] = realtime_info["arrival"]
-                        if "time" in realtime_info["arrival"]:
-                            stop["realtime_arrival"]["time"] = (
-                                datetime.datetime.strftime(
-                                    datetime.datetime.fromtimestamp(
-                                        int(realtime_info["arrival"]["time"]),
-                                    ),
-                                    "%H:%M:%S",
-                                )
-                            )
-
-                    # stop_sequence と schedule_relationship を追加
-                    if "stop_sequence" in realtime_info:
-                        stop["stop_sequence"] = realtime_info["stop_sequence"]
-                    if "schedule_relationship" in realtime_info:
-                        stop["schedule_relationship"] = realtime_info[
-                            "schedule_relationship"
-                        ]
+    merged_data = dict(static_data)
+    realtime_trips = realtime.trips
+
+    # 件数の少ない方を走査して、両方にある trip_id だけを処理する
+    if len(realtime_trips) < len(static_data):
+        trip_ids = [trip_id for trip_id in realtime_trips if trip_id in static_data]
+    else:
+        trip_ids = [trip_id for trip_id in static_data if trip_id in realtime_trips]
+
+    matched = 0
+    for trip_id in trip_ids:
+        trip_data = static_data[trip_id]
+        if "stops" not in trip_data:
+            continue
+        # 別の運行日の便の TripUpdate は付けない
+        run_id, service_date, undated = _run(trip_id, trip_data)
+        trip_record = run_record(
+            realtime_trips,
+            run_id,
+            service_date,
+            undated=undated,
+        )
+        if trip_record is None:
+            continue
+        matched += 1
+        pattern = patterns.get(trip_id) if patterns is not None else None
+        merged_data[trip_id] = _merge_trip(trip_data, trip_record, pattern)
+    realtime_trips_matched.inc(matched)
+
+    if realtime.vehicles or realtime.alerts:
+        for trip_id, trip_data in merged_data.items():
+            if "stops" not in trip_data:
+                continue
+            enriched_trip = _enrich_trip(trip_data, trip_id, realtime, patterns)
+            if enriched_trip is not None:
+                merged_data[trip_id] = enriched_trip
 
     return merged_data
 
@@ -106,10 +419,7 @@ def merge_gtfs_realtime(static_data: dict, dynamic_data: dict) -> dict:
 if __name__ == "__main__":
     load_dotenv()
     GTFS_DYNAMIC_URL = os.getenv("GTFS_DYNAMIC_URL")
-    download_dynamic_files(
-        GTFS_DYNAMIC_URL,
-        "trip_updates.bin",
-    )
+    content, _, _ = fetch_dynamic_feed(GTFS_DYNAMIC_URL)
     with SessionLocal() as session:
         st = get_bus_schedule_flexible(
             session,
@@ -118,6 +428,10 @@ if __name__ == "__main__":
             start_time="22:00:00",
             stop_time="23:00:00",
         )
-        re = parse_gtfs_realtime("trip_updates.bin")
-        merged = merge_gtfs_realtime(st, re)
+        feed = load_feed_message(content)
+        merged = merge_gtfs_realtime(
+            st,
+            build_realtime_index(feed),
+            trip_patterns.get(session, st),
+        )
         print(json.dumps(merged, ensure_ascii=False, indent=4))
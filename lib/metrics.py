@@ -0,0 +1,240 @@
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 秒。掲示板の組み立ては数 ms、フィードの取得は数百 ms 程度を想定
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+type Labels = tuple[str, ...]
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{value.replace("\\", "\\\\").replace('"', '\\"')}"'
+        for name, value in zip(names, values, strict=True)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+        function: Callable[[], dict[Labels, float]] | None = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        # 値を持たず、書き出すたびに呼んで値を集める場合
+        self.function = function
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterator[tuple[str, Labels, str, float]]:
+        values = self.function() if self.function is not None else dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, "", value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(
+            f"{name}{_format_labels(self.labelnames, labels, extra)} "
+            f"{_format_value(value)}"
+            for name, labels, extra, value in self.samples()
+        )
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    バケットごとの件数と合計を持つヒストグラム。
+
+    observe() は bisect でバケットを探して数を 1 つ増やすだけなので、常時有効にしておける。
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # ラベル -> [バケットごとの件数 (最後は +Inf), 合計]
+        self._series: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def samples(self) -> Iterator[tuple[str, Labels, str, float]]:
+        with self._lock:
+            series = {
+                labels: (list(counts), total[0])
+                for labels, (counts, total) in self._series.items()
+            }
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts, strict=True):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket", labels, le, cumulative
+            yield f"{self.name}_sum", labels, "", total
+            yield f"{self.name}_count", labels, "", cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register[M: _Metric](self, metric: M) -> M:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        # Prometheus のテキスト形式 (text/plain; version=0.0.4)
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(
+    Histogram(
+        "nowhere_stage_seconds",
+        "Time spent in each stage of the realtime and board pipelines.",
+        ("stage",),
+    ),
+)
+request_seconds = REGISTRY.register(
+    Histogram(
+        "nowhere_request_seconds",
+        "HTTP request latency by route and status.",
+        ("route", "status"),
+    ),
+)
+
+# リクエストごとの区間の記録先。トレースが有効なリクエストの間だけリストが入る
+_spans: ContextVar[list[tuple[str, float]] | None] = ContextVar(
+    "nowhere_spans",
+    default=None,
+)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    # 区間の時間を stage_seconds に記録し、トレース中のリクエストなら区間としても残す
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, (stage,))
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+class MetricsMiddleware:
+    """
+    HTTP リクエストの処理時間をルートごとに記録する ASGI ミドルウェア。
+
+    trace を有効にすると、リクエスト中に timed() で測った区間を
+    Server-Timing ヘッダで返す (ブラウザの開発者ツールで見られる)。
+    """
+
+    def __init__(self, app: Callable, trace: bool = False) -> None:  # noqa: FBT001, FBT002
+        self.app = app
+        self.trace = trace
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [0]
+        spans: list[tuple[str, float]] | None = [] if self.trace else None
+        token = _spans.set(spans)
+
+        async def send_with_timing(message: dict) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if spans:
+                    timing = ", ".join(
+                        f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in spans
+                    )
+                    headers = [
+                        *message.get("headers", ()),
+                        (b"server-timing", timing.encode()),
+                    ]
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _spans.reset(token)
+            route = scope.get("route")
+            request_seconds.observe(
+                time.perf_counter() - started,
+                (getattr(route, "path", "unmatched"), str(status[0])),
+            )
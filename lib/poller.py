@@ -0,0 +1,349 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from collections.abc import Iterable
+from dataclasses import dataclass, field, replace
+from itertools import chain
+
+import requests
+from google.transit import gtfs_realtime_pb2
+from requests.adapters import HTTPAdapter
+
+from .alerts import AlertIndex
+from .archive import SnapshotArchive
+from .dynamic import (
+    RealtimeDelta,
+    RealtimeIndex,
+    fetch_dynamic_feed,
+    load_feed_message,
+    update_realtime_index,
+)
+from .feeds import Feed
+from .metrics import REGISTRY, Counter, timed
+from .vehicles import VehicleIndex
+
+DEFAULT_INTERVAL = 15.0
+# changes_since() で遡れる版の数
+HISTORY_SIZE = 64
+# 同時に取得するフィードの数 (と HTTP の接続プールの大きさ)
+DEFAULT_CONCURRENCY = 4
+
+feed_fetches = REGISTRY.register(
+    Counter(
+        "nowhere_feed_fetches_total",
+        "Realtime feed polls by feed, source and outcome "
+        "(updated, unchanged, not_modified, timeout, error).",
+        ("feed", "source", "result"),
+    ),
+)
+
+
+@dataclass(frozen=True)
+class RealtimeSnapshot:
+    """
+    ポーラーが公開する GTFS-Realtime のスナップショット。
+
+    リクエスト間で共有されるため、受け取った側は realtime を変更しないこと。
+    複数のフィードがある場合、realtime はすべてのフィードの便・車両・Alert を
+    合わせたもので、feed_timestamp は最も古いフィードのもの。
+    """
+
+    version: int = 0
+    feed_timestamp: int = 0
+    fetched_at: float = 0.0
+    realtime: RealtimeIndex = field(default_factory=lambda: RealtimeIndex(0, {}))
+    # 直前の版から追加・変更・削除された trip_id
+    changed: frozenset[str] = frozenset()
+
+
+@dataclass
+class _FeedState:
+    # フィードの TripUpdates・VehiclePositions・Alerts の URL ごとに 1 つ
+    feed: Feed
+    source: str
+    url: str
+    etag: str | None = None
+    last_modified: str | None = None
+    feed_timestamp: int = 0
+    fetched_at: float = 0.0
+    index: RealtimeIndex = field(default_factory=lambda: RealtimeIndex(0, {}))
+    fingerprints: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class _PollResult:
+    etag: str | None
+    last_modified: str | None
+    feed_timestamp: int | None = None  # None なら本文なし・古いフィードで何もしない
+    delta: RealtimeDelta | None = None
+
+
+def changes_between(
+    history: list[tuple[int, frozenset[str] | None]],
+    current: int,
+    version: int,
+) -> frozenset[str] | None:
+    # version から current までの履歴で変わった trip_id。わからなければ None
+    if version == current:
+        return frozenset()
+    if version > current or not history or history[0][0] > version + 1:
+        return None
+    changed: set[str] = set()
+    for history_version, trip_ids in history:
+        if history_version > version:
+            if trip_ids is None:
+                return None
+            changed.update(trip_ids)
+    return frozenset(changed)
+
+
+class RealtimePoller:
+    """
+    GTFS-Realtime フィードを一定間隔で取得し、最新のスナップショットを保持する。
+
+    取得と解析はポーリングごとに一度だけ行い、各リクエストは snapshot を読むだけにする。
+    ヘッダのタイムスタンプが進んでいなければ何もせず、進んでいても変わった便だけを
+    作り直す。中身が変わらなければ版は上げない。取得したものはファイルに書かずに
+    メモリ上で解析する。archive を渡すと、新しい内容だけをそこへ追記する。
+
+    フィード (とその VehiclePositions・Alerts の URL) が複数あれば、それぞれを
+    独立したタスクで並行して取得する。同時に取得する数は
+    max_concurrency までに抑え、各フィードの接続と読み込みは Feed.timeout 秒で打ち切るので、
+    遅い事業者がほかのフィードの更新を待たせることはない。どれかのフィードが更新されるたびに
+    全フィードを合わせたスナップショットを公開する。
+    """
+
+    def __init__(
+        self,
+        feeds: str | Iterable[Feed] | None,
+        interval: float = DEFAULT_INTERVAL,
+        max_concurrency: int = DEFAULT_CONCURRENCY,
+        archive: SnapshotArchive | None = None,
+    ) -> None:
+        if feeds is None or isinstance(feeds, str):
+            feeds = [Feed("", realtime_url=feeds)]
+        self.interval = interval
+        self._feeds = [
+            _FeedState(feed, source, url)
+            for feed in feeds
+            for source, url in feed.realtime_sources()
+        ]
+        self._snapshot = RealtimeSnapshot()
+        # (版, その版で変わった trip_id) の直近の履歴。None は便を絞れない変更 (Alert)
+        self._history: deque[tuple[int, frozenset[str] | None]] = deque(
+            maxlen=HISTORY_SIZE,
+        )
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_concurrency,
+            pool_maxsize=max_concurrency,
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+        self._max_concurrency = max_concurrency
+        self._archive = archive
+        self._tasks: list[asyncio.Task] = []
+        self._updated = asyncio.Event()
+
+    @property
+    def snapshot(self) -> RealtimeSnapshot:
+        return self._snapshot
+
+    def feed_timestamps(self) -> dict[tuple[str, str], tuple[int, float]]:
+        # (feed_id, 種類) -> (ヘッダのタイムスタンプ, 取得した時刻)
+        return {
+            (state.feed.feed_id, state.source): (state.feed_timestamp, state.fetched_at)
+            for state in self._feeds
+        }
+
+    def changes_since(self, version: int) -> frozenset[str] | None:
+        """
+        version より後の版で変わった trip_id をまとめて返す。
+        履歴が足りずわからなければ None。
+        """
+        return changes_between(self.history(), self._snapshot.version, version)
+
+    def history(self) -> list[tuple[int, frozenset[str] | None]]:
+        return list(self._history)
+
+    def resume(self, snapshot: RealtimeSnapshot) -> None:
+        # 別のプロセスが公開していた版の続きから版を振る。履歴は引き継がない
+        if snapshot.version > self._snapshot.version:
+            self._snapshot = snapshot
+            self._history.clear()
+
+    def _poll_feed(self, state: _FeedState) -> _PollResult:
+        # 取得から差分の索引づくりまで。state は読むだけで、反映は _apply() で行う
+        feed = state.feed
+        with timed("fetch"):
+            content, etag, last_modified = fetch_dynamic_feed(
+                state.url,
+                etag=state.etag,
+                last_modified=state.last_modified,
+                http=self._http,
+                timeout=feed.timeout,
+            )
+        if content is None:
+            feed_fetches.inc(labels=(feed.feed_id, state.source, "not_modified"))
+            return _PollResult(etag, last_modified)
+
+        with timed("parse"):
+            message = load_feed_message(content)
+        feed_timestamp = message.header.timestamp
+        # ヘッダのタイムスタンプが進んでいなければ解析済みのものを使い続ける
+        if feed_timestamp and feed_timestamp <= state.feed_timestamp:
+            feed_fetches.inc(labels=(feed.feed_id, state.source, "unchanged"))
+            return _PollResult(etag, last_modified)
+        if self._archive is not None:
+            self._archive_content(state, content, message)
+
+        with timed("index"):
+            delta = update_realtime_index(
+                message,
+                state.index,
+                state.fingerprints,
+                namespace=feed.feed_id,
+            )
+        return _PollResult(etag, last_modified, feed_timestamp, delta)
+
+    def _archive_content(
+        self,
+        state: _FeedState,
+        content: bytes,
+        message: gtfs_realtime_pb2.FeedMessage,
+    ) -> None:
+        # 保存に失敗してもリアルタイムの更新は止めない
+        try:
+            with timed("archive"):
+                self._archive.append(
+                    f"{state.feed.feed_id}/{state.source}",
+                    time.time(),
+                    content,
+                    message,
+                )
+        except (OSError, ValueError) as e:
+            print(f"Error archiving realtime feed {state.feed.feed_id!r}: {e}")  # noqa: T201
+
+    def _apply(self, state: _FeedState, result: _PollResult) -> bool:
+        # 新しいスナップショットを公開した場合のみ True
+        state.etag, state.last_modified = result.etag, result.last_modified
+        if result.delta is None:
+            return False
+        state.feed_timestamp = result.feed_timestamp
+        state.fetched_at = time.time()
+        state.index = result.delta.index
+        state.fingerprints = result.delta.fingerprints
+        current = self._snapshot
+        feed_timestamp = min(
+            (
+                feed_state.feed_timestamp
+                for feed_state in self._feeds
+                if feed_state.feed_timestamp
+            ),
+            default=0,
+        )
+
+        delta = result.delta
+        if not delta.changed and not delta.alerts_changed and current.version:
+            # 中身が同じなら鮮度だけ更新し、版を上げずに各キャッシュをそのまま使わせる
+            self._snapshot = replace(
+                current,
+                feed_timestamp=feed_timestamp,
+                fetched_at=state.fetched_at,
+            )
+            feed_fetches.inc(labels=(state.feed.feed_id, state.source, "unchanged"))
+            return False
+
+        version = current.version + 1
+        self._history.append(
+            (version, None if delta.alerts_changed else delta.changed),
+        )
+        self._snapshot = RealtimeSnapshot(
+            version=version,
+            feed_timestamp=feed_timestamp,
+            fetched_at=state.fetched_at,
+            realtime=self._combined(state, feed_timestamp),
+            changed=delta.changed,
+        )
+        feed_fetches.inc(labels=(state.feed.feed_id, state.source, "updated"))
+        return True
+
+    def _combined(self, state: _FeedState, feed_timestamp: int) -> RealtimeIndex:
+        # すべての取得先の索引を 1 つにまとめる。リクエストはこれを引くだけにする
+        if len(self._feeds) == 1:
+            return state.index
+        trips = {}
+        for feed_state in self._feeds:
+            trips.update(feed_state.index.trips)
+        indexes = [feed_state.index for feed_state in self._feeds]
+        return RealtimeIndex(
+            feed_timestamp,
+            trips,
+            VehicleIndex(
+                chain.from_iterable(index.vehicles.positions for index in indexes),
+            ),
+            AlertIndex(chain.from_iterable(index.alerts.alerts for index in indexes)),
+        )
+
+    def poll_once(self) -> bool:
+        # すべてのフィードを順に 1 回ずつ取得する。どれかで公開すれば True
+        published = False
+        for state in self._feeds:
+            published = self._apply(state, self._poll_feed(state)) or published
+        return published
+
+    async def _run_feed(self, state: _FeedState, limit: asyncio.Semaphore) -> None:
+        while True:
+            try:
+                # 打ち切りは fetch_dynamic_feed() に渡す requests の timeout に任せる。
+                # asyncio 側で待つのをやめてもスレッドは取得 (と archive への追記) を続け、
+                # 接続プールを使ったままになるので、終わるまで枠を持ったまま待つ
+                async with limit:
+                    result = await asyncio.to_thread(self._poll_feed, state)
+                if self._apply(state, result):
+                    # 待っている側を起こし、次の更新用に作り直す
+                    self._updated.set()
+                    self._updated = asyncio.Event()
+            except requests.Timeout:
+                feed_fetches.inc(labels=(state.feed.feed_id, state.source, "timeout"))
+                print(  # noqa: T201
+                    f"Timed out polling {state.source} of realtime feed "
+                    f"{state.feed.feed_id!r}",
+                )
+            except Exception as e:  # noqa: BLE001
+                feed_fetches.inc(labels=(state.feed.feed_id, state.source, "error"))
+                print(  # noqa: T201
+                    f"Error polling {state.source} of realtime feed "
+                    f"{state.feed.feed_id!r}: {e}",
+                )
+            await asyncio.sleep(self.interval)
+
+    async def wait_for_update(self, max_wait: float) -> None:
+        # 新しいスナップショットが公開されるか max_wait 秒経つまで待つ
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(self._updated.wait(), max_wait)
+
+    def start(self) -> None:
+        if not self._feeds:
+            print("No realtime feed URL is set; realtime polling is disabled")  # noqa: T201
+            return
+        if not self._tasks:
+            limit = asyncio.Semaphore(self._max_concurrency)
+            self._tasks = [
+                asyncio.create_task(self._run_feed(state, limit))
+                for state in self._feeds
+            ]
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        self._http.close()
+        if self._archive is not None:
+            self._archive.close()
@@ -0,0 +1,163 @@
+import datetime
+import threading
+from collections.abc import Iterable
+
+from sqlalchemy.orm import Session
+
+from .static_models import Calendar, CalendarDates
+from .store import session_generation
+
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+
+def _parse_date(value: str) -> datetime.date:
+    return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+class ServiceCalendar:
+    """
+    サービスと日付の組ごとの運行表を、フィードの有効期間についてあらかじめ展開したもの。
+
+    サービスごとに「first_date から d 日目に運行するなら d ビット目が立つ」整数を持つ。
+    曜日のパターンと有効期間はビット演算でまとめて作り、calendar_dates の例外はビットを
+    個別に立てる・落とすことで反映する。日付ごとの運行サービスの集合は、問い合わせの
+    あった日の分だけ作って覚えておく。期間外の日付はどのサービスも運行しない。
+    """
+
+    def __init__(
+        self,
+        first_date: datetime.date,
+        bits: dict[str, int],
+        days: int,
+    ) -> None:
+        self.first_date = first_date
+        self.bits = bits
+        self.days = days
+        # 日の添字 -> その日の運行サービス。同時に作っても同じものになるのでロックしない
+        self._active: dict[int, frozenset[str]] = {}
+
+    @classmethod
+    def build(
+        cls,
+        calendar: Iterable[tuple],
+        calendar_dates: Iterable[tuple],
+    ) -> "ServiceCalendar":
+        """
+        calendar は (service_id, monday, ..., sunday, start_date, end_date)、
+        calendar_dates は (service_id, date, exception_type) の行。
+        """
+        calendar = [row for row in calendar if row[8] and row[9]]
+        calendar_dates = [row for row in calendar_dates if row[1]]
+        dates = [_parse_date(row[8]) for row in calendar]
+        dates += [_parse_date(row[9]) for row in calendar]
+        dates += [_parse_date(row[1]) for row in calendar_dates]
+        if not dates:
+            return cls(datetime.date.min, {}, 0)
+        first_date = min(dates)
+        days = (max(dates) - first_date).days + 1
+
+        # 曜日ごとに、その曜日にあたる日のビットだけが立った整数
+        weekday_masks = [0] * 7
+        for weekday in range(7):
+            offset = (weekday - first_date.weekday()) % 7
+            weekday_masks[weekday] = sum(1 << day for day in range(offset, days, 7))
+
+        bits: dict[str, int] = {}
+        for service_id, *flags, start_date, end_date in calendar:
+            pattern = 0
+            for weekday, flag in enumerate(flags):
+                if flag == "1":
+                    pattern |= weekday_masks[weekday]
+            start = (_parse_date(start_date) - first_date).days
+            end = (_parse_date(end_date) - first_date).days
+            valid = ((1 << (end + 1)) - 1) ^ ((1 << start) - 1)
+            bits[service_id] = bits.get(service_id, 0) | (pattern & valid)
+
+        for service_id, date, exception_type in calendar_dates:
+            day = 1 << (_parse_date(date) - first_date).days
+            if exception_type == "1":
+                bits[service_id] = bits.get(service_id, 0) | day
+            elif exception_type == "2":
+                bits[service_id] = bits.get(service_id, 0) & ~day
+
+        return cls(first_date, bits, days)
+
+    @classmethod
+    def load(cls, session: Session) -> "ServiceCalendar":
+        calendar = session.query(
+            Calendar.service_id,
+            *(getattr(Calendar, weekday) for weekday in WEEKDAYS),
+            Calendar.start_date,
+            Calendar.end_date,
+        )
+        calendar_dates = session.query(
+            CalendarDates.service_id,
+            CalendarDates.date,
+            CalendarDates.exception_type,
+        )
+        return cls.build(calendar, calendar_dates)
+
+    def day_index(self, target_date: datetime.date) -> int:
+        # first_date から何日目か。期間外なら負の数か days 以上になる
+        if isinstance(target_date, datetime.datetime):
+            target_date = target_date.date()
+        return (target_date - self.first_date).days
+
+    def active(self, target_date: datetime.date) -> frozenset[str]:
+        """target_date に運行するサービスID。"""
+        day = self.day_index(target_date)
+        if not 0 <= day < self.days:
+            return frozenset()
+        services = self._active.get(day)
+        if services is None:
+            services = frozenset(
+                service_id
+                for service_id, service_bits in self.bits.items()
+                if service_bits >> day & 1
+            )
+            self._active[day] = services
+        return services
+
+
+class ServiceCalendarCache:
+    """
+    静的データから ServiceCalendar を一度だけ作って使い回す。
+
+    最初の問い合わせ時に作り、静的データを入れ替えたら invalidate() を呼ぶ。
+    無効化した世代より古いセッションで作ったものは保持しない。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは invalidate() しなくてよい
+    tables = ("calendar", "calendar_dates")
+
+    def __init__(self) -> None:
+        self._calendar: ServiceCalendar | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, session: Session) -> ServiceCalendar:
+        calendar = self._calendar
+        if calendar is None:
+            with self._lock:
+                calendar = self._calendar
+                if calendar is None:
+                    calendar = ServiceCalendar.load(session)
+                    if session_generation(session) >= self._generation:
+                        self._calendar = calendar
+        return calendar
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._calendar = None
+            self._generation = max(self._generation, generation)
+
+
+service_calendars = ServiceCalendarCache()
@@ -0,0 +1,313 @@
+import asyncio
+import contextlib
+import fcntl
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from collections.abc import Callable, Hashable, Iterator, Mapping
+from pathlib import Path
+from typing import IO
+
+from .boards import CachedResponse
+from .dynamic import RealtimeIndex, TripRecord
+from .metrics import timed
+from .poller import RealtimePoller, RealtimeSnapshot, changes_between
+
+# スナップショットのファイルの先頭と、続く目次 (pickle) の位置と長さ
+MAGIC = b"NWRS\x01"
+_TABLE = struct.Struct(">QQ")
+# 読む側がファイルの置き換えを確かめる秒数
+CHECK_INTERVAL = 0.5
+# 書き手が掲示板を組み立て直す間隔の上限 (秒)。分が変われば新しい分の掲示板を作る
+PREBUILD_INTERVAL = 5.0
+
+type Prebuild = Callable[[], Mapping[Hashable, CachedResponse]]
+
+
+class _SharedTrips(Mapping[str, TripRecord]):
+    """
+    スナップショットのファイル上の TripRecord を trip_id で引く読み取り専用の辞書。
+
+    目次 (trip_id -> 位置) だけを持ち、引かれた便だけをその場で復元する。
+    """
+
+    def __init__(self, view: memoryview, table: dict[str, tuple[int, int]]) -> None:
+        self._view = view
+        self._table = table
+        self._decoded: dict[str, TripRecord] = {}
+
+    def __getitem__(self, trip_id: str) -> TripRecord:
+        record = self._decoded.get(trip_id)
+        if record is None:
+            offset, length = self._table[trip_id]
+            record = self._decoded[trip_id] = pickle.loads(  # noqa: S301
+                self._view[offset : offset + length],
+            )
+        return record
+
+    def __contains__(self, trip_id: object) -> bool:
+        return trip_id in self._table
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+
+class _Published:
+    # 読む側が開いたスナップショット 1 版分
+    def __init__(self, path: Path) -> None:
+        with path.open("rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        if view[: len(MAGIC)] != MAGIC:
+            msg = f"{path} is not a realtime snapshot"
+            raise ValueError(msg)
+        offset, length = _TABLE.unpack_from(view, len(MAGIC))
+        meta = pickle.loads(view[offset : offset + length])  # noqa: S301
+        self.history: list[tuple[int, frozenset[str] | None]] = meta["history"]
+        self.feed_timestamps: dict = meta["feed_timestamps"]
+        self.responses: dict[Hashable, tuple[str, int, int]] = meta["responses"]
+        self.view = view
+        self.snapshot = RealtimeSnapshot(
+            version=meta["version"],
+            feed_timestamp=meta["feed_timestamp"],
+            fetched_at=meta["fetched_at"],
+            realtime=RealtimeIndex(
+                meta["feed_timestamp"],
+                _SharedTrips(view, meta["trips"]),
+                meta["vehicles"],
+                meta["alerts"],
+            ),
+            changed=meta["changed"],
+        )
+
+
+class SharedRealtime:
+    """
+    同じホストの複数のワーカープロセスで 1 つのリアルタイムのポーラーを共有する。
+
+    ロックファイルを取れたプロセス (書き手) だけが poller でフィードを取得し、
+    スナップショットと、prebuild で組み立てた掲示板のレスポンスを path に書き出す。
+    ほかのプロセス (読み手) は path を読み取り専用で mmap し、版が変わったら開き直す。
+    便の TripRecord は掲示板に載ったものだけを復元するので、ワーカーを増やしても
+    プロセスごとのメモリはほとんど増えず、フィードの取得は常にホストで 1 つになる。
+    書き手が止まると、ロックが外れるので読み手のどれかが引き継ぐ。
+
+    snapshot・changes_since()・wait_for_update()・feed_timestamps() は
+    RealtimePoller と同じように使える (読み手の wait_for_update() は start() の後だけ)。
+    """
+
+    def __init__(self, poller: RealtimePoller, path: str | Path) -> None:
+        self.poller = poller
+        self.path = Path(path)
+        self._lock_file: IO | None = None
+        self._published: _Published | None = None
+        self._stamp: tuple[int, int] | None = None
+        self._checked = 0.0
+        self._refresh_lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self._prebuild: Prebuild | None = None
+        # 読み手で、_run() が新しい版を見つけるたびに set して作り直す
+        self._updated = asyncio.Event()
+        # 書き手の、直前に書いた TripRecord とその pickle
+        self._encoded: dict[str, tuple[TripRecord, bytes]] = {}
+
+    @property
+    def is_writer(self) -> bool:
+        return self._lock_file is not None
+
+    @property
+    def snapshot(self) -> RealtimeSnapshot:
+        if self.is_writer:
+            return self.poller.snapshot
+        published = self._refresh()
+        return published.snapshot if published is not None else RealtimeSnapshot()
+
+    def changes_since(self, version: int) -> frozenset[str] | None:
+        if self.is_writer:
+            return self.poller.changes_since(version)
+        published = self._refresh()
+        if published is None:
+            return None
+        return changes_between(published.history, published.snapshot.version, version)
+
+    def feed_timestamps(self) -> dict:
+        if self.is_writer:
+            return self.poller.feed_timestamps()
+        published = self._refresh()
+        return published.feed_timestamps if published is not None else {}
+
+    def response(self, key: Hashable) -> CachedResponse | None:
+        # 書き手が組み立てておいた掲示板。読み手で、いまの版のものがあるときだけ返す
+        if self.is_writer:
+            return None
+        published = self._refresh()
+        if published is None or key not in published.responses:
+            return None
+        etag, offset, length = published.responses[key]
+        return CachedResponse(
+            etag,
+            bytes(published.view[offset : offset + length]),
+            published.snapshot.version,
+            {},
+            {},
+            {},
+        )
+
+    async def wait_for_update(self, max_wait: float) -> None:
+        if self.is_writer:
+            await self.poller.wait_for_update(max_wait)
+            return
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(self._updated.wait(), max_wait)
+
+    def _refresh(self) -> _Published | None:
+        # ファイルが置き換わっていれば開き直す。stat は CHECK_INTERVAL に 1 回まで
+        now = time.monotonic()
+        if now - self._checked < CHECK_INTERVAL:
+            return self._published
+        with self._refresh_lock:
+            self._checked = now
+            try:
+                stat = self.path.stat()
+            except FileNotFoundError:
+                return self._published
+            stamp = (stat.st_ino, stat.st_mtime_ns)
+            if stamp != self._stamp:
+                # 古い版の mmap は、それを参照しているリクエストが終われば解放される
+                with timed("shared_open"):
+                    self._published = _Published(self.path)
+                self._stamp = stamp
+        return self._published
+
+    def _try_lock(self) -> bool:
+        lock_file = Path(f"{self.path}.lock").open("w")  # noqa: SIM115
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def start(self, prebuild: Prebuild | None = None) -> None:
+        self._prebuild = prebuild
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        # 読み手はロックが空くのを待ち、取れたら書き手になる。待つ間はファイルの版を見て
+        # wait_for_update() で待っている側を起こす。別のプロセスが置き換えるファイルと
+        # flock には待てるものがないので、ここ 1 か所で CHECK_INTERVAL ごとに確かめる
+        version = self.snapshot.version
+        locked_at = -self.poller.interval
+        while True:
+            now = time.monotonic()
+            if now - locked_at >= self.poller.interval:
+                if self._try_lock():
+                    break
+                locked_at = now
+            if self.snapshot.version != version:
+                version = self.snapshot.version
+                self._updated.set()
+                self._updated = asyncio.Event()
+            await asyncio.sleep(CHECK_INTERVAL)
+        print(f"Publishing realtime snapshots to {self.path} (pid {os.getpid()})")  # noqa: T201
+        # 前の書き手の版の続きから始め、読み手のキャッシュと版が重ならないようにする
+        previous = self._refresh()
+        if previous is not None:
+            self.poller.resume(previous.snapshot)
+        self.poller.start()
+        # 読み手として待っていた側は、起こして poller で待ち直させる
+        self._updated.set()
+        published = None
+        while True:
+            minute = int(time.time() // 60)
+            if (self.poller.snapshot.version, minute) != published:
+                try:
+                    await asyncio.to_thread(self._publish)
+                    published = (self.poller.snapshot.version, minute)
+                except Exception as e:  # noqa: BLE001
+                    print(f"Error publishing realtime snapshot: {e!r}")  # noqa: T201
+            await self.poller.wait_for_update(PREBUILD_INTERVAL)
+
+    def _publish(self) -> None:
+        with timed("shared_publish"):
+            snapshot = self.poller.snapshot
+            responses = self._prebuild() if self._prebuild is not None else {}
+            self.write(snapshot, responses)
+
+    def write(
+        self,
+        snapshot: RealtimeSnapshot,
+        responses: Mapping[Hashable, CachedResponse],
+    ) -> None:
+        """
+        スナップショットを別名で書いてから path に置き換える。
+
+        前の版から変わっていない TripRecord は前回の pickle をそのまま使う。
+        trip_id と始発時刻の両方で引ける便 (同じ TripRecord) は 1 回だけ書く。
+        """
+        parts = [MAGIC, b"\0" * _TABLE.size]
+        offset = len(MAGIC) + _TABLE.size
+        trips = {}
+        encoded = {}
+        written: dict[int, tuple[int, int]] = {}
+        for trip_id, record in snapshot.realtime.trips.items():
+            if id(record) in written:
+                trips[trip_id] = written[id(record)]
+                continue
+            previous = self._encoded.get(trip_id)
+            if previous is not None and previous[0] is record:
+                blob = previous[1]
+            else:
+                blob = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            encoded[trip_id] = (record, blob)
+            trips[trip_id] = written[id(record)] = (offset, len(blob))
+            parts.append(blob)
+            offset += len(blob)
+        self._encoded = encoded
+
+        bodies = {}
+        for key, response in responses.items():
+            bodies[key] = (response.etag, offset, len(response.body))
+            parts.append(response.body)
+            offset += len(response.body)
+
+        meta = pickle.dumps(
+            {
+                "version": snapshot.version,
+                "feed_timestamp": snapshot.feed_timestamp,
+                "fetched_at": snapshot.fetched_at,
+                "changed": snapshot.changed,
+                "history": self.poller.history(),
+                "feed_timestamps": self.poller.feed_timestamps(),
+                "vehicles": snapshot.realtime.vehicles,
+                "alerts": snapshot.realtime.alerts,
+                "trips": trips,
+                "responses": bodies,
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        parts[1] = _TABLE.pack(offset, len(meta))
+        parts.append(meta)
+        temporary = Path(f"{self.path}.{os.getpid()}.tmp")
+        with temporary.open("wb") as f:
+            f.writelines(parts)
+        temporary.replace(self.path)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self.is_writer:
+            await self.poller.stop()
+            self._lock_file.close()
+            self._lock_file = None
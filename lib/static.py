@@ -1,18 +1,33 @@
 import datetime  # noqa: I001
+import heapq
 import json
-from collections import defaultdict
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterable
+from itertools import islice
+from operator import itemgetter
 
-from sqlalchemy import and_, or_
-from sqlalchemy.orm import Session
+from typing import NamedTuple
 
+from sqlalchemy import ColumnElement, Select, select, text, union_all
+from sqlalchemy.orm import Query, Session
+
+from .feeds import base_trip_id, dated_trip_id, frequency_trip_id
+from .services import service_calendars
 from .static_models import (
-    Calendar,
-    CalendarDates,
+    Frequencies,
     Routes,
     Stops,
     StopTimes,
     Trips,
 )
+from .store import session_generation
+
+# 便の停車順: (stop_sequence, stop_id) の並び
+type TripPattern = tuple[tuple[int, str], ...]
+
+SECS_PER_DAY = 86400
 
 stops_ids = [
     "22030 1",
@@ -23,43 +38,63 @@ stops_ids = [
 ]
 
 
-def get_bus_schedule_flexible(
+def time_to_secs(value: str) -> int:
+    # GTFS の時刻は 24:00:00 を超えることがあるので秒に変換して比較する
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def secs_to_time(value: int) -> str:
+    # 秒を "HH:MM:SS" へ。表示用なので 24 時を超えた分は折り返す
+    hours, rest = divmod(value % 86400, 3600)
+    return f"{hours:02d}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def secs_to_gtfs_time(secs: int) -> str:
+    # GTFS の表記の時刻。24 時を超えても折り返さない
+    hours, rest = divmod(secs, 3600)
+    return f"{hours:02d}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def window_secs(start_time: str | None, stop_time: str | None) -> tuple[int, int]:
+    # 時間帯を target_date の 0 時からの秒で表す。終わりの省略は翌運行日の終わりまで
+    start_secs = time_to_secs(start_time) if start_time else 0
+    stop_secs = time_to_secs(stop_time) if stop_time else 2 * SECS_PER_DAY - 1
+    return start_secs, stop_secs
+
+
+def service_days(
+    target_date: datetime.datetime,
+    stop_secs: int,
+) -> list[tuple[datetime.datetime, int]]:
+    """
+    時間帯に発車が含まれうる運行日と、その運行日の発車秒に足すと target_date の
+    0 時からの秒になるずれの組。
+
+    前日の運行日の 24:00:00 以降の発車は当日の深夜にあたるので前日は常に含める。
+    時間帯が 24 時を超えるときは翌日の運行日の早朝の発車も含める。
+    """
+    days = [
+        (target_date - datetime.timedelta(days=1), -SECS_PER_DAY),
+        (target_date, 0),
+    ]
+    if stop_secs >= SECS_PER_DAY:
+        days.append((target_date + datetime.timedelta(days=1), SECS_PER_DAY))
+    return days
+
+
+def _service_filter(
     session: Session,
-    stop_ids: list,
-    target_date: str,
-    limit: int = 100,
-    start_time: str | None = "00:00:00",
-    stop_time: str | None = "23:59:59",
-) -> dict[str, dict[str, list[dict]]]:
-    target_date_str = datetime.datetime.strftime(target_date, "%Y%m%d")
-    day_of_week = target_date.strftime("%A").lower()
-
-    # 通常運行サービス
-    regular_services = (
-        session.query(Calendar.service_id)
-        .filter(getattr(Calendar, day_of_week) == "1")
-        .filter(
-            Calendar.service_id.notin_(
-                session.query(CalendarDates.service_id).filter(
-                    and_(
-                        CalendarDates.date == target_date_str,
-                        CalendarDates.exception_type == "2",
-                    ),
-                ),
-            ),
-        )
-    )
+    target_date: datetime.datetime,
+) -> ColumnElement[bool]:
+    # 運行サービスは展開済みの運行表から引く (calendar の表は問い合わせない)
+    services = service_calendars.get(session).active(target_date)
+    return Trips.service_id.in_(sorted(services))
 
-    # 特別運行サービス
-    special_services = session.query(CalendarDates.service_id).filter(
-        and_(
-            CalendarDates.date == target_date_str,
-            CalendarDates.exception_type == "1",
-        ),
-    )
 
-    # メインクエリ
-    query = (
+def _departure_rows(session: Session) -> Query:
+    # 発車の行。列の並びは group_by_trip と FrequencyIndex が前提にしている
+    return (
         session.query(
             StopTimes.trip_id,
             Trips.route_id,
@@ -70,43 +105,208 @@ def get_bus_schedule_flexible(
             StopTimes.stop_id,
             StopTimes.stop_headsign,
             Stops.stop_name,
+            StopTimes.departure_secs,
         )
         .join(Trips, StopTimes.trip_id == Trips.trip_id)
         .join(Routes, Trips.route_id == Routes.route_id)
         .join(Stops, StopTimes.stop_id == Stops.stop_id)
+    )
+
+
+def _departures_query(
+    session: Session,
+    stop_ids: list,
+    target_date: datetime.datetime,
+) -> Query:
+    # frequencies.txt の便の stop_times は雛形なので除き、FrequencyIndex で展開する
+    return (
+        _departure_rows(session)
         .filter(StopTimes.stop_id.in_(stop_ids))
-        .filter(
-            or_(
-                Trips.service_id.in_(regular_services),
-                Trips.service_id.in_(special_services),
-            ),
+        .filter(_service_filter(session, target_date))
+        .filter(StopTimes.trip_id.not_in(select(Frequencies.trip_id)))
+    )
+
+
+class Frequency(NamedTuple):
+    start_secs: int  # 始発の発車がこの時刻から
+    end_secs: int  # この時刻より前まで
+    headway_secs: int
+    exact_times: bool  # 始発時刻が時刻表どおりか (False なら目安の間隔)
+
+
+class FrequencyIndex:
+    """
+    frequencies.txt で運行する便を、問い合わせの停留所と時間帯の分だけ発車に展開する索引。
+
+    便の stop_times は始発からの相対時刻の雛形として停留所ごとに持ち、1 本 1 本の便は
+    DB にもメモリにも作らない。展開した発車の trip_id は frequency_trip_id() で、
+    GTFS-Realtime の TripDescriptor (trip_id と start_time) の便と同じものになる。
+    静的データから作り、作った後は変更しない。
+    """
+
+    def __init__(
+        self,
+        periods: dict[str, tuple[Frequency, ...]] | None = None,
+        templates: dict[str, tuple[tuple[int, tuple], ...]] | None = None,
+    ) -> None:
+        # trip_id -> 運行間隔の期間
+        self.periods = periods or {}
+        # 停留所ID -> (始発からの秒, 発車の行) の並び
+        self.templates = templates or {}
+
+    def __len__(self) -> int:
+        return len(self.periods)
+
+    @classmethod
+    def build(
+        cls,
+        frequencies: Iterable[tuple],
+        stop_times: Iterable[tuple],
+    ) -> "FrequencyIndex":
+        """
+        frequencies は (trip_id, start_time, end_time, headway_secs, exact_times)、
+        stop_times は _departure_rows() と同じ列の行を便ごとに停車順で渡す。
+        """
+        periods = defaultdict(list)
+        for trip_id, start_time, end_time, headway_secs, exact_times in frequencies:
+            if not headway_secs or int(headway_secs) <= 0:
+                continue
+            periods[trip_id].append(
+                Frequency(
+                    time_to_secs(start_time),
+                    time_to_secs(end_time),
+                    int(headway_secs),
+                    str(exact_times) == "1",
+                ),
+            )
+        templates = defaultdict(list)
+        first_secs: dict[str, int] = {}
+        for row in stop_times:
+            if row[0] not in periods or row[9] is None:
+                continue
+            origin = first_secs.setdefault(row[0], row[9])
+            templates[row[6]].append((row[9] - origin, tuple(row)))
+        return cls(
+            {trip_id: tuple(sorted(items)) for trip_id, items in periods.items()},
+            {stop_id: tuple(items) for stop_id, items in templates.items()},
         )
-        .order_by(StopTimes.departure_time)
-        .filter(StopTimes.departure_time >= start_time)
-        .filter(StopTimes.departure_time <= stop_time)
-        .limit(limit)
+
+    @classmethod
+    def load(cls, session: Session) -> "FrequencyIndex":
+        frequencies = session.query(
+            Frequencies.trip_id,
+            Frequencies.start_time,
+            Frequencies.end_time,
+            Frequencies.headway_secs,
+            Frequencies.exact_times,
+        ).all()
+        if not frequencies:
+            return cls()
+        stop_times = (
+            _departure_rows(session)
+            .filter(StopTimes.trip_id.in_(select(Frequencies.trip_id)))
+            .order_by(StopTimes.trip_id, StopTimes.stop_sequence)
+        )
+        return cls.build(frequencies, stop_times)
+
+    def departures(
+        self,
+        stop_ids: Iterable[str],
+        services: frozenset[str],
+        start_secs: int,
+        stop_secs: int,
+        shift: int = 0,
+        limit: int | None = None,
+    ) -> list[tuple[int, tuple]]:
+        """
+        時間帯に発車する便の 1 本ごとの (target_date の時刻での秒, 発車の行) を発車順で。
+
+        行の trip_id は frequency_trip_id()、時刻はその便の時刻にする。
+        shift は運行日の発車秒に足すずれ (service_days() のもの)。
+        """
+        found = []
+        for stop_id in dict.fromkeys(stop_ids):
+            for offset, row in self.templates.get(stop_id, ()):
+                if row[2] not in services:
+                    continue
+                # 始発が earliest 以降の便がこの停留所を時間帯の中で発車する
+                earliest = start_secs - shift - offset
+                for period in self.periods[row[0]]:
+                    headway = period.headway_secs
+                    skipped = max(0, -((period.start_secs - earliest) // headway))
+                    start = period.start_secs + skipped * headway
+                    count = 0
+                    while (
+                        start < period.end_secs and start + offset + shift <= stop_secs
+                    ):
+                        found.append(
+                            (start + offset + shift, _instance(row, start, offset)),
+                        )
+                        start += headway
+                        count += 1
+                        if limit is not None and count >= limit:
+                            break
+        found.sort(key=itemgetter(0))
+        return found[:limit] if limit is not None else found
+
+
+def _instance(row: tuple, start_secs: int, offset: int) -> tuple:
+    # 雛形の行を始発が start_secs の便の行にする
+    secs = start_secs + offset
+    return (
+        frequency_trip_id(row[0], secs_to_gtfs_time(start_secs)),
+        *row[1:5],
+        secs_to_gtfs_time(secs),
+        *row[6:9],
+        secs,
     )
 
-    results = query.all()
 
-    # UUIDでグループ化
-    grouped_data = defaultdict(lambda: {"trip_info": {}, "stops": []})
+def group_by_trip(
+    results: Iterable[tuple[int, tuple]],
+    target_date: datetime.datetime,
+) -> dict[str, dict[str, list[dict]]]:
+    """
+    (target_date の時刻での秒, 発車の行) を運行日と便ごとにまとめる。
 
-    for result in results:
-        trip_id = result[0]  # UUID
+    キーは trip_id。時間帯が長いと前日と当日の同じ便が両方載るので、2 本目からは
+    dated_trip_id() をキーにする。trip_info の service_date はその便の運行日。
+    """
+    grouped_data = {}
+    # (運行日のずれ, trip_id) -> キー
+    keys: dict[tuple[int, str], str] = {}
+    service_dates: dict[int, str] = {}
 
-        # 便情報（最初のレコードで設定）
-        if not grouped_data[trip_id]["trip_info"]:
-            grouped_data[trip_id]["trip_info"] = {
-                "trip_id": result[0],
-                "route_id": result[1],
-                "service_id": result[2],
-                "route_short_name": result[3],
-                "route_long_name": result[4],
+    for board_secs, result in results:
+        trip_id = result[0]
+        shift = board_secs - result[9]
+        key = keys.get((shift, trip_id))
+        if key is None:
+            # 便情報（最初のレコードで設定）
+            service_date = service_dates.get(shift)
+            if service_date is None:
+                service_date = service_dates[shift] = (
+                    target_date + datetime.timedelta(seconds=shift)
+                ).strftime("%Y%m%d")
+            key = keys[shift, trip_id] = (
+                dated_trip_id(trip_id, service_date)
+                if trip_id in grouped_data
+                else trip_id
+            )
+            grouped_data[key] = {
+                "trip_info": {
+                    "trip_id": result[0],
+                    "route_id": result[1],
+                    "service_id": result[2],
+                    "route_short_name": result[3],
+                    "route_long_name": result[4],
+                    "service_date": service_date,
+                },
+                "stops": [],
             }
 
         # 停留所情報を追加
-        grouped_data[trip_id]["stops"].append(
+        grouped_data[key]["stops"].append(
             {
                 "departure_scheduled_time": result[5],
                 "stop_id": result[6],
@@ -115,7 +315,316 @@ def get_bus_schedule_flexible(
             }
         )
 
-    return dict(grouped_data)
+    return grouped_data
+
+
+def _schedule_statement(
+    session: Session,
+    stop_ids: list,
+    target_date: datetime.datetime,
+    *,
+    start_secs: int,
+    stop_secs: int,
+    limit: int,
+) -> Select:
+    # 運行日ごとの時間帯を UNION ALL でつなぎ、target_date の時刻 (board_secs) で並べる
+    windows = union_all(
+        *(
+            _departures_query(session, stop_ids, day)
+            .add_columns((StopTimes.departure_secs + shift).label("board_secs"))
+            .filter(StopTimes.departure_secs >= start_secs - shift)
+            .filter(StopTimes.departure_secs <= stop_secs - shift)
+            .statement
+            for day, shift in service_days(target_date, stop_secs)
+        ),
+    ).subquery()
+    return select(windows).order_by(windows.c.board_secs).limit(limit)
+
+
+def get_bus_schedule_flexible(
+    session: Session,
+    stop_ids: list,
+    target_date: str,
+    limit: int = 100,
+    start_time: str | None = "00:00:00",
+    stop_time: str | None = "23:59:59",
+) -> dict[str, dict[str, list[dict]]]:
+    # メインクエリ。日をまたぐ時間帯も 1 回の問い合わせで答える
+    start_secs, stop_secs = window_secs(start_time, stop_time)
+    query = _schedule_statement(
+        session,
+        stop_ids,
+        target_date,
+        start_secs=start_secs,
+        stop_secs=stop_secs,
+        limit=limit,
+    )
+    rows = ((row.board_secs, row) for row in session.execute(query))
+    frequencies = frequency_indexes.get(session)
+    if not frequencies:
+        return group_by_trip(rows, target_date)
+    # 頻度ベースの便は時間帯の分だけ展開して board_secs の順に併合する
+    calendar = service_calendars.get(session)
+    windows = [
+        frequencies.departures(
+            stop_ids,
+            calendar.active(day),
+            start_secs,
+            stop_secs,
+            shift,
+            limit,
+        )
+        for day, shift in service_days(target_date, stop_secs)
+    ]
+    merged = heapq.merge(rows, *windows, key=itemgetter(0))
+    return group_by_trip(islice(merged, limit), target_date)
+
+
+class TripPatternCache:
+    """
+    便ごとの停車パターン (stop_sequence, stop_id) の並びを保持するキャッシュ。
+
+    要求された便のうち未取得のものだけをまとめて読み込む。同じ並びの便は
+    同じタプルを共有する。頻度ベースの便の 1 本や運行日付きの便は元の便の並びを使い、
+    元の trip_id で保持するので、大きさは静的データの便の数までに収まる。
+    静的データを入れ替えたら invalidate() を呼ぶ。無効化した世代より古いセッションで
+    読んだものは保持しない。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは invalidate() しなくてよい
+    tables = ("stop_times",)
+
+    def __init__(self) -> None:
+        # 元の便の trip_id -> 停車パターン
+        self._trips: dict[str, TripPattern] = {}
+        self._patterns: dict[TripPattern, TripPattern] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        session: Session,
+        trip_ids: Iterable[str],
+    ) -> dict[str, TripPattern]:
+        bases = {trip_id: base_trip_id(trip_id) for trip_id in trip_ids}
+        trips = self._trips
+        missing = {base for base in bases.values() if base not in trips}
+        if missing:
+            loaded = defaultdict(list)
+            query = (
+                session.query(
+                    StopTimes.trip_id,
+                    StopTimes.stop_sequence,
+                    StopTimes.stop_id,
+                )
+                .filter(StopTimes.trip_id.in_(missing))
+                .order_by(StopTimes.trip_id, StopTimes.stop_sequence)
+            )
+            for trip_id, stop_sequence, stop_id in query:
+                loaded[trip_id].append((stop_sequence, stop_id))
+            with self._lock:
+                if session_generation(session) < self._generation:
+                    # 無効化した後なので詰めずに、この問い合わせの分だけで答える
+                    trips = dict(trips)
+                    patterns: dict[TripPattern, TripPattern] = {}
+                else:
+                    patterns = self._patterns
+                for base in missing:
+                    pattern = tuple(loaded.get(base, ()))
+                    trips[base] = patterns.setdefault(pattern, pattern)
+        return {
+            trip_id: trips[base] for trip_id, base in bases.items() if base in trips
+        }
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._trips.clear()
+            self._patterns.clear()
+            self._generation = max(self._generation, generation)
+
+    def stats(self) -> dict[str, int]:
+        return {"trips": len(self._trips), "patterns": len(self._patterns)}
+
+
+def explain_departures(
+    session: Session,
+    stop_ids: list,
+    target_date: datetime.datetime,
+) -> list[str]:
+    # get_bus_schedule_flexible と同じ形のクエリの EXPLAIN QUERY PLAN を返す
+    query = _schedule_statement(
+        session,
+        stop_ids,
+        target_date,
+        start_secs=0,
+        stop_secs=SECS_PER_DAY - 1,
+        limit=100,
+    )
+    sql = query.compile(
+        session.get_bind(),
+        compile_kwargs={"literal_binds": True},
+    )
+    rows = session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))
+    return [row[3] for row in rows]
+
+
+class DepartureBoardCache:
+    """
+    運行日ごとに停留所別の発車時刻表を保持するキャッシュ。
+
+    停留所の 1 日分の発車を初回要求時にまとめて取得して発車秒で整列しておき、
+    時間帯の問い合わせは bisect と limit のスライスだけで答える。
+    頻度ベースの便は保持せず、問い合わせのたびに FrequencyIndex で時間帯の分だけ展開する。
+    運行日単位の LRU で古い日を追い出し、静的データを入れ替えたら invalidate() を呼ぶ。
+    無効化した世代より古いセッションで読んだものは保持しない。
+    """
+
+    # 読むテーブル (運行サービスは ServiceCalendarCache を通して calendar から)
+    tables = (
+        "calendar",
+        "calendar_dates",
+        "frequencies",
+        "routes",
+        "stop_times",
+        "stops",
+        "trips",
+    )
+
+    def __init__(self, max_days: int = 6) -> None:
+        self.max_days = max_days
+        self.hits = 0
+        self.misses = 0
+        # 運行日 -> 停留所ID -> (発車秒のリスト, 行のリスト)
+        self._days: OrderedDict[str, dict[str, tuple[list[int], list[tuple]]]] = (
+            OrderedDict()
+        )
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _boards_for(
+        self,
+        session: Session,
+        stop_ids: list,
+        target_date: datetime.datetime,
+    ) -> dict[str, tuple[list[int], list[tuple]]]:
+        key = target_date.strftime("%Y%m%d")
+        with self._lock:
+            boards = self._days.get(key)
+            if boards is None:
+                boards = self._days[key] = {}
+            self._days.move_to_end(key)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+            missing = [stop_id for stop_id in stop_ids if stop_id not in boards]
+            if not missing:
+                self.hits += 1
+                return boards
+            self.misses += 1
+
+        # 足りない停留所の 1 日分を一度に取得する
+        loaded = {stop_id: [] for stop_id in missing}
+        query = (
+            _departures_query(session, missing, target_date)
+            .filter(StopTimes.departure_secs.is_not(None))
+            .order_by(StopTimes.departure_secs)
+        )
+        for row in query:
+            loaded[row[6]].append(tuple(row))
+        with self._lock:
+            if session_generation(session) < self._generation:
+                # 無効化で捨てた日に詰めないよう、この問い合わせの分だけで答える
+                boards = dict(boards)
+            for stop_id, rows in loaded.items():
+                boards[stop_id] = ([row[9] for row in rows], rows)
+        return boards
+
+    def get(
+        self,
+        session: Session,
+        stop_ids: list,
+        target_date: datetime.datetime,
+        limit: int = 100,
+        start_time: str | None = "00:00:00",
+        stop_time: str | None = "23:59:59",
+    ) -> dict[str, dict[str, list[dict]]]:
+        start_secs, stop_secs = window_secs(start_time, stop_time)
+
+        # 運行日と停留所の組ごとの整列済みの範囲を、target_date の時刻で 1 回で併合する
+        windows = []
+        frequencies = frequency_indexes.get(session)
+        for day, shift in service_days(target_date, stop_secs):
+            boards = self._boards_for(session, stop_ids, day)
+            for stop_id in dict.fromkeys(stop_ids):
+                secs, rows = boards[stop_id]
+                lo = bisect_left(secs, start_secs - shift)
+                hi = min(bisect_right(secs, stop_secs - shift, lo), lo + limit)
+                windows.append(
+                    zip(map(shift.__add__, secs[lo:hi]), rows[lo:hi], strict=True),
+                )
+            if frequencies:
+                windows.append(
+                    frequencies.departures(
+                        stop_ids,
+                        service_calendars.get(session).active(day),
+                        start_secs,
+                        stop_secs,
+                        shift,
+                        limit,
+                    ),
+                )
+
+        merged = islice(heapq.merge(*windows, key=itemgetter(0)), limit)
+        return group_by_trip(merged, target_date)
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._days.clear()
+            self._generation = max(self._generation, generation)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "days": len(self._days),
+        }
+
+
+class FrequencyIndexCache:
+    """
+    静的データから FrequencyIndex を一度だけ作って使い回す。
+
+    最初の問い合わせ時に作り、静的データを入れ替えたら invalidate() を呼ぶ。
+    無効化した世代より古いセッションで作ったものは保持しない。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは invalidate() しなくてよい
+    tables = ("frequencies", "routes", "stop_times", "stops", "trips")
+
+    def __init__(self) -> None:
+        self._index: FrequencyIndex | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, session: Session) -> FrequencyIndex:
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = FrequencyIndex.load(session)
+                    if session_generation(session) >= self._generation:
+                        self._index = index
+        return index
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._index = None
+            self._generation = max(self._generation, generation)
+
+
+departure_boards = DepartureBoardCache()
+trip_patterns = TripPatternCache()
+frequency_indexes = FrequencyIndexCache()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Text
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -92,6 +92,14 @@ class Calendar(Base):
 
 class CalendarDates(Base):
     __tablename__ = "calendar_dates"
+    __table_args__ = (
+        Index(
+            "calendar_dates_date_exception",
+            "date",
+            "exception_type",
+            "service_id",
+        ),
+    )
 
     service_id = Column(String(64), primary_key=True)
     date = Column(String(16), primary_key=True)
@@ -185,6 +193,17 @@ class Stops(Base):
 
 class StopTimes(Base):
     __tablename__ = "stop_times"
+    __table_args__ = (
+        Index(
+            "stop_times_stop_departure",
+            "stop_id",
+            "departure_secs",
+            "trip_id",
+            "departure_time",
+            "stop_headsign",
+        ),
+        Index("stop_times_trip_sequence", "trip_id", "stop_sequence", "stop_id"),
+    )
 
     trip_id = Column(String(64), ForeignKey("trips.trip_id"), primary_key=True)
     stop_id = Column(String(64), ForeignKey("stops.stop_id"), primary_key=True)
@@ -196,6 +215,7 @@ class StopTimes(Base):
     drop_off_type = Column(String(2))
     shape_dist_traveled = Column(Integer)
     timepoint = Column(Integer)
+    departure_secs = Column(Integer)
 
     # リレーションシップ
     trips = relationship("Trips", back_populates="stop_times")
@@ -207,8 +227,12 @@ class Transfers(Base):
 
     from_stop_id = Column(String(64), primary_key=True)
     to_stop_id = Column(String(64), primary_key=True)
+    from_route_id = Column(String(64))
+    to_route_id = Column(String(64))
+    from_trip_id = Column(String(64))
+    to_trip_id = Column(String(64))
     transfer_type = Column(String(2))
-    min_transfer_type = Column(Integer)
+    min_transfer_time = Column(Integer)
 
 
 class FareAttributes(Base):
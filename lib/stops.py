@@ -0,0 +1,155 @@
+import threading
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from sqlalchemy.orm import Session
+
+from .geo import GridIndex
+from .static_models import Stops
+from .store import session_generation
+
+# 親の停留所 (parent_station) がない標柱は、stop_id のこの文字より前が同じものをまとめる
+# ("22030 1" と "22030 2" は "22030" の 2 つののりば)
+STOP_GROUP_SEPARATOR = " "
+
+
+class Stop(NamedTuple):
+    stop_id: str
+    stop_name: str | None
+    latitude: float
+    longitude: float
+    group: str  # parent_station か stop_id の前半
+
+
+class StopGroup(NamedTuple):
+    group: str
+    name: str | None
+    stops: tuple[Stop, ...]
+
+
+def _coordinate(value: str | None) -> float | None:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def stop_group(stop_id: str, parent_station: str | None) -> str:
+    if parent_station:
+        return parent_station
+    head, separator, _ = stop_id.rpartition(STOP_GROUP_SEPARATOR)
+    return head if separator else stop_id
+
+
+class StopIndex:
+    """
+    発車のある標柱 (location_type が 0 か空) を位置で引けるようにした索引。
+
+    位置は GridIndex のマスに分けて持つ。近くの標柱が見つかったら、同じ停留所の
+    のりば (groups) をまとめて返すので、道路の反対側ののりばが半径から外れても落ちない。
+    静的データから作り、作った後は変更しない。
+    """
+
+    def __init__(
+        self,
+        stops: Iterable[Stop] = (),
+        group_names: dict[str, str | None] | None = None,
+    ) -> None:
+        self.stops = tuple(stops)
+        self.by_id = {stop.stop_id: stop for stop in self.stops}
+        grouped: defaultdict[str, list[Stop]] = defaultdict(list)
+        for stop in self.stops:
+            grouped[stop.group].append(stop)
+        # 停留所の名前は親の停留所の名前、なければ最初ののりばの名前
+        group_names = group_names or {}
+        self.groups = {
+            group: StopGroup(
+                group,
+                group_names.get(group) or members[0].stop_name,
+                tuple(sorted(members, key=lambda stop: stop.stop_id)),
+            )
+            for group, members in grouped.items()
+        }
+        self.grid = GridIndex(
+            (stop.latitude, stop.longitude, stop) for stop in self.stops
+        )
+
+    def __len__(self) -> int:
+        return len(self.stops)
+
+    @classmethod
+    def load(cls, session: Session) -> "StopIndex":
+        rows = session.query(
+            Stops.stop_id,
+            Stops.stop_name,
+            Stops.stop_lat,
+            Stops.stop_lon,
+            Stops.location_type,
+            Stops.parent_station,
+        ).all()
+        stops = []
+        names = {}
+        for stop_id, stop_name, stop_lat, stop_lon, location_type, parent in rows:
+            names[stop_id] = stop_name
+            if location_type not in {None, "", "0"}:
+                continue
+            latitude = _coordinate(stop_lat)
+            longitude = _coordinate(stop_lon)
+            if latitude is None or longitude is None:
+                continue
+            group = stop_group(stop_id, parent)
+            stops.append(Stop(stop_id, stop_name, latitude, longitude, group))
+        return cls(stops, names)
+
+    def near(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_meters: float,
+        limit: int | None = None,
+    ) -> list[tuple[float, StopGroup]]:
+        # radius_meters 以内に標柱がある停留所を、いちばん近い標柱の距離の近い順で返す
+        found: dict[str, tuple[float, StopGroup]] = {}
+        for distance, stop in self.grid.near(latitude, longitude, radius_meters):
+            if stop.group not in found:
+                found[stop.group] = (distance, self.groups[stop.group])
+                if limit is not None and len(found) >= limit:
+                    break
+        return list(found.values())
+
+
+class StopIndexCache:
+    """
+    静的データから StopIndex を一度だけ作って使い回す。
+
+    最初の問い合わせ時に作り、静的データを入れ替えたら invalidate() を呼ぶ。
+    無効化した世代より古いセッションで作ったものは保持しない。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは invalidate() しなくてよい
+    tables = ("stops",)
+
+    def __init__(self) -> None:
+        self._index: StopIndex | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, session: Session) -> StopIndex:
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = StopIndex.load(session)
+                    if session_generation(session) >= self._generation:
+                        self._index = index
+        return index
+
+    def invalidate(self, generation: int = 0) -> None:
+        with self._lock:
+            self._index = None
+            self._generation = max(self._generation, generation)
+
+
+stop_indexes = StopIndexCache()
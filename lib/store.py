@@ -0,0 +1,217 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from collections.abc import Callable, Iterable
+from contextlib import closing, suppress
+from typing import NamedTuple
+
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+# 差し替えを確かめる秒数
+CHECK_INTERVAL = 5.0
+
+# 公開時に呼ぶ関数。引数は公開する世代
+type Invalidate = Callable[[int], None]
+# 差し替えたファイルから作り直し、公開時に呼ぶ関数を返す
+type Rebuild = Callable[[], Callable[[], None]]
+
+
+def session_generation(session: Session) -> int:
+    # StaticStore.session() で開いたときの世代。ほかで開いたセッションは 0
+    return session.info.get("generation", 0)
+
+
+class _Opened(NamedTuple):
+    generation: int
+    engine: Engine
+    session_factory: sessionmaker
+
+
+class StaticStore:
+    """
+    静的 GTFS の DB へのエンジンを保持し、ファイルが差し替えられたら開き直す。
+
+    build_database() は rename で DB を入れ替えるため、開いている接続は古いファイルを
+    読み続けられる。start() したタスクが CHECK_INTERVAL ごとに inode を見て、変わっていれば
+    別スレッドで refresh() する。リクエストは差し替えを待たない。
+
+    refresh() は新しいファイルへのエンジンを作り、on_rebuild() で登録したものを
+    脇で作り直してから、on_swap() で登録した無効化を呼び、エンジンの参照を 1 回で
+    入れ替えて公開する。公開のたびに世代を 1 つ進め、session() で開いたセッションには
+    その世代を持たせる。キャッシュは無効化した世代より古いセッションからは詰め直さない。
+    tables を付けて登録したものは、前に開いた DB の取り込みから後に変わったテーブル
+    (static_changes に update_database() が書き足したもの) と重なるときだけ呼ぶ。
+    何度か差し替えを見逃して記録が残っていなければ、すべて呼ぶ。作り直しに失敗したら
+    公開せずに古いエンジンを使い続け、次の確認でやり直す。
+    """
+
+    def __init__(
+        self,
+        db_path: str = "nowhere.db",
+        pool_size: int = 8,
+        max_overflow: int = 16,
+    ) -> None:
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        # 差し替えるまでひとつのエンジン (と接続プール) を使い回す
+        self._opened = _Opened(0, *self._open())
+        # 開いている DB の取り込みの番号。差し替えと競合しても古い番号なら多めに無効化するだけ
+        self._imported = self._last_generation()
+        self._identity = self._stat()
+        self._invalidates: list[tuple[Invalidate, frozenset[str] | None]] = []
+        self._rebuilds: list[tuple[Rebuild, frozenset[str] | None]] = []
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _open(self) -> tuple[Engine, sessionmaker]:
+        engine = create_engine(
+            f"sqlite:///{self.db_path}",
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+        )
+        return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    @property
+    def engine(self) -> Engine:
+        return self._opened.engine
+
+    @property
+    def generation(self) -> int:
+        return self._opened.generation
+
+    def _stat(self) -> tuple[int, int, int, int] | None:
+        try:
+            st = os.stat(self.db_path)  # noqa: PTH116
+        except FileNotFoundError:
+            return None
+        # 続けて差し替えると消えたファイルの inode が使い回されることがあるので、
+        # 更新時刻と大きさも見る
+        return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+    def on_swap(
+        self,
+        invalidate: Invalidate,
+        tables: Iterable[str] | None = None,
+    ) -> None:
+        # tables は invalidate が無効化するキャッシュが読むテーブル。None ならいつも呼ぶ
+        self._invalidates.append(
+            (invalidate, frozenset(tables) if tables is not None else None),
+        )
+
+    def on_rebuild(
+        self,
+        rebuild: Rebuild,
+        tables: Iterable[str] | None = None,
+    ) -> None:
+        # rebuild は公開前に呼び、返した関数を公開時に呼ぶ
+        self._rebuilds.append(
+            (rebuild, frozenset(tables) if tables is not None else None),
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+
+    def _last_generation(self) -> int | None:
+        try:
+            with closing(self._connect()) as conn:
+                (generation,) = conn.execute(
+                    "SELECT MAX(generation) FROM static_changes",
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        return generation
+
+    def _changed_tables(self) -> tuple[set[str] | None, int | None]:
+        # (前に開いた DB の取り込みから後に変わったテーブル, 差し替えた DB の取り込みの番号)。
+        # 間の記録がそろっていなければテーブルは None (すべて変わったとみなす)
+        try:
+            with closing(self._connect()) as conn:
+                first, last = conn.execute(
+                    "SELECT MIN(generation), MAX(generation) FROM static_changes",
+                ).fetchone()
+                if (
+                    self._imported is None
+                    or last is None
+                    or not first <= self._imported + 1 <= last
+                ):
+                    return None, last
+                rows = conn.execute(
+                    "SELECT DISTINCT table_name FROM static_changes "
+                    "WHERE generation > ?",
+                    (self._imported,),
+                )
+                return {table for (table,) in rows}, last
+        except sqlite3.Error:
+            return None, None
+
+    def refresh(self) -> bool:
+        # 差し替えを検知して公開した場合のみ True。時間がかかるのでリクエストからは呼ばない
+        identity = self._stat()
+        if identity == self._identity:
+            return False
+        with self._lock:
+            if identity == self._identity:
+                return False
+            changed, imported = self._changed_tables()
+
+            def affected(tables: frozenset[str] | None) -> bool:
+                return tables is None or changed is None or bool(tables & changed)
+
+            engine, session_factory = self._open()
+            # 時刻表などは古いものを使わせたまま作り直し、1 つでも失敗したら公開しない
+            try:
+                publishes = [
+                    rebuild() for rebuild, tables in self._rebuilds if affected(tables)
+                ]
+            except Exception as e:  # noqa: BLE001
+                engine.dispose()
+                print(f"Error rebuilding after a static feed swap: {e!r}")  # noqa: T201
+                return False
+            generation = self._opened.generation + 1
+            # 先に無効化してから公開する。公開までに開いた古い世代のセッションは詰め直せない
+            for invalidate, tables in self._invalidates:
+                if affected(tables):
+                    invalidate(generation)
+            for publish in publishes:
+                publish()
+            previous = self._opened
+            self._opened = _Opened(generation, engine, session_factory)
+            self._identity = identity
+            self._imported = imported
+        # 貸し出し中の接続は返却時に閉じられる
+        previous.engine.dispose()
+        tables = ", ".join(sorted(changed)) if changed is not None else "all tables"
+        print(f"Reopened {self.db_path} after a static feed swap ({tables})")  # noqa: T201
+        return True
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if self._stat() != self._identity:
+                try:
+                    await asyncio.to_thread(self.refresh)
+                except Exception as e:  # noqa: BLE001
+                    print(f"Error reopening {self.db_path}: {e!r}")  # noqa: T201
+
+    def start(self, interval: float = CHECK_INTERVAL) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def session(self) -> Session:
+        opened = self._opened
+        session = opened.session_factory()
+        session.info["generation"] = opened.generation
+        return session
+
+    def close(self) -> None:
+        self._opened.engine.dispose()
@@ -0,0 +1,118 @@
+import asyncio
+import contextlib
+import json
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+
+def diff_boards(old: dict, new: dict) -> dict:
+    """
+    2 つの掲示板 (trip_id をキーとしたマージ結果) の差分。
+
+    Returns:
+        removed: 消えた便 (発車済み・時間帯から外れた便) の trip_id。
+        upserted: 追加された便と、遅延や運休などで内容が変わった便。
+    """
+    return {
+        "removed": [trip_id for trip_id in old if trip_id not in new],
+        "upserted": {
+            trip_id: trip for trip_id, trip in new.items() if old.get(trip_id) != trip
+        },
+    }
+
+
+def _encode(message: dict) -> str:
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+class BoardChannel:
+    """
+    1 枚の掲示板の最新の内容を、購読しているすべてのクライアントへ配る。
+
+    掲示板の組み立てはリアルタイムのスナップショットが更新されるたび (と refresh_interval ごと)
+    にチャンネル単位で 1 回だけ行い、JSON もその時に 1 回だけ作る。
+    購読者には接続時に全体を送り、その後は直前の版からの差分だけを送る。
+    購読者がいなくなれば更新を止める。
+    """
+
+    def __init__(
+        self,
+        build: Callable[[], dict],
+        wait_for_update: Callable[[float], Awaitable[None]],
+        refresh_interval: float = 60.0,
+    ) -> None:
+        self._build = build
+        self._wait_for_update = wait_for_update
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self.result: dict = {}
+        self._snapshot_json = ""
+        self._diff_json = ""
+        self._subscribers = 0
+        self._condition = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self) -> bool:
+        # 内容が変わって新しい版を配った場合のみ True
+        result = await asyncio.to_thread(self._build)
+        diff = diff_boards(self.result, result)
+        if self.version and not diff["removed"] and not diff["upserted"]:
+            return False
+        async with self._condition:
+            self.version += 1
+            self.result = result
+            self._snapshot_json = _encode(
+                {"type": "snapshot", "version": self.version, "result": result},
+            )
+            self._diff_json = _encode({"type": "diff", "version": self.version, **diff})
+            self._condition.notify_all()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:  # noqa: BLE001
+                print(f"Error refreshing board stream: {e}")  # noqa: T201
+            await self._wait_for_update(self.refresh_interval)
+
+    async def subscribe(
+        self,
+        keepalive: float = 15.0,
+    ) -> AsyncIterator[tuple[str, str] | None]:
+        """
+        配信するメッセージを ("snapshot" か "diff", JSON 文字列) の組で順に返す。
+        keepalive 秒何もなければ None を返す。
+
+        取りこぼした版がある場合は差分ではなく全体を送り直す。
+        """
+        self._subscribers += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        seen = 0
+        try:
+            while True:
+                async with self._condition:
+                    try:
+                        await asyncio.wait_for(
+                            self._condition.wait_for(
+                                lambda seen=seen: self.version > seen,
+                            ),
+                            keepalive,
+                        )
+                    except TimeoutError:
+                        message = None
+                    else:
+                        message = (
+                            ("diff", self._diff_json)
+                            if seen and self.version == seen + 1
+                            else ("snapshot", self._snapshot_json)
+                        )
+                        seen = self.version
+                yield message
+        finally:
+            self._subscribers -= 1
+            if not self._subscribers and self._task is not None:
+                self._task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await self._task
+                self._task = None
@@ -0,0 +1,467 @@
+import datetime
+import fcntl
+import heapq
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from operator import itemgetter
+from pathlib import Path
+
+from .feeds import base_trip_id
+from .services import WEEKDAYS, ServiceCalendar
+from .static import (
+    FrequencyIndex,
+    TripPattern,
+    group_by_trip,
+    service_days,
+    window_secs,
+)
+
+# Timetable.save() のファイルの先頭と、続くメタデータ (pickle) の長さ
+MAGIC = b"NWTT\x02"
+_META_LENGTH = struct.Struct(">Q")
+# 配列の int の大きさ。ファイル上の配列はこの倍数の位置から始める
+_ITEM_SIZE = array("i").itemsize
+
+
+class _Interner:
+    # 文字列に連番を振り、同じ文字列は同じ番号・同じオブジェクトにする
+    def __init__(self, values: Iterable[str] = ()) -> None:
+        self.values: list[str] = list(values)
+        self._index: dict[str, int] = {
+            value: index for index, value in enumerate(self.values)
+        }
+
+    def __call__(self, value: str | None) -> int:
+        value = value or ""
+        index = self._index.get(value)
+        if index is None:
+            index = self._index[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def get(self, value: str) -> int | None:
+        return self._index.get(value)
+
+
+class Timetable:
+    """
+    読み取り専用の時刻表をメモリ上の列 (array) で持ち、SQL を介さずに答えるエンジン。
+
+    文字列の ID はすべて連番に置き換え、stop_times は列ごとの配列で保持する。
+    停留所ごとに発車秒で並べた索引 (CSR 形式) を持ち、時間帯の検索は bisect で行う。
+    get_bus_schedule_flexible() は lib.static の同名関数と同じ結果を返す。
+
+    save() でファイルに書き出し、open() でそれを mmap すると、配列はコピーせずに
+    ファイルのページを指す (memoryview)。同じファイルを開いた複数のワーカープロセスは
+    配列のメモリを共有し、プロセスごとに持つのは ID の文字列と索引の辞書だけになる。
+
+    frequencies.txt の便は発車の索引に入れず、FrequencyIndex (frequencies) で
+    問い合わせの時間帯の分だけ展開する。
+    """
+
+    # 読むテーブル。これらが変わらない差し替えでは読み込み直さなくてよい
+    tables = (
+        "calendar",
+        "calendar_dates",
+        "frequencies",
+        "routes",
+        "stop_times",
+        "stops",
+        "trips",
+    )
+
+    def __init__(self) -> None:
+        self.stops = _Interner()
+        self.trips = _Interner()
+        self.routes = _Interner()
+        self.services = _Interner()
+        self.strings = _Interner()  # 時刻の文字列・行先・名称
+
+        self.stop_names = array("i")
+        self.route_short_names = array("i")
+        self.route_long_names = array("i")
+        self.trip_routes = array("i")  # 経路がなければ -1
+        self.trip_services = array("i")
+
+        # stop_times の列
+        self.st_trip = array("i")
+        self.st_stop = array("i")
+        self.st_sequence = array("i")
+        self.st_departure_secs = array("i")
+        self.st_departure_time = array("i")
+        self.st_headsign = array("i")
+
+        # 停留所ごとの発車索引。停留所 s の行は dep_offsets[s] から dep_offsets[s + 1] の前まで
+        self.dep_offsets = array("i")
+        self.dep_rows = array("i")
+        self.dep_secs = array("i")
+        # 便ごとの停車順。便 t の行は trip_offsets[t] から trip_offsets[t + 1] の手前まで
+        self.trip_offsets = array("i")
+        self.pattern_rows = array("i")
+
+        # 運行表と、問い合わせのあった日ごとの運行サービスを連番に置き換えたもの
+        self.calendar = ServiceCalendar(datetime.date.min, {}, 0)
+        self.day_services: dict[int, frozenset[int]] = {}
+        # frequencies.txt の便の雛形 (件数が少ないので配列にはしない)
+        self.frequencies = FrequencyIndex()
+
+    @classmethod
+    def load(cls, db_path: str = "nowhere.db") -> "Timetable":
+        timetable = cls()
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            timetable._load(conn)
+            frequencies = conn.execute(
+                "SELECT trip_id, start_time, end_time, headway_secs, exact_times "
+                "FROM frequencies",
+            ).fetchall()
+        timetable._build_indexes(frequencies)
+        return timetable
+
+    def _arrays(self) -> dict[str, array]:
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if isinstance(value, array | memoryview)
+        }
+
+    def save(self, path: str | Path, source: tuple | None = None) -> None:
+        """
+        path に書き出す。source は元のデータを表す値で、open() で照合する。
+
+        書きかけのファイルを読まれないよう、別名で書いてから置き換える。
+        """
+        arrays = self._arrays()
+        offsets = {}
+        offset = 0
+        for name, values in arrays.items():
+            offsets[name] = (offset, len(values))
+            offset += len(values) * _ITEM_SIZE
+        meta = pickle.dumps(
+            {
+                "source": source,
+                "arrays": offsets,
+                "interners": {
+                    name: value.values
+                    for name, value in vars(self).items()
+                    if isinstance(value, _Interner)
+                },
+                "calendar": self.calendar,
+                "frequencies": self.frequencies,
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        # 配列の位置を _ITEM_SIZE の倍数にそろえる
+        start = len(MAGIC) + _META_LENGTH.size + len(meta)
+        padding = -start % _ITEM_SIZE
+        temporary = Path(f"{path}.{os.getpid()}.tmp")
+        with temporary.open("wb") as f:
+            f.write(MAGIC + _META_LENGTH.pack(len(meta)) + meta + b"\0" * padding)
+            for values in arrays.values():
+                f.write(values if isinstance(values, array) else values.tobytes())
+        temporary.replace(path)
+
+    @classmethod
+    def open(cls, path: str | Path, source: tuple | None = None) -> "Timetable | None":
+        # save() したファイルを mmap する。source が保存時と違えば None
+        with Path(path).open("rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (length,) = _META_LENGTH.unpack(f.read(_META_LENGTH.size))
+            meta = pickle.loads(f.read(length))  # noqa: S301
+            if meta["source"] != source:
+                return None
+            start = f.tell()
+            start += -start % _ITEM_SIZE
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        timetable = cls()
+        view = memoryview(data)
+        for name, (offset, count) in meta["arrays"].items():
+            begin = start + offset
+            setattr(
+                timetable,
+                name,
+                view[begin : begin + count * _ITEM_SIZE].cast("i"),
+            )
+        for name, values in meta["interners"].items():
+            setattr(timetable, name, _Interner(values))
+        timetable.calendar = meta["calendar"]
+        timetable.frequencies = meta["frequencies"]
+        return timetable
+
+    @classmethod
+    def load_shared(cls, db_path: str, cache_path: str | Path) -> "Timetable":
+        """
+        cache_path に保存した時刻表を開く。なければ (DB が変わっていれば) 作って保存する。
+
+        複数のワーカーが同時に起動しても作るのは 1 つだけで、ほかはそれを待って開く。
+        """
+        stat = Path(db_path).stat()
+        source = (str(db_path), stat.st_size, stat.st_mtime_ns)
+        with Path(f"{cache_path}.lock").open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                timetable = cls.open(cache_path, source)
+            except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+                timetable = None
+            if timetable is None:
+                cls.load(db_path).save(cache_path, source)
+                timetable = cls.open(cache_path, source)
+        return timetable
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        self._load_entities(conn)
+        self._load_calendar(conn)
+        self._load_stop_times(conn)
+
+    def _load_entities(self, conn: sqlite3.Connection) -> None:
+        strings = self.strings
+        for stop_id, stop_name in conn.execute("SELECT stop_id, stop_name FROM stops"):
+            self.stops(stop_id)
+            self.stop_names.append(strings(stop_name))
+
+        for route_id, short_name, long_name in conn.execute(
+            "SELECT route_id, route_short_name, route_long_name FROM routes",
+        ):
+            self.routes(route_id)
+            self.route_short_names.append(strings(short_name))
+            self.route_long_names.append(strings(long_name))
+
+        for trip_id, route_id, service_id in conn.execute(
+            "SELECT trip_id, route_id, service_id FROM trips",
+        ):
+            self.trips(trip_id)
+            route = self.routes.get(route_id)
+            self.trip_routes.append(-1 if route is None else route)
+            self.trip_services.append(self.services(service_id))
+
+    def _load_calendar(self, conn: sqlite3.Connection) -> None:
+        self.calendar = ServiceCalendar.build(
+            conn.execute(
+                f"SELECT service_id, {', '.join(WEEKDAYS)}, start_date, end_date "
+                "FROM calendar",
+            ),
+            conn.execute("SELECT service_id, date, exception_type FROM calendar_dates"),
+        )
+        self.day_services = {}
+
+    def _load_stop_times(self, conn: sqlite3.Connection) -> None:
+        strings = self.strings
+        trip_index = self.trips.get
+        stop_index = self.stops.get
+        for (
+            trip_id,
+            stop_id,
+            stop_sequence,
+            departure_time,
+            departure_secs,
+            headsign,
+        ) in conn.execute(
+            "SELECT trip_id, stop_id, stop_sequence, departure_time, departure_secs, "
+            "stop_headsign FROM stop_times",
+        ):
+            trip = trip_index(trip_id)
+            stop = stop_index(stop_id)
+            if trip is None or stop is None:
+                # SQL 側の内部結合で落ちる行
+                continue
+            self.st_trip.append(trip)
+            self.st_stop.append(stop)
+            self.st_sequence.append(stop_sequence)
+            self.st_departure_secs.append(
+                -1 if departure_secs is None else departure_secs,
+            )
+            self.st_departure_time.append(strings(departure_time))
+            self.st_headsign.append(strings(headsign))
+
+    def _build_indexes(self, frequencies: list[tuple]) -> None:
+        rows = range(len(self.st_trip))
+        st_stop, st_secs, st_trip, st_sequence = (
+            self.st_stop,
+            self.st_departure_secs,
+            self.st_trip,
+            self.st_sequence,
+        )
+        # frequencies.txt の便の行は雛形なので発車の索引に入れない
+        frequent = {
+            trip
+            for trip in map(self.trips.get, {row[0] for row in frequencies})
+            if trip is not None
+        }
+
+        departures = sorted(
+            (row for row in rows if st_secs[row] >= 0 and st_trip[row] not in frequent),
+            key=lambda row: (st_stop[row], st_secs[row]),
+        )
+        self.dep_rows = array("i", departures)
+        self.dep_secs = array("i", (st_secs[row] for row in departures))
+        self.dep_offsets = self._offsets(
+            len(self.stops.values),
+            (st_stop[row] for row in departures),
+        )
+
+        patterns = sorted(rows, key=lambda row: (st_trip[row], st_sequence[row]))
+        self.pattern_rows = array("i", patterns)
+        self.trip_offsets = self._offsets(
+            len(self.trips.values),
+            (st_trip[row] for row in patterns),
+        )
+        self.frequencies = FrequencyIndex.build(
+            frequencies,
+            (
+                self._row(row)
+                for trip in sorted(frequent)
+                if self.trip_routes[trip] >= 0
+                for row in self.pattern_rows[
+                    self.trip_offsets[trip] : self.trip_offsets[trip + 1]
+                ]
+                if st_secs[row] >= 0
+            ),
+        )
+
+    @staticmethod
+    def _offsets(count: int, keys: Iterable[int]) -> array:
+        # 並べ替え済みのキー列から CSR のオフセットを作る
+        counts = [0] * (count + 1)
+        for key in keys:
+            counts[key + 1] += 1
+        for i in range(count):
+            counts[i + 1] += counts[i]
+        return array("i", counts)
+
+    def active_services(self, target_date: datetime.datetime) -> frozenset[int]:
+        day = self.calendar.day_index(target_date)
+        if not 0 <= day < self.calendar.days:
+            return frozenset()
+        services = self.day_services.get(day)
+        if services is None:
+            # 便のないサービスには番号がないので除く。問い合わせで番号は増やさない
+            services = frozenset(
+                number
+                for service_id in self.calendar.active(target_date)
+                if (number := self.services.get(service_id)) is not None
+            )
+            self.day_services[day] = services
+        return services
+
+    def _window(
+        self,
+        stop: int,
+        start_secs: int,
+        stop_secs: int,
+        services: frozenset[int],
+        shift: int = 0,
+    ) -> Iterator[tuple[int, int]]:
+        # 発車秒に shift を足した (target_date の時刻での秒, 行) を発車順に返す
+        begin, end = self.dep_offsets[stop], self.dep_offsets[stop + 1]
+        lo = bisect_left(self.dep_secs, start_secs - shift, begin, end)
+        hi = bisect_right(self.dep_secs, stop_secs - shift, lo, end)
+        dep_rows, dep_secs = self.dep_rows, self.dep_secs
+        trip_services, trip_routes, st_trip = (
+            self.trip_services,
+            self.trip_routes,
+            self.st_trip,
+        )
+        for i in range(lo, hi):
+            trip = st_trip[dep_rows[i]]
+            if trip_services[trip] in services and trip_routes[trip] >= 0:
+                yield dep_secs[i] + shift, dep_rows[i]
+
+    def _row(self, row: int) -> tuple:
+        # lib.static の _departures_query と同じ列の並び
+        strings = self.strings.values
+        trip = self.st_trip[row]
+        route = self.trip_routes[trip]
+        stop = self.st_stop[row]
+        return (
+            self.trips.values[trip],
+            self.routes.values[route],
+            self.services.values[self.trip_services[trip]],
+            strings[self.route_short_names[route]],
+            strings[self.route_long_names[route]],
+            strings[self.st_departure_time[row]],
+            self.stops.values[stop],
+            strings[self.st_headsign[row]],
+            strings[self.stop_names[stop]],
+            self.st_departure_secs[row],
+        )
+
+    def get_bus_schedule_flexible(
+        self,
+        stop_ids: list,
+        target_date: datetime.datetime,
+        limit: int = 100,
+        start_time: str | None = "00:00:00",
+        stop_time: str | None = "23:59:59",
+    ) -> dict[str, dict[str, list[dict]]]:
+        start_secs, stop_secs = window_secs(start_time, stop_time)
+        stops = [
+            stop
+            for stop in map(self.stops.get, dict.fromkeys(stop_ids))
+            if stop is not None
+        ]
+        days = service_days(target_date, stop_secs)
+        windows = [
+            self._window(stop, start_secs, stop_secs, self.active_services(day), shift)
+            for day, shift in days
+            for stop in stops
+        ]
+        if self.frequencies:
+            # 頻度ベースの便は展開済みの行 (tuple) で併合する
+            windows.extend(
+                self.frequencies.departures(
+                    stop_ids,
+                    self.calendar.active(day),
+                    start_secs,
+                    stop_secs,
+                    shift,
+                    limit,
+                )
+                for day, shift in days
+            )
+        merged = islice(heapq.merge(*windows, key=itemgetter(0)), limit)
+        return group_by_trip(
+            (
+                (secs, row if isinstance(row, tuple) else self._row(row))
+                for secs, row in merged
+            ),
+            target_date,
+        )
+
+    def patterns(self, trip_ids: Iterable[str]) -> dict[str, TripPattern]:
+        # TripPatternCache.get() と同じ形の停車順
+        result = {}
+        stops, st_stop, st_sequence = self.stops.values, self.st_stop, self.st_sequence
+        for trip_id in trip_ids:
+            # 頻度ベースの便の 1 本は元の便の停車順
+            trip = self.trips.get(base_trip_id(trip_id))
+            if trip is None:
+                continue
+            rows = self.pattern_rows[
+                self.trip_offsets[trip] : self.trip_offsets[trip + 1]
+            ]
+            result[trip_id] = tuple(
+                (st_sequence[row], stops[st_stop[row]]) for row in rows
+            )
+        return result
+
+    def memory_usage(self) -> int:
+        # 保持している配列・リスト・文字列のおおよそのバイト数。mmap した配列は含めない
+        total = 0
+        for value in vars(self).values():
+            if isinstance(value, array | list):
+                total += sys.getsizeof(value)
+            elif isinstance(value, _Interner):
+                total += sys.getsizeof(value.values) + sys.getsizeof(value._index)  # noqa: SLF001
+                total += sum(sys.getsizeof(string) for string in value.values)
+            elif isinstance(value, dict):
+                total += sys.getsizeof(value)
+        return total
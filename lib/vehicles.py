@@ -0,0 +1,155 @@
+from collections import defaultdict
+from collections.abc import Collection, Iterable
+from typing import NamedTuple
+
+from google.transit import gtfs_realtime_pb2
+
+from .feeds import namespaced, run_trip_ids
+from .geo import GridIndex
+
+# current_status の列挙値 -> 名前。未設定なら仕様どおり IN_TRANSIT_TO とみなす
+_VEHICLE_STATUSES = {
+    value: name
+    for name, value in gtfs_realtime_pb2.VehiclePosition.VehicleStopStatus.items()
+}
+
+
+class VehiclePosition(NamedTuple):
+    vehicle_id: str | None
+    trip_id: str | None
+    route_id: str | None
+    latitude: float | None
+    longitude: float | None
+    bearing: float | None
+    speed: float | None
+    stop_id: str | None
+    # 停車中 (STOPPED_AT) の停留所か、次に向かっている停留所
+    current_stop_sequence: int | None
+    current_status: str
+    timestamp: int | None
+    start_time: str | None = None  # 便の始発時刻 (頻度ベースの便の 1 本を区別する)
+    start_date: str | None = None  # 便の運行日 (YYYYMMDD)
+
+
+class VehicleIndex:
+    """
+    VehiclePosition を trip_id・route_id・stop_id と位置で引けるようにした索引。
+
+    by_trip は run_trip_ids() のすべての trip_id で引ける。運行日まで合わせるなら
+    run_record() で引く。
+
+    位置は GridIndex のマスに分けて持ち、near() は周りのマスだけを調べる。
+    ポーリングのたびに作り直し、作った後は変更しない。
+    """
+
+    def __init__(self, positions: Iterable[VehiclePosition] = ()) -> None:
+        self.positions = tuple(positions)
+        self.by_trip: dict[str, VehiclePosition] = {}
+        by_route: defaultdict[str, list[VehiclePosition]] = defaultdict(list)
+        by_stop: defaultdict[str, list[VehiclePosition]] = defaultdict(list)
+        for position in self.positions:
+            if position.trip_id:
+                for key in run_trip_ids(
+                    position.trip_id,
+                    position.start_time,
+                    position.start_date,
+                ):
+                    self.by_trip[key] = position
+            if position.route_id:
+                by_route[position.route_id].append(position)
+            if position.stop_id:
+                by_stop[position.stop_id].append(position)
+        self.by_route = dict(by_route)
+        self.by_stop = dict(by_stop)
+        self.grid = GridIndex(
+            (position.latitude, position.longitude, position)
+            for position in self.positions
+            if position.latitude is not None and position.longitude is not None
+        )
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def near(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_meters: float,
+    ) -> list[tuple[float, VehiclePosition]]:
+        # radius_meters 以内の車両を (距離, 位置) の近い順で返す
+        return self.grid.near(latitude, longitude, radius_meters)
+
+    def find(
+        self,
+        route_ids: Collection[str] | None = None,
+        stop_ids: Collection[str] | None = None,
+        near: tuple[float, float, float] | None = None,
+    ) -> list[tuple[float | None, VehiclePosition]]:
+        """
+        route_ids・stop_ids・near (緯度, 経度, 半径 m) の指定したものすべてに当てはまる車両。
+
+        near があれば near() と同じく (距離, 位置) の近い順に、なければ距離を None として
+        索引の順に返す。最初の候補は指定のある索引から取り、残りの条件で絞る。
+        """
+        if near is not None:
+            found: list[tuple[float | None, VehiclePosition]] = list(self.near(*near))
+        elif route_ids is not None:
+            found = [
+                (None, position)
+                for route_id in dict.fromkeys(route_ids)
+                for position in self.by_route.get(route_id, ())
+            ]
+        elif stop_ids is not None:
+            found = [
+                (None, position)
+                for stop_id in dict.fromkeys(stop_ids)
+                for position in self.by_stop.get(stop_id, ())
+            ]
+        else:
+            found = [(None, position) for position in self.positions]
+        return [
+            (distance, position)
+            for distance, position in found
+            if (route_ids is None or position.route_id in route_ids)
+            and (stop_ids is None or position.stop_id in stop_ids)
+        ]
+
+
+def _vehicle_position(
+    vehicle: gtfs_realtime_pb2.VehiclePosition,
+    namespace: str = "",
+) -> VehiclePosition:
+    trip = vehicle.trip
+    position = vehicle.position if vehicle.HasField("position") else None
+    return VehiclePosition(
+        vehicle.vehicle.id if vehicle.vehicle.HasField("id") else None,
+        namespaced(namespace, trip.trip_id) if trip.HasField("trip_id") else None,
+        namespaced(namespace, trip.route_id) if trip.HasField("route_id") else None,
+        position.latitude if position is not None else None,
+        position.longitude if position is not None else None,
+        position.bearing
+        if position is not None and position.HasField("bearing")
+        else None,
+        position.speed if position is not None and position.HasField("speed") else None,
+        namespaced(namespace, vehicle.stop_id) if vehicle.HasField("stop_id") else None,
+        vehicle.current_stop_sequence
+        if vehicle.HasField("current_stop_sequence")
+        else None,
+        _VEHICLE_STATUSES[vehicle.current_status]
+        if vehicle.HasField("current_status")
+        else "IN_TRANSIT_TO",
+        vehicle.timestamp if vehicle.HasField("timestamp") else None,
+        trip.start_time if trip.HasField("start_time") else None,
+        trip.start_date if trip.HasField("start_date") else None,
+    )
+
+
+def parse_vehicle_positions(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    namespace: str = "",
+) -> list[VehiclePosition]:
+    return [
+        _vehicle_position(entity.vehicle, namespace)
+        for entity in feed.entity
+        if entity.HasField("vehicle")
+    ]
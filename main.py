@@ -1,66 +1,746 @@
-import dotenv
-import os
+import asyncio
+import contextlib
 import datetime
+import hashlib
+import json
+import os
+import re
+import time
+from collections.abc import AsyncIterator, Callable, Iterator, Mapping
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import replace
+from http import HTTPStatus
+from typing import Annotated
 
-from lib.dynamic import (
-    download_dynamic_files,
-    parse_gtfs_realtime,
+import dotenv
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import (
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
 )
-from lib.static import get_bus_schedule_flexible
-from lib.merger import merge_gtfs_realtime
-
-from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
 
-app = FastAPI()
+from lib.archive import SnapshotArchive
+from lib.boards import Board, CachedResponse, ResponseCache, load_boards
+from lib.feeds import AGENCY_TIMEZONE, load_feeds
+from lib.journey import MAX_ROUNDS, journey_planners
+from lib.merger import merge_gtfs_realtime, vehicle_dict
+from lib.metrics import REGISTRY, Counter, Gauge, MetricsMiddleware, timed
+from lib.poller import DEFAULT_INTERVAL, RealtimePoller
+from lib.services import service_calendars
+from lib.shared import SharedRealtime
+from lib.static import (
+    TripPattern,
+    departure_boards,
+    frequency_indexes,
+    time_to_secs,
+    trip_patterns,
+)
+from lib.stops import StopIndex, stop_indexes
+from lib.store import StaticStore, session_generation
+from lib.stream import BoardChannel
+from lib.timetable import Timetable
 
 dotenv.load_dotenv()
-GTFS_DYNAMIC_URL = os.getenv("GTFS_DYNAMIC_URL")
+GTFS_DYNAMIC_INTERVAL = float(os.getenv("GTFS_DYNAMIC_INTERVAL", DEFAULT_INTERVAL))
+DATABASE_PATH = os.getenv("DATABASE_PATH", "nowhere.db")
+# "sql" は SQLite に問い合わせ、"memory" は起動時に時刻表をメモリへ読み込む
+TIMETABLE_ENGINE = os.getenv("TIMETABLE_ENGINE", "sql")
+# 1 にすると各リクエストの区間ごとの時間を Server-Timing ヘッダで返す
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS") == "1"
+# 指定すると取得した Realtime を日付ごとのファイルに保存する (tools.replay_archive で再生)
+REALTIME_ARCHIVE_DIR = os.getenv("REALTIME_ARCHIVE_DIR")
+# 指定すると同じホストのワーカーで Realtime の取得とスナップショットを共有する
+# (フィードを取得するのは 1 プロセスだけで、ほかはこのファイルを mmap して読む)
+SHARED_SNAPSHOT_PATH = os.getenv("SHARED_SNAPSHOT_PATH")
+# /api/stops/nearby と /api/departures/nearby の半径の上限 (m)
+MAX_NEARBY_RADIUS = 3000
+# from= の書式と、受け付ける時の上限 (運行日の翌日の深夜まで)
+FROM_TIME_PATTERN = re.compile(
+    r"(?P<hours>\d{1,2}):(?P<minutes>\d{2})(?::(?P<seconds>\d{2}))?",
+)
+MAX_FROM_HOURS = 47
 
+# FEEDS_PATH がなければ GTFS_STATIC_URL と GTFS_DYNAMIC_URL の 1 組だけを使う
+feeds = load_feeds(os.getenv("FEEDS_PATH"))
+poller = RealtimePoller(
+    feeds.values(),
+    interval=GTFS_DYNAMIC_INTERVAL,
+    archive=SnapshotArchive(REALTIME_ARCHIVE_DIR) if REALTIME_ARCHIVE_DIR else None,
+)
+shared = SharedRealtime(poller, SHARED_SNAPSHOT_PATH) if SHARED_SNAPSHOT_PATH else None
+# 以降のリアルタイムの参照はすべてこちらを通す
+realtime: RealtimePoller | SharedRealtime = shared or poller
+boards = load_boards(os.getenv("BOARDS_PATH"))
+responses = ResponseCache()
+channels: dict[str, BoardChannel] = {}
 
-@app.get("/api/")
-async def api():
+board_errors = REGISTRY.register(
+    Counter("nowhere_board_errors_total", "Boards that failed to build."),
+)
+board_refreshes = REGISTRY.register(
+    Counter(
+        "nowhere_board_refreshes_total",
+        "Boards brought up to date with a new realtime snapshot "
+        "(reused, partial re-merge of changed trips, full rebuild).",
+        ("kind",),
+    ),
+)
+departure_rows = REGISTRY.register(
+    Counter("nowhere_departure_rows_total", "Scheduled departures put on boards."),
+)
+REGISTRY.register(
+    Counter(
+        "nowhere_cache_hits_total",
+        "Cache hits by cache.",
+        ("cache",),
+        function=lambda: {
+            ("departure_boards",): departure_boards.hits,
+            ("responses",): responses.hits,
+        },
+    ),
+)
+REGISTRY.register(
+    Counter(
+        "nowhere_cache_misses_total",
+        "Cache misses by cache.",
+        ("cache",),
+        function=lambda: {
+            ("departure_boards",): departure_boards.misses,
+            ("responses",): responses.misses,
+        },
+    ),
+)
+REGISTRY.register(
+    Gauge(
+        "nowhere_feed_freshness_seconds",
+        "Realtime snapshot freshness: feed header timestamp, fetch time and age.",
+        ("kind",),
+        function=lambda: {
+            ("feed_timestamp",): realtime.snapshot.feed_timestamp,
+            ("fetched_at",): realtime.snapshot.fetched_at,
+            ("age",): time.time() - realtime.snapshot.feed_timestamp
+            if realtime.snapshot.feed_timestamp
+            else 0,
+        },
+    ),
+)
+REGISTRY.register(
+    Gauge(
+        "nowhere_realtime_snapshot",
+        "Published realtime snapshot version and number of trips in it.",
+        ("kind",),
+        function=lambda: {
+            ("version",): realtime.snapshot.version,
+            ("trips",): len(realtime.snapshot.realtime.trips),
+        },
+    ),
+)
+REGISTRY.register(
+    Gauge(
+        "nowhere_feed_timestamp_seconds",
+        "Header timestamp of the last realtime update applied from each feed.",
+        ("feed", "source"),
+        function=lambda: {
+            source: feed_timestamp
+            for source, (feed_timestamp, _) in realtime.feed_timestamps().items()
+        },
+    ),
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    store = StaticStore(DATABASE_PATH)
+    # 差し替えで変わったテーブルを読んでいるキャッシュだけを捨てる
+    store.on_swap(service_calendars.invalidate, service_calendars.tables)
+    store.on_swap(departure_boards.invalidate, departure_boards.tables)
+    store.on_swap(trip_patterns.invalidate, trip_patterns.tables)
+    store.on_swap(responses.invalidate, departure_boards.tables)
+    store.on_swap(stop_indexes.invalidate, stop_indexes.tables)
+    store.on_swap(frequency_indexes.invalidate, frequency_indexes.tables)
+    app.state.store = store
+    # 運行表は最初のリクエストを待たずに作っておく
+    await asyncio.to_thread(_warm_service_calendar, store)
+    await asyncio.to_thread(_warm_stop_index, store)
+    # 経路検索はどちらのエンジンでも配列の時刻表を使うので、ここで読み込んでおく
+    app.state.journey_timetable = await asyncio.to_thread(_load_timetable)
+    app.state.timetable = (
+        app.state.journey_timetable if TIMETABLE_ENGINE == "memory" else None
+    )
+    store.on_rebuild(_rebuild_timetable, Timetable.tables)
+    await asyncio.to_thread(_warm_journey_planner, store)
+    # 経路検索は読み込み直した時刻表から作り直す
+    store.on_swap(journey_planners.invalidate, journey_planners.tables)
+    # 差し替えの検知と作り直しはリクエストとは別のタスクで行う
+    store.start()
+    if shared is not None:
+        shared.start(_prebuild_boards)
+    else:
+        poller.start()
+    yield
+    if shared is not None:
+        await shared.stop()
+    else:
+        await poller.stop()
+    await store.stop()
+    store.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, trace=TRACE_REQUESTS)
+
+
+def _warm_service_calendar(store: StaticStore) -> None:
+    with store.session() as session:
+        calendar = service_calendars.get(session)
+    print(  # noqa: T201
+        f"Built service calendar: {len(calendar.bits)} services, "
+        f"{calendar.days} days from {calendar.first_date:%Y%m%d}",
+    )
+
+
+def _warm_stop_index(store: StaticStore) -> None:
+    with store.session() as session:
+        index = stop_indexes.get(session)
+    print(f"Built stop index: {len(index)} stops in {len(index.groups)} groups")  # noqa: T201
+
+
+def _load_timetable() -> Timetable:
+    with timed("timetable_load"):
+        # ワーカーで共有するなら配列はファイルに保存したものを mmap する
+        timetable = (
+            Timetable.load_shared(DATABASE_PATH, f"{SHARED_SNAPSHOT_PATH}.timetable")
+            if SHARED_SNAPSHOT_PATH
+            else Timetable.load(DATABASE_PATH)
+        )
+    print(  # noqa: T201
+        f"Loaded timetable into memory: {len(timetable.st_trip)} stop times, "
+        f"{timetable.memory_usage() / 2**20:.1f} MiB",
+    )
+    return timetable
+
+
+def _warm_journey_planner(store: StaticStore) -> None:
+    with store.session() as session:
+        journey_planners.get(
+            session,
+            lambda: app.state.journey_timetable,
+            stop_indexes.get(session),
+        )
+
+
+def _rebuild_timetable() -> Callable[[], None]:
+    # 読み込む間は古い時刻表で答え、公開時に参照だけを入れ替える
+    timetable = _load_timetable()
+
+    def publish() -> None:
+        app.state.journey_timetable = timetable
+        if TIMETABLE_ENGINE == "memory":
+            app.state.timetable = timetable
+
+    return publish
+
+
+def get_session(request: Request) -> Iterator[Session]:
+    with request.app.state.store.session() as session:
+        yield session
+
+
+def _hhmmss(secs: int) -> str:
+    # get_bus_schedule_flexible に渡す時刻。24 時を超えても折り返さない
+    hours, rest = divmod(secs, 3600)
+    return f"{hours:02d}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def _window(
+    date: str | None,
+    from_time: str | None,
+    now: datetime.datetime | None = None,
+) -> tuple[datetime.datetime, int]:
+    # 指定がなければ事業者のタイムゾーンでの現在時刻。分単位に丸めてキャッシュを共有する
+    now = now or datetime.datetime.now(AGENCY_TIMEZONE)
     try:
-        eng = create_engine("sqlite:///nowhere.db")
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=eng)
-        download_dynamic_files(
-            GTFS_DYNAMIC_URL,
-            "trip_updates.bin",
+        target_date = (
+            datetime.datetime.strptime(date, "%Y%m%d").replace(tzinfo=AGENCY_TIMEZONE)
+            if date
+            else now.replace(hour=0, minute=0, second=0, microsecond=0)
+        )
+    except ValueError as e:
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            f"Invalid date: {date!r} (expected YYYYMMDD)",
+        ) from e
+    if not from_time:
+        return target_date, now.hour * 3600 + now.minute * 60
+    # 運行日の時刻なので 24 時以降 (翌日の深夜) も受け付ける
+    match = FROM_TIME_PATTERN.fullmatch(from_time)
+    if match is None or not (
+        int(match["hours"]) <= MAX_FROM_HOURS
+        and int(match["minutes"]) < 60  # noqa: PLR2004
+        and int(match["seconds"] or 0) < 60  # noqa: PLR2004
+    ):
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            f"Invalid from: {from_time!r} (expected HH:MM or HH:MM:SS, "
+            f"up to {MAX_FROM_HOURS}:59:59)",
         )
-        with SessionLocal() as session:
-            dynamic_data = parse_gtfs_realtime("trip_updates.bin")
-            static_data = get_bus_schedule_flexible(
-                session,
-                stop_ids=[
-                    "22030 1",
-                    "22030 2",
-                    "22030 52",
-                    "24140 1",
-                    "24140 2",
-                ],
-                target_date=datetime.datetime(2025, 10, 22),  # noqa: DTZ001
-                start_time="21:15:00",
-                stop_time="22:00:00",
-                limit=50,
+    return target_date, time_to_secs(
+        f"{match['hours']}:{match['minutes']}:{match['seconds'] or 0}",
+    )
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    )
+
+
+def _static_board(
+    session: Session,
+    board: Board,
+    target_date: datetime.datetime,
+    start_secs: int,
+) -> tuple[dict, Mapping[str, TripPattern]]:
+    window = {
+        "stop_ids": list(board.stop_ids),
+        "target_date": target_date,
+        "start_time": _hhmmss(start_secs),
+        "stop_time": _hhmmss(start_secs + board.minutes * 60),
+        "limit": board.limit,
+    }
+    timetable: Timetable | None = app.state.timetable
+    if timetable is not None:
+        with timed("query"):
+            static_data = timetable.get_bus_schedule_flexible(**window)
+        with timed("patterns"):
+            patterns = timetable.patterns(static_data)
+    else:
+        with timed("query"):
+            static_data = departure_boards.get(session, **window)
+        with timed("patterns"):
+            patterns = trip_patterns.get(session, static_data)
+    departure_rows.inc(sum(len(trip["stops"]) for trip in static_data.values()))
+    return static_data, patterns
+
+
+def _encode_board(
+    version: int,
+    static_data: dict,
+    patterns: Mapping[str, TripPattern],
+    result: dict,
+) -> CachedResponse:
+    with timed("encode"):
+        body = json.dumps(
+            {"status": True, "message": "Success", "result": result},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'  # noqa: S324
+    return CachedResponse(etag, body, version, static_data, patterns, result)
+
+
+def _board_key(
+    board: Board,
+    target_date: datetime.datetime,
+    start_secs: int,
+) -> tuple[Board, str, int]:
+    return (board, target_date.strftime("%Y%m%d"), start_secs)
+
+
+def _cached_board(
+    session: Session,
+    board: Board,
+    target_date: datetime.datetime,
+    start_secs: int,
+) -> CachedResponse:
+    """
+    掲示板を組み立てて返す。組み立て済みのものがあればリアルタイムの差分だけ反映する。
+
+    前に組み立てた版から変わった便が掲示板になければそのまま使い、あればその便だけを
+    マージし直す。差分がわからない (履歴より古い) 場合は最初から組み立てる。
+    """
+    snapshot = realtime.snapshot
+    generation = session_generation(session)
+    key = _board_key(board, target_date, start_secs)
+    cached = responses.get(key)
+    if cached is not None and cached.version == snapshot.version:
+        return cached
+
+    changed = realtime.changes_since(cached.version) if cached is not None else None
+    if cached is not None and changed is not None:
+        touched = changed & cached.static_data.keys()
+        if not touched:
+            board_refreshes.inc(labels=("reused",))
+            return responses.put(
+                key,
+                replace(cached, version=snapshot.version),
+                generation,
             )
-            merged_result = merge_gtfs_realtime(
-                static_data,
-                dynamic_data,
+        with timed("merge"):
+            result = dict(cached.result)
+            result.update(
+                merge_gtfs_realtime(
+                    {trip_id: cached.static_data[trip_id] for trip_id in touched},
+                    snapshot.realtime,
+                    cached.patterns,
+                ),
             )
-            return {
-                "status": True,
-                "message": "Success",
-                "result": merged_result,
-            }
-    except Exception as e:
-        return {
-            "status": False,
-            "message": str(e),
-            "result": {},
+        board_refreshes.inc(labels=("partial",))
+        return responses.put(
+            key,
+            _encode_board(
+                snapshot.version,
+                cached.static_data,
+                cached.patterns,
+                result,
+            ),
+            generation,
+        )
+
+    static_data, patterns = _static_board(session, board, target_date, start_secs)
+    with timed("merge"):
+        result = merge_gtfs_realtime(static_data, snapshot.realtime, patterns)
+    board_refreshes.inc(labels=("full",))
+    return responses.put(
+        key,
+        _encode_board(snapshot.version, static_data, patterns, result),
+        generation,
+    )
+
+
+def _prebuild_boards() -> dict[tuple[Board, str, int], CachedResponse]:
+    # 設定した掲示板を、いまの分と次の分の分だけ組み立てて共有スナップショットに載せる
+    now = datetime.datetime.now(AGENCY_TIMEZONE)
+    built = {}
+    with app.state.store.session() as session:
+        for board in boards.values():
+            for moment in (now, now + datetime.timedelta(minutes=1)):
+                target_date, start_secs = _window(None, None, moment)
+                key = _board_key(board, target_date, start_secs)
+                try:
+                    built[key] = _cached_board(session, board, target_date, start_secs)
+                except Exception as e:  # noqa: BLE001
+                    board_errors.inc()
+                    print(f"Error building board {board}: {e!r}")  # noqa: T201
+    return built
+
+
+def _departures_response(
+    request: Request,
+    session: Session,
+    board: Board,
+    target_date: datetime.datetime,
+    start_secs: int,
+) -> Response:
+    try:
+        # 共有スナップショットの書き手が組み立てておいたものがあればそれを返す
+        cached = (
+            shared.response(_board_key(board, target_date, start_secs))
+            if shared is not None
+            else None
+        ) or _cached_board(session, board, target_date, start_secs)
+    except Exception as e:  # noqa: BLE001
+        # 失敗した結果はキャッシュしない
+        board_errors.inc()
+        print(f"Error building board {board}: {e!r}")  # noqa: T201
+        return Response(
+            json.dumps({"status": False, "message": str(e), "result": {}}),
+            media_type="application/json",
+        )
+
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if _not_modified(request, cached.etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+# DB を読む同期処理はイベントループを止めないよう def のままにしてスレッドプールで動かす
+@app.get("/api/boards/{board_id}")
+def api_board(
+    board_id: str,
+    request: Request,
+    session: Annotated[Session, Depends(get_session)],
+    date: Annotated[str | None, Query(pattern=r"^\d{8}$")] = None,
+    from_time: Annotated[str | None, Query(alias="from")] = None,
+) -> Response:
+    board = boards.get(board_id)
+    if board is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown board: {board_id}")
+    target_date, start_secs = _window(date, from_time)
+    return _departures_response(request, session, board, target_date, start_secs)
+
+
+@app.get("/api/departures")
+def api_departures(
+    *,
+    request: Request,
+    session: Annotated[Session, Depends(get_session)],
+    stop_id: Annotated[list[str], Query(min_length=1)],
+    date: Annotated[str | None, Query(pattern=r"^\d{8}$")] = None,
+    from_time: Annotated[str | None, Query(alias="from")] = None,
+    minutes: Annotated[int, Query(gt=0, le=24 * 60)] = Board.minutes,
+    limit: Annotated[int, Query(gt=0, le=1000)] = Board.limit,
+) -> Response:
+    board = Board(stop_ids=tuple(sorted(set(stop_id))), minutes=minutes, limit=limit)
+    target_date, start_secs = _window(date, from_time)
+    return _departures_response(request, session, board, target_date, start_secs)
+
+
+@app.get("/api/stops/nearby")
+def api_stops_nearby(
+    session: Annotated[Session, Depends(get_session)],
+    lat: Annotated[float, Query(ge=-90, le=90)],
+    lon: Annotated[float, Query(ge=-180, le=180)],
+    radius: Annotated[float, Query(gt=0, le=MAX_NEARBY_RADIUS)] = 500,
+    stops: Annotated[int, Query(gt=0, le=100)] = 10,
+) -> Response:
+    # 近い順に停留所とそののりば。距離はいちばん近いのりばまで (m)
+    with timed("stops"):
+        found = stop_indexes.get(session).near(lat, lon, radius, stops)
+    result = [
+        {
+            "group": group.group,
+            "name": group.name,
+            "distance": round(distance),
+            "stops": [
+                {
+                    "stop_id": stop.stop_id,
+                    "stop_name": stop.stop_name,
+                    "lat": stop.latitude,
+                    "lon": stop.longitude,
+                }
+                for stop in group.stops
+            ],
+        }
+        for distance, group in found
+    ]
+    return Response(
+        json.dumps(
+            {"status": True, "message": "Success", "result": result},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ),
+        media_type="application/json",
+    )
+
+
+@app.get("/api/vehicles")
+def api_vehicles(
+    *,
+    route_id: Annotated[list[str] | None, Query()] = None,
+    stop_id: Annotated[list[str] | None, Query()] = None,
+    lat: Annotated[float | None, Query(ge=-90, le=90)] = None,
+    lon: Annotated[float | None, Query(ge=-180, le=180)] = None,
+    radius: Annotated[float, Query(gt=0, le=MAX_NEARBY_RADIUS)] = 500,
+) -> Response:
+    # 車両の位置。route_id・stop_id・lat と lon を指定すれば、そのすべてに当てはまるもの。
+    # lat と lon があれば近い順に距離 (m) を付ける
+    if (lat is None) != (lon is None):
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            "Specify both lat and lon, or neither",
+        )
+    vehicles = realtime.snapshot.realtime.vehicles
+    with timed("vehicles"):
+        found = vehicles.find(
+            route_ids=route_id,
+            stop_ids=stop_id,
+            near=(lat, lon, radius) if lat is not None else None,
+        )
+    result = [
+        {
+            **({"distance": round(distance)} if distance is not None else {}),
+            "trip_id": position.trip_id,
+            "route_id": position.route_id,
+            **vehicle_dict(position),
         }
+        for distance, position in found
+    ]
+    return Response(
+        json.dumps(
+            {"status": True, "message": "Success", "result": result},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ),
+        media_type="application/json",
+    )
+
+
+@app.get("/api/departures/nearby")
+def api_departures_nearby(
+    *,
+    request: Request,
+    session: Annotated[Session, Depends(get_session)],
+    lat: Annotated[float, Query(ge=-90, le=90)],
+    lon: Annotated[float, Query(ge=-180, le=180)],
+    radius: Annotated[float, Query(gt=0, le=MAX_NEARBY_RADIUS)] = 500,
+    stops: Annotated[int, Query(gt=0, le=100)] = 10,
+    date: Annotated[str | None, Query(pattern=r"^\d{8}$")] = None,
+    from_time: Annotated[str | None, Query(alias="from")] = None,
+    minutes: Annotated[int, Query(gt=0, le=24 * 60)] = Board.minutes,
+    limit: Annotated[int, Query(gt=0, le=1000)] = Board.limit,
+) -> Response:
+    # 近くの停留所 (stops 件まで) の全のりばを 1 つの掲示板にする。
+    # のりばの組が同じなら別の地点からの要求とも掲示板のキャッシュを共有する
+    with timed("stops"):
+        found = stop_indexes.get(session).near(lat, lon, radius, stops)
+    if not found:
+        return Response(
+            json.dumps({"status": True, "message": "No stops nearby", "result": {}}),
+            media_type="application/json",
+        )
+    board = Board(
+        stop_ids=tuple(
+            sorted(stop.stop_id for _, group in found for stop in group.stops),
+        ),
+        minutes=minutes,
+        limit=limit,
+    )
+    target_date, start_secs = _window(date, from_time)
+    return _departures_response(request, session, board, target_date, start_secs)
+
+
+def _journey_stops(index: StopIndex, values: list[str]) -> list[str]:
+    # stop_id か停留所 (StopIndex のまとまり) のキー。停留所ならすべてののりば
+    stop_ids = []
+    for value in values:
+        group = index.groups.get(value)
+        if group is not None:
+            stop_ids.extend(stop.stop_id for stop in group.stops)
+        elif value in index.by_id:
+            stop_ids.append(value)
+        else:
+            raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown stop: {value}")
+    return stop_ids
+
+
+@app.get("/api/journeys")
+def api_journeys(
+    *,
+    session: Annotated[Session, Depends(get_session)],
+    origin: Annotated[list[str], Query(min_length=1)],
+    destination: Annotated[list[str], Query(min_length=1)],
+    date: Annotated[str | None, Query(pattern=r"^\d{8}$")] = None,
+    from_time: Annotated[str | None, Query(alias="from")] = None,
+    use_realtime: Annotated[bool, Query(alias="realtime")] = True,
+    transfers: Annotated[int, Query(ge=0, lt=MAX_ROUNDS)] = MAX_ROUNDS - 1,
+) -> Response:
+    # 乗り換えの回数ごとに、それより少ない乗り換えより早く着く経路を返す
+    index = stop_indexes.get(session)
+    origins = _journey_stops(index, origin)
+    destinations = _journey_stops(index, destination)
+    target_date, start_secs = _window(date, from_time)
+    with timed("journey_planner"):
+        planner = journey_planners.get(
+            session,
+            lambda: app.state.journey_timetable,
+            index,
+        )
+    with timed("journey"):
+        journeys = planner.plan(
+            planner.stop_numbers(origins),
+            planner.stop_numbers(destinations),
+            target_date,
+            start_secs,
+            realtime=realtime.snapshot.realtime if use_realtime else None,
+            max_rounds=transfers + 1,
+        )
+    result = {"journeys": [planner.describe(journey) for journey in journeys]}
+    return Response(
+        json.dumps(
+            {"status": True, "message": "Success", "result": result},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ),
+        media_type="application/json",
+    )
+
+
+@app.get("/api/")
+def api(
+    request: Request,
+    session: Annotated[Session, Depends(get_session)],
+) -> Response:
+    return api_board("default", request, session)
+
+
+def _channel(board_id: str) -> BoardChannel | None:
+    # 掲示板ごとにひとつのチャンネルを全クライアントで共有する
+    board = boards.get(board_id)
+    if board is None:
+        return None
+    channel = channels.get(board_id)
+    if channel is None:
+
+        def build() -> dict:
+            target_date, start_secs = _window(None, None)
+            with app.state.store.session() as session:
+                return _cached_board(session, board, target_date, start_secs).result
+
+        channel = channels[board_id] = BoardChannel(build, realtime.wait_for_update)
+    return channel
+
+
+@app.get("/api/boards/{board_id}/events")
+async def api_board_events(board_id: str, request: Request) -> StreamingResponse:
+    channel = _channel(board_id)
+    if channel is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown board: {board_id}")
+
+    async def events() -> AsyncIterator[str]:
+        async with aclosing(channel.subscribe()) as messages:
+            async for message in messages:
+                if await request.is_disconnected():
+                    break
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                event, data = message
+                yield f"event: {event}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.websocket("/api/boards/{board_id}/ws")
+async def api_board_ws(websocket: WebSocket, board_id: str) -> None:
+    channel = _channel(board_id)
+    if channel is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    with contextlib.suppress(WebSocketDisconnect):
+        async with aclosing(channel.subscribe()) as messages:
+            async for message in messages:
+                if message is not None:
+                    await websocket.send_text(message[1])
+
+
+@app.get("/metrics")
+def metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        REGISTRY.render(),
+        media_type="text/plain; version=0.0.4",
+    )
 
 
 @app.get("/")
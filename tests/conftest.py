@@ -0,0 +1,52 @@
+import datetime
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from lib.database import build_database
+from tools.synthetic_feed import TARGET_DATE, FeedConfig, write_static_zip
+
+ROOT = Path(__file__).resolve().parent.parent
+SCHEMA_PATH = str(ROOT / "lib" / "database.sql")
+
+# テスト用の小さな合成フィード。24 時を過ぎる便と frequencies.txt の便を含む
+FEED = FeedConfig(
+    routes=12,
+    stops=120,
+    stops_per_trip=30,
+    trips_per_route=40,
+    updates=200,
+    frequency_routes=2,
+)
+
+
+@pytest.fixture(scope="session")
+def target_date() -> datetime.datetime:
+    return datetime.datetime.combine(TARGET_DATE, datetime.time())
+
+
+@pytest.fixture(scope="session")
+def static_zip(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    return write_static_zip(FEED, tmp_path_factory.mktemp("feed") / "static.zip")
+
+
+@pytest.fixture(scope="session")
+def schema_path() -> str:
+    return SCHEMA_PATH
+
+
+@pytest.fixture(scope="session")
+def db_path(static_zip: Path, schema_path: str) -> str:
+    path = str(static_zip.parent / "nowhere.db")
+    build_database(str(static_zip), path, schema_path)
+    return path
+
+
+@pytest.fixture
+def session(db_path: str) -> Iterator[Session]:
+    session_factory = sessionmaker(bind=create_engine(f"sqlite:///{db_path}"))
+    with session_factory() as session:
+        yield session
@@ -0,0 +1,55 @@
+from google.transit import gtfs_realtime_pb2
+
+from lib.alerts import Alert, AlertIndex, parse_alerts
+
+
+def _alerts(
+    namespace: str,
+    *entities: dict[str, str],
+) -> list[Alert]:
+    # InformedEntity ごとに Alert を 1 つ。alert_id は 0 から順に振る
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    for number, fields in enumerate(entities):
+        alert = feed.entity.add(id=str(number)).alert
+        informed = alert.informed_entity.add()
+        for name, value in fields.items():
+            if name == "trip_id":
+                informed.trip.trip_id = value
+            else:
+                setattr(informed, name, value)
+    return parse_alerts(feed, namespace)
+
+
+def _ids(alerts: list[Alert]) -> list[str]:
+    return [alert.alert_id for alert in alerts]
+
+
+def test_trip_at_stop_alert_is_shown_at_that_stop() -> None:
+    index = AlertIndex(_alerts("", {"trip_id": "T1", "stop_id": "S1"}))
+    assert _ids(index.for_trip("T1", "R1", 0)) == []
+    assert _ids(index.for_stop("S1", "T1", "R1", 0)) == ["0"]
+    assert _ids(index.for_stop("S2", "T1", "R1", 0)) == []
+    assert _ids(index.for_stop("S1", "T2", "R1", 0)) == []
+
+
+def test_agency_alert_stays_in_its_feed() -> None:
+    index = AlertIndex(
+        [
+            *_alerts(
+                "feedA",
+                {"agency_id": "AG"},
+                {"agency_id": "AG", "stop_id": "S1"},
+            ),
+            *_alerts("feedB", {"route_id": "R1"}),
+        ],
+    )
+    assert _ids(index.for_trip("feedA:T1", "feedA:R1", 0)) == ["feedA:0"]
+    assert _ids(index.for_stop("feedA:S1", "feedA:T1", None, 0)) == ["feedA:1"]
+    assert _ids(index.for_trip("feedB:T1", "feedB:R1", 0)) == ["feedB:0"]
+    assert _ids(index.for_stop("feedA:S1", "feedB:T1", None, 0)) == []
+
+
+def test_agency_alert_applies_to_a_single_feed() -> None:
+    index = AlertIndex(_alerts("", {"agency_id": "AG"}))
+    assert _ids(index.for_trip("T1", None, 0)) == ["0"]
@@ -0,0 +1,126 @@
+import datetime
+import random
+import time
+from pathlib import Path
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from lib.archive import (
+    KEYFRAME_INTERVAL,
+    MAGIC,
+    RECORD_HEADER,
+    SnapshotArchive,
+    read_archive,
+)
+from lib.feeds import AGENCY_TIMEZONE
+from tools.replay_archive import replay
+from tools.synthetic_feed import TARGET_DATE, FeedConfig, make_trip_updates
+
+KEY = "/trip_updates"
+# frequencies.txt の便は 1 本ごとに trip_id が同じなので含めない
+FEED = FeedConfig(routes=12, stops=120, trips_per_route=40, updates=200)
+# 1 日分を 1 分ごとに取得したことにする
+POLLS = 24 * 60
+POLL_INTERVAL = 60
+# 再生にかかってよい秒数 (手元では 1 秒かからない)
+REPLAY_SECONDS = 5.0
+
+
+def _midnight() -> float:
+    return datetime.datetime.combine(
+        TARGET_DATE,
+        datetime.time(),
+        AGENCY_TIMEZONE,
+    ).timestamp()
+
+
+def _entities(content: bytes) -> dict[str, gtfs_realtime_pb2.FeedEntity]:
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(content)
+    return {entity.id: entity for entity in message.entity}
+
+
+@pytest.fixture(scope="module")
+def day(
+    tmp_path_factory: pytest.TempPathFactory,
+) -> tuple[Path, list[bytes], dict[str, int]]:
+    # (アーカイブ, 書いたフィード, 便ごとの最後の遅延)。取得ごとに 10 便の遅延が増える
+    message = make_trip_updates(FEED)
+    rng = random.Random(0)  # noqa: S311
+    archive = SnapshotArchive(tmp_path_factory.mktemp("archive"))
+    contents = []
+    for poll in range(POLLS):
+        for entity in rng.sample(list(message.entity), 10):
+            for update in entity.trip_update.stop_time_update:
+                update.departure.delay += 30
+        fetched_at = _midnight() + poll * POLL_INTERVAL
+        message.header.timestamp = int(fetched_at)
+        content = message.SerializeToString()
+        archive.append(KEY, fetched_at, content, message)
+        contents.append(content)
+    archive.close()
+    delays = {
+        entity.trip_update.trip.trip_id: (
+            entity.trip_update.stop_time_update[-1].departure.delay
+        )
+        for entity in message.entity
+    }
+    return archive.path_for(TARGET_DATE), contents, delays
+
+
+def test_full_records_round_trip(day: tuple[Path, list[bytes], dict[str, int]]) -> None:
+    path, contents, _ = day
+    # 最初の FULL から次の FULL の後まで
+    count = KEYFRAME_INTERVAL + 10
+    records = list(zip(read_archive(path, KEY), contents[:count], strict=False))
+    assert len(records) == count
+    for record, content in records:
+        assert _entities(record.content) == _entities(content)
+
+
+def test_replaying_a_day_is_fast(day: tuple[Path, list[bytes], dict[str, int]]) -> None:
+    path, _, delays = day
+    started = time.perf_counter()
+    replayed, records, _ = replay(str(path), None)
+    elapsed = time.perf_counter() - started
+    assert records == {KEY: POLLS}
+    assert replayed == delays
+    assert elapsed < REPLAY_SECONDS
+
+
+def _append(archive: SnapshotArchive, poll: int, trip_id: str) -> bytes:
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.timestamp = poll
+    message.entity.add(id=trip_id).trip_update.trip.trip_id = trip_id
+    content = message.SerializeToString()
+    archive.append(KEY, _midnight() + poll, content, message)
+    return content
+
+
+def test_reopening_drops_a_torn_record(tmp_path: Path) -> None:
+    archive = SnapshotArchive(tmp_path)
+    path = archive.path_for(TARGET_DATE)
+    written = [_append(archive, poll, f"T{poll}") for poll in range(3)]
+    archive.close()
+    # 記録の本文を書いている途中で止まった
+    with path.open("ab") as f:
+        f.write(RECORD_HEADER.pack(100, 0.0, len(KEY), 0) + KEY.encode() + b"x")
+
+    # 次に起動したプロセスが同じファイルに追記を続ける
+    archive = SnapshotArchive(tmp_path)
+    written.append(_append(archive, 3, "T3"))
+    archive.close()
+    assert [_entities(record.content) for record in read_archive(path, KEY)] == [
+        _entities(content) for content in written
+    ]
+
+
+def test_reopening_after_a_torn_magic(tmp_path: Path) -> None:
+    archive = SnapshotArchive(tmp_path)
+    path = archive.path_for(TARGET_DATE)
+    path.write_bytes(MAGIC[:3])
+    content = _append(archive, 0, "T0")
+    archive.close()
+    assert [record.content for record in read_archive(path)] == [content]
@@ -0,0 +1,110 @@
+from sqlalchemy.orm import Session
+
+from lib.feeds import frequency_trip_id
+from lib.static import (
+    SECS_PER_DAY,
+    FrequencyIndex,
+    TripPatternCache,
+    time_to_secs,
+)
+
+# 08:00-09:00 は 10 分おき、17:00-18:00 は 20 分おき (end_time ちょうどの便は出ない)
+FREQUENCIES = [
+    ("F1", "08:00:00", "09:00:00", 600, 0),
+    ("F1", "17:00:00", "18:00:00", 1200, 0),
+]
+
+
+def _row(stop_id: str, departure_time: str) -> tuple:
+    # _departure_rows() と同じ列
+    return (
+        "F1",
+        "R1",
+        "WD",
+        "1",
+        "Route 1",
+        departure_time,
+        stop_id,
+        "Terminal",
+        f"Stop {stop_id}",
+        time_to_secs(departure_time),
+    )
+
+
+def _index() -> FrequencyIndex:
+    # 雛形は 08:00 始発。S2 は 5 分後、S3 は 12 分後
+    return FrequencyIndex.build(
+        FREQUENCIES,
+        [_row("S1", "08:00:00"), _row("S2", "08:05:00"), _row("S3", "08:12:00")],
+    )
+
+
+def _departures(found: list[tuple[int, tuple]]) -> list[tuple[int, str, str]]:
+    # (発車秒, 1 本ごとの trip_id, その便の時刻)
+    return [(secs, row[0], row[5]) for secs, row in found]
+
+
+def test_departures_expand_each_headway() -> None:
+    found = _index().departures(
+        ["S2"],
+        frozenset({"WD"}),
+        time_to_secs("08:20:00"),
+        time_to_secs("08:50:00"),
+    )
+    assert _departures(found) == [
+        (time_to_secs("08:25:00"), "F1@08:20:00", "08:25:00"),
+        (time_to_secs("08:35:00"), "F1@08:30:00", "08:35:00"),
+        (time_to_secs("08:45:00"), "F1@08:40:00", "08:45:00"),
+    ]
+
+
+def test_departures_across_periods_and_stops() -> None:
+    index = _index()
+    services = frozenset({"WD"})
+    # 08:50 始発の便は 09:00 を過ぎても走る。09:00 始発の便はなく、次は 17:00 から 20 分おき
+    found = index.departures(
+        ["S3", "S1"],
+        services,
+        time_to_secs("08:55:00"),
+        time_to_secs("17:30:00"),
+    )
+    assert _departures(found) == [
+        (time_to_secs("09:02:00"), "F1@08:50:00", "09:02:00"),
+        (time_to_secs("17:00:00"), "F1@17:00:00", "17:00:00"),
+        (time_to_secs("17:12:00"), "F1@17:00:00", "17:12:00"),
+        (time_to_secs("17:20:00"), "F1@17:20:00", "17:20:00"),
+    ]
+    assert _departures(
+        index.departures(["S1"], services, 0, SECS_PER_DAY - 1, limit=2),
+    ) == [
+        (time_to_secs("08:00:00"), "F1@08:00:00", "08:00:00"),
+        (time_to_secs("08:10:00"), "F1@08:10:00", "08:10:00"),
+    ]
+    # 運行しない日には出ない
+    assert not index.departures(["S1"], frozenset({"WE"}), 0, SECS_PER_DAY - 1)
+
+
+def test_previous_service_day_is_shifted() -> None:
+    # 前日の運行日の便を、当日の 0 時からの秒で (shift で) 問い合わせる
+    found = _index().departures(
+        ["S1"],
+        frozenset({"WD"}),
+        time_to_secs("17:40:00") - SECS_PER_DAY,
+        SECS_PER_DAY,
+        shift=-SECS_PER_DAY,
+    )
+    assert _departures(found) == [
+        (time_to_secs("17:40:00") - SECS_PER_DAY, "F1@17:40:00", "17:40:00"),
+    ]
+
+
+def test_trip_patterns_are_kept_per_base_trip(session: Session) -> None:
+    cache = TripPatternCache()
+    trip_id = next(iter(FrequencyIndex.load(session).periods))
+    runs = [frequency_trip_id(trip_id, f"{hour:02d}:00:00") for hour in range(6, 22)]
+    patterns = cache.get(session, runs)
+    assert patterns.keys() == set(runs)
+    assert len({id(pattern) for pattern in patterns.values()}) == 1
+    assert cache.get(session, [trip_id])[trip_id] is patterns[runs[0]]
+    # 1 本ごとの trip_id が増えても、保持するのは元の便の分だけ
+    assert cache.stats()["trips"] == 1
@@ -0,0 +1,250 @@
+import datetime
+import random
+from collections.abc import Iterator
+from itertools import pairwise
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from lib.dynamic import RealtimeIndex, build_realtime_index
+from lib.feeds import base_trip_id, frequency_trip_id
+from lib.journey import MAX_ROUNDS, Journey, JourneyPlanner, load_footpaths
+from lib.static import SECS_PER_DAY, secs_to_gtfs_time, time_to_secs
+from lib.static_models import Frequencies, StopTimes
+from lib.stops import StopIndex
+from lib.timetable import Timetable
+
+# 合成フィードの frequencies.txt の便 (最後から 2 つ目の経路の平日ダイヤ)
+FREQUENCY_TRIP = "R10_WD"
+
+
+@pytest.fixture(scope="module")
+def planner_session(db_path: str) -> Iterator[Session]:
+    session_factory = sessionmaker(bind=create_engine(f"sqlite:///{db_path}"))
+    with session_factory() as session:
+        yield session
+
+
+@pytest.fixture(scope="module")
+def planner(db_path: str, planner_session: Session) -> JourneyPlanner:
+    timetable = Timetable.load(db_path)
+    stops = StopIndex.load(planner_session)
+    return JourneyPlanner(timetable, load_footpaths(planner_session, timetable, stops))
+
+
+def _stop_times(session: Session, trip_id: str) -> list[tuple[str, int, int]]:
+    # (stop_id, stop_sequence, 発車秒) の停車順
+    return session.execute(
+        select(StopTimes.stop_id, StopTimes.stop_sequence, StopTimes.departure_secs)
+        .filter(StopTimes.trip_id == trip_id)
+        .order_by(StopTimes.stop_sequence),
+    ).all()
+
+
+def _plan(
+    planner: JourneyPlanner,
+    origin: str,
+    destination: str,
+    target_date: datetime.datetime,
+    departure_secs: int,
+    **options: object,
+) -> list[Journey]:
+    return planner.plan(
+        planner.stop_numbers([origin]),
+        planner.stop_numbers([destination]),
+        target_date,
+        departure_secs,
+        **options,
+    )
+
+
+def _trip_ids(planner: JourneyPlanner, journey: Journey) -> list[str]:
+    return [
+        leg["trip_id"]
+        for leg in planner.describe(journey)["legs"]
+        if leg["type"] == "trip"
+    ]
+
+
+def _check_legs(
+    planner: JourneyPlanner,
+    session: Session,
+    journey: Journey,
+) -> None:
+    # 便の区間は、乗る停留所と降りる停留所の時刻表の発車秒に合っている
+    assert journey.transfers == max(len(_trip_ids(planner, journey)) - 1, 0)
+    for previous, leg in pairwise(journey.legs):
+        assert previous.to_stop == leg.from_stop
+        assert previous.arrival_secs <= leg.departure_secs
+    stop_ids = planner.timetable.stops.values
+    for leg, item in zip(journey.legs, planner.describe(journey)["legs"], strict=True):
+        if leg.trip < 0:
+            continue
+        trip_id = item["trip_id"]
+        base = base_trip_id(trip_id)
+        times = _stop_times(session, base)
+        # 1 本ごとの trip_id なら雛形の始発からのずれを足す
+        offset = 0
+        if trip_id != base:
+            offset = time_to_secs(trip_id.rpartition("@")[2]) - times[0][2]
+        departures = {stop_id: secs + offset for stop_id, _, secs in times}
+        for secs, stop in (
+            (leg.departure_secs, leg.from_stop),
+            (leg.arrival_secs, leg.to_stop),
+        ):
+            # 前日の便は 24 時過ぎの時刻で走る
+            assert departures[stop_ids[stop]] in {secs, secs + SECS_PER_DAY}
+
+
+def test_transfer_limit_keeps_pareto_journeys(
+    planner: JourneyPlanner,
+    planner_session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    rng = random.Random(0)  # noqa: S311
+    stops = [
+        stop_id
+        for (stop_id,) in planner_session.execute(
+            text("SELECT DISTINCT stop_id FROM stop_times ORDER BY stop_id"),
+        )
+    ]
+    transferred = 0
+    for _ in range(30):
+        origin, destination = rng.sample(stops, 2)
+        journeys = _plan(planner, origin, destination, target_date, 8 * 3600)
+        # 乗り換えが増えるほど早く着く
+        assert [journey.transfers for journey in journeys] == sorted(
+            {journey.transfers for journey in journeys},
+        )
+        arrivals = [journey.arrival_secs for journey in journeys]
+        assert arrivals == sorted(arrivals, reverse=True)
+        assert len(set(arrivals)) == len(arrivals)
+        for journey in journeys:
+            _check_legs(planner, planner_session, journey)
+        transferred += any(journey.transfers for journey in journeys)
+        # 乗り換えの上限を下げると、その回数までの経路だけが残る
+        for max_rounds in range(1, MAX_ROUNDS):
+            limited = _plan(
+                planner,
+                origin,
+                destination,
+                target_date,
+                8 * 3600,
+                max_rounds=max_rounds,
+            )
+            assert limited == [
+                journey for journey in journeys if journey.transfers < max_rounds
+            ]
+    assert transferred
+
+
+def test_frequency_trip_runs_every_headway(
+    planner: JourneyPlanner,
+    planner_session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    times = _stop_times(planner_session, FREQUENCY_TRIP)
+    start_time, headway = planner_session.execute(
+        select(Frequencies.start_time, Frequencies.headway_secs).filter(
+            Frequencies.trip_id == FREQUENCY_TRIP,
+        ),
+    ).one()
+    start_secs = time_to_secs(start_time)
+    (origin, _, first), (destination, _, last) = times[0], times[5]
+    ride = last - first
+    # 始発の停留所を n 本目の始発の時刻に出ると、その 1 本に乗る
+    for run in (1, 2):
+        start = start_secs + run * headway
+        (journey,) = _plan(
+            planner,
+            origin,
+            destination,
+            target_date,
+            start,
+            max_rounds=1,
+        )
+        assert _trip_ids(planner, journey) == [
+            frequency_trip_id(FREQUENCY_TRIP, secs_to_gtfs_time(start)),
+        ]
+        assert (journey.departure_secs, journey.arrival_secs) == (start, start + ride)
+
+
+def test_trip_after_midnight_runs_on_the_previous_service_day(
+    planner: JourneyPlanner,
+    planner_session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    # 平日ダイヤで 24 時を過ぎてから 2 つ以上停まる便
+    trip_id = planner_session.execute(
+        text(
+            "SELECT st.trip_id FROM stop_times st JOIN trips t USING (trip_id) "
+            "WHERE t.service_id = 'WD' AND st.departure_secs >= 86400 "
+            "GROUP BY st.trip_id HAVING COUNT(*) >= 2 LIMIT 1",
+        ),
+    ).scalar_one()
+    after = [
+        row for row in _stop_times(planner_session, trip_id) if row[2] >= SECS_PER_DAY
+    ]
+    (origin, _, departure), (destination, _, arrival) = after[0], after[-1]
+    # 翌日は平日ダイヤが運休する例外日だが、前日の便はそのまま走る
+    next_day = target_date + datetime.timedelta(days=1)
+    (journey,) = _plan(
+        planner,
+        origin,
+        destination,
+        next_day,
+        departure - SECS_PER_DAY,
+        max_rounds=1,
+    )
+    assert _trip_ids(planner, journey) == [trip_id]
+    assert journey.departure_secs == departure - SECS_PER_DAY
+    assert journey.arrival_secs <= arrival - SECS_PER_DAY
+
+
+def _delayed(trip_id: str, updates: list[tuple[int, int]]) -> RealtimeIndex:
+    # updates は (stop_sequence, 遅延秒) の並び
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    trip_update = feed.entity.add(id=trip_id).trip_update
+    trip_update.trip.trip_id = trip_id
+    for stop_sequence, delay in updates:
+        update = trip_update.stop_time_update.add(stop_sequence=stop_sequence)
+        update.arrival.delay = delay
+        update.departure.delay = delay
+    return build_realtime_index(feed)
+
+
+def test_realtime_delays_shift_the_trip(
+    planner: JourneyPlanner,
+    planner_session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    trip_id = "R0_0"
+    times = _stop_times(planner_session, trip_id)
+    (origin, _, departure), (destination, _, arrival) = times[2], times[8]
+    delay = 300
+    # 遅れは 1 つ目の停留所から先に引き継ぎ、乗る停留所の遅延を区間に付ける
+    realtime = _delayed(trip_id, [(times[1][1], delay)])
+    # 時刻表では乗り遅れる時刻に着いても、遅れている便に乗れる
+    (journey,) = _plan(
+        planner,
+        origin,
+        destination,
+        target_date,
+        departure + 60,
+        realtime=realtime,
+        max_rounds=1,
+    )
+    assert _trip_ids(planner, journey) == [trip_id]
+    assert (journey.departure_secs, journey.arrival_secs) == (
+        departure + delay,
+        arrival + delay,
+    )
+    assert journey.legs[0].delay == delay
+    assert planner.describe(journey)["legs"][0]["delay"] == delay
+    # リアルタイムがなければ時刻表どおりで、同じ便には乗れない
+    (scheduled,) = _plan(planner, origin, destination, target_date, departure)
+    assert _trip_ids(planner, scheduled)[0] == trip_id
+    assert scheduled.legs[0].delay is None
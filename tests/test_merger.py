@@ -0,0 +1,84 @@
+from google.transit import gtfs_realtime_pb2
+
+from lib.dynamic import build_realtime_index
+from lib.merger import merge_gtfs_realtime, position_delays
+
+# 6 停留所を 10 分おきに出る便
+PATTERN = tuple((sequence, f"S{sequence}") for sequence in range(1, 7))
+SCHEDULED = {stop_id: f"08:{sequence}0:00" for sequence, stop_id in PATTERN}
+
+
+def _trip_updates(*updates: tuple[int, int | None]) -> gtfs_realtime_pb2.FeedMessage:
+    # updates は (stop_sequence, 遅延秒) の並び。遅延が None なら NO_DATA
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    trip_update = feed.entity.add(id="T1").trip_update
+    trip_update.trip.trip_id = "T1"
+    for stop_sequence, delay in updates:
+        update = trip_update.stop_time_update.add(
+            stop_sequence=stop_sequence,
+            stop_id=f"S{stop_sequence}",
+        )
+        if delay is None:
+            update.schedule_relationship = (
+                gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.NO_DATA
+            )
+        else:
+            update.departure.delay = delay
+    return feed
+
+
+def _board() -> dict:
+    return {
+        "T1": {
+            "trip_info": {"trip_id": "T1"},
+            "stops": [
+                {"stop_id": stop_id, "departure_scheduled_time": time}
+                for stop_id, time in SCHEDULED.items()
+            ],
+        },
+    }
+
+
+def _delays(merged: dict) -> dict[str, tuple[int, bool] | None]:
+    # 停留所ごとに、遅延と引き継いだものかどうか
+    return {
+        stop["stop_id"]: (
+            stop["actual_departure"]["delay"],
+            stop.get("delay_propagated", False),
+        )
+        if "actual_departure" in stop
+        else None
+        for stop in merged["T1"]["stops"]
+    }
+
+
+def test_delay_carries_until_the_next_update() -> None:
+    realtime = build_realtime_index(_trip_updates((2, 120), (5, 30)))
+    merged = merge_gtfs_realtime(_board(), realtime, {"T1": PATTERN})
+    assert _delays(merged) == {
+        "S1": None,
+        "S2": (120, False),
+        "S3": (120, True),
+        "S4": (120, True),
+        "S5": (30, False),
+        "S6": (30, True),
+    }
+    stop = merged["T1"]["stops"][2]
+    assert stop["actual_departure"]["time"] == "08:32:00"
+    # 経路検索の遅延も同じ引き継ぎ方
+    assert position_delays(realtime.trips["T1"], PATTERN) == [0, 120, 120, 120, 30, 30]
+
+
+def test_no_data_stops_the_carried_delay() -> None:
+    realtime = build_realtime_index(_trip_updates((2, 120), (4, None)))
+    merged = merge_gtfs_realtime(_board(), realtime, {"T1": PATTERN})
+    assert _delays(merged) == {
+        "S1": None,
+        "S2": (120, False),
+        "S3": (120, True),
+        "S4": None,
+        "S5": None,
+        "S6": None,
+    }
+    assert position_delays(realtime.trips["T1"], PATTERN) == [0, 120, 120, 0, 0, 0]
@@ -0,0 +1,149 @@
+import threading
+from collections.abc import Callable, Iterator
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from lib.feeds import Feed, namespaced
+from lib.poller import HISTORY_SIZE, RealtimePoller
+from tools.serve_feed import make_handler
+from tools.synthetic_feed import FeedConfig, make_trip_updates, make_vehicle_positions
+
+FEED = FeedConfig(routes=2, stops=20, stops_per_trip=5, trips_per_route=4, updates=4)
+TIMESTAMP = 1_761_000_000
+
+# .pb ファイルの置き場所を受け取り、それを返すサーバーの URL を返す
+type Serve = Callable[[Path], str]
+
+
+@pytest.fixture
+def serve() -> Iterator[Serve]:
+    servers = []
+
+    def start(path: Path) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(path))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _write(
+    path: Path,
+    message: gtfs_realtime_pb2.FeedMessage,
+    timestamp: int,
+) -> gtfs_realtime_pb2.FeedMessage:
+    message.header.timestamp = timestamp
+    path.write_bytes(message.SerializeToString())
+    return message
+
+
+def _delay(message: gtfs_realtime_pb2.FeedMessage, index: int, seconds: int) -> str:
+    # index 番目の TripUpdate の遅延を増やし、その trip_id を返す
+    trip_update = message.entity[index].trip_update
+    for update in trip_update.stop_time_update:
+        update.departure.delay += seconds
+    return trip_update.trip.trip_id
+
+
+def test_feeds_are_combined_into_one_snapshot(tmp_path: Path, serve: Serve) -> None:
+    trip_updates = _write(tmp_path / "a.pb", make_trip_updates(FEED), TIMESTAMP)
+    vehicles = _write(tmp_path / "av.pb", make_vehicle_positions(FEED), TIMESTAMP)
+    _write(tmp_path / "b.pb", make_trip_updates(FEED), TIMESTAMP - 30)
+    poller = RealtimePoller(
+        [
+            Feed(
+                "A",
+                realtime_url=serve(tmp_path / "a.pb"),
+                vehicle_positions_url=serve(tmp_path / "av.pb"),
+            ),
+            Feed("B", realtime_url=serve(tmp_path / "b.pb")),
+        ],
+    )
+    assert poller.poll_once()
+    snapshot = poller.snapshot
+    trip_ids = [entity.trip_update.trip.trip_id for entity in trip_updates.entity]
+    # 同じ trip_id でもフィードごとの名前空間で別の便になる
+    assert {
+        namespaced(feed_id, trip_id) for feed_id in "AB" for trip_id in trip_ids
+    } <= snapshot.realtime.trips.keys()
+    # 車両は VehiclePositions の URL からだけ
+    assert {position.trip_id for position in snapshot.realtime.vehicles.positions} == {
+        namespaced("A", entity.vehicle.trip.trip_id)
+        for entity in vehicles.entity
+        if entity.HasField("vehicle")
+    }
+    assert snapshot.realtime.alerts.alerts
+    # いちばん古いフィードの時刻
+    assert snapshot.feed_timestamp == TIMESTAMP - 30
+    assert {
+        key: feed_timestamp
+        for key, (feed_timestamp, _) in poller.feed_timestamps().items()
+    } == {
+        ("A", "trip_updates"): TIMESTAMP,
+        ("A", "vehicle_positions"): TIMESTAMP,
+        ("B", "trip_updates"): TIMESTAMP - 30,
+    }
+    # 1 つのフィードだけ更新しても、ほかのフィードの便は残る
+    message = make_trip_updates(FEED)
+    changed = _delay(message, 0, 60)
+    _write(tmp_path / "b.pb", message, TIMESTAMP + 30)
+    assert poller.poll_once()
+    assert poller.snapshot.changed == {namespaced("B", changed)}
+    assert {
+        namespaced(feed_id, trip_id) for feed_id in "AB" for trip_id in trip_ids
+    } <= poller.snapshot.realtime.trips.keys()
+    assert poller.snapshot.feed_timestamp == TIMESTAMP
+
+
+def test_unchanged_header_timestamp_is_skipped(tmp_path: Path, serve: Serve) -> None:
+    path = tmp_path / "feed.pb"
+    message = _write(path, make_trip_updates(FEED), TIMESTAMP)
+    poller = RealtimePoller([Feed("", realtime_url=serve(path))])
+    assert poller.poll_once()
+    version = poller.snapshot.version
+    # 同じ内容は 304 で返る
+    assert not poller.poll_once()
+    # 中身が変わってもヘッダの時刻が進んでいなければ読まない
+    _delay(message, 0, 60)
+    _write(path, message, TIMESTAMP)
+    assert not poller.poll_once()
+    assert poller.snapshot.version == version
+    # 時刻だけ進んで中身が同じなら版は上げない
+    message = _write(path, make_trip_updates(FEED), TIMESTAMP + 30)
+    assert not poller.poll_once()
+    assert poller.snapshot.version == version
+    assert poller.snapshot.feed_timestamp == TIMESTAMP + 30
+    changed = _delay(message, 1, 60)
+    _write(path, message, TIMESTAMP + 60)
+    assert poller.poll_once()
+    assert poller.snapshot.version == version + 1
+    assert poller.changes_since(version) == {changed}
+
+
+def test_history_keeps_the_last_versions(tmp_path: Path, serve: Serve) -> None:
+    path = tmp_path / "feed.pb"
+    message = _write(path, make_trip_updates(FEED), TIMESTAMP)
+    poller = RealtimePoller([Feed("", realtime_url=serve(path))])
+    assert poller.poll_once()
+    first = poller.snapshot.version
+    changed = []
+    for poll in range(HISTORY_SIZE + 6):
+        changed.append(_delay(message, poll % len(message.entity), 60))
+        _write(path, message, TIMESTAMP + poll + 1)
+        assert poller.poll_once()
+    history = poller.history()
+    assert len(history) == HISTORY_SIZE
+    assert [version for version, _ in history] == list(
+        range(poller.snapshot.version - HISTORY_SIZE + 1, poller.snapshot.version + 1),
+    )
+    # 履歴より前の版からの差分はわからない
+    assert poller.changes_since(first) is None
+    assert poller.changes_since(poller.snapshot.version - 3) == set(changed[-3:])
+    assert poller.changes_since(poller.snapshot.version) == frozenset()
@@ -0,0 +1,20 @@
+import datetime
+
+from sqlalchemy.orm import Session
+
+from lib.static import explain_departures
+from tools.check_query_plan import check_query_plan
+from tools.synthetic_feed import stop_id
+
+
+def test_departures_use_stop_departure_index(
+    session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    plan = explain_departures(
+        session,
+        stop_ids=[stop_id(0), stop_id(1)],
+        target_date=target_date,
+    )
+    assert any("stop_times_stop_departure" in line for line in plan), plan
+    assert check_query_plan(plan) == []
@@ -0,0 +1,120 @@
+import datetime
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from lib.dynamic import build_realtime_index
+from lib.feeds import dated_trip_id
+from lib.merger import merge_gtfs_realtime
+from lib.static import (
+    SECS_PER_DAY,
+    departure_boards,
+    get_bus_schedule_flexible,
+    time_to_secs,
+)
+from lib.timetable import Timetable
+
+
+@pytest.fixture(scope="module")
+def timetable(db_path: str) -> Timetable:
+    return Timetable.load(db_path)
+
+
+def _midnight_trip(session: Session) -> tuple[str, str, str]:
+    # 24 時の前と後の両方に停まる便と、その前後の停留所
+    trip_id, before, after = session.execute(
+        text(
+            "SELECT b.trip_id, b.stop_id, a.stop_id FROM stop_times b "
+            "JOIN stop_times a ON a.trip_id = b.trip_id "
+            "JOIN trips t ON t.trip_id = b.trip_id "
+            "WHERE t.service_id = 'WD' AND b.departure_secs < 86400 "
+            "AND a.departure_secs >= 86400 AND b.stop_id != a.stop_id LIMIT 1",
+        ),
+    ).one()
+    return trip_id, before, after
+
+
+def _boards(
+    session: Session,
+    timetable: Timetable,
+    stop_ids: list[str],
+    target_date: datetime.datetime,
+) -> list[dict]:
+    departure_boards.invalidate()
+    window = {"stop_ids": stop_ids, "target_date": target_date, "limit": 10**9}
+    return [
+        get_bus_schedule_flexible(session, **window),
+        departure_boards.get(session, **window),
+        timetable.get_bus_schedule_flexible(**window),
+    ]
+
+
+def test_runs_on_two_service_days_stay_apart(
+    session: Session,
+    timetable: Timetable,
+    target_date: datetime.datetime,
+) -> None:
+    # 既定の 00:00:00-23:59:59 には前日の便の 24 時過ぎと当日の同じ便が両方載る
+    trip_id, before, after = _midnight_trip(session)
+    today = target_date.strftime("%Y%m%d")
+    yesterday = (target_date - datetime.timedelta(days=1)).strftime("%Y%m%d")
+    for board in _boards(session, timetable, [before, after], target_date):
+        previous_run = board[trip_id]
+        current_run = board[dated_trip_id(trip_id, today)]
+        assert previous_run["trip_info"]["service_date"] == yesterday
+        assert current_run["trip_info"]["service_date"] == today
+        assert current_run["trip_info"]["trip_id"] == trip_id
+        assert [stop["stop_id"] for stop in previous_run["stops"]] == [after]
+        assert [stop["stop_id"] for stop in current_run["stops"]] == [before]
+        departure = previous_run["stops"][0]["departure_scheduled_time"]
+        assert time_to_secs(departure) >= SECS_PER_DAY
+
+
+def _trip_updates(
+    trip_id: str,
+    stop_id: str,
+    start_date: str | None,
+) -> gtfs_realtime_pb2.FeedMessage:
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = 0
+    trip_update = feed.entity.add(id="1").trip_update
+    trip_update.trip.trip_id = trip_id
+    if start_date:
+        trip_update.trip.start_date = start_date
+    stop_update = trip_update.stop_time_update.add(stop_id=stop_id)
+    stop_update.departure.delay = 120
+    return feed
+
+
+@pytest.mark.parametrize("dated", [True, False])
+def test_realtime_attaches_to_its_service_day(
+    session: Session,
+    target_date: datetime.datetime,
+    dated: bool,  # noqa: FBT001
+) -> None:
+    trip_id, before, after = _midnight_trip(session)
+    today = target_date.strftime("%Y%m%d")
+    board = get_bus_schedule_flexible(session, [before, after], target_date, 10**9)
+    current_key = dated_trip_id(trip_id, today)
+
+    # 当日の便の TripUpdate は当日の便だけに付く
+    realtime = build_realtime_index(
+        _trip_updates(trip_id, before, today if dated else None),
+    )
+    merged = merge_gtfs_realtime(board, realtime)
+    delayed = {
+        key
+        for key, trip in merged.items()
+        for stop in trip["stops"]
+        if "actual_departure" in stop
+    }
+    # 運行日のない TripUpdate は掲示板の最初の 1 本 (前日の便) のものとみなす
+    assert delayed == ({current_key} if dated else set())
+
+    realtime = build_realtime_index(_trip_updates(trip_id, after, None))
+    merged = merge_gtfs_realtime(board, realtime)
+    assert "actual_departure" in merged[trip_id]["stops"][0]
+    assert "actual_departure" not in merged[current_key]["stops"][0]
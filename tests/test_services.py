@@ -0,0 +1,87 @@
+import datetime
+
+from sqlalchemy.orm import Session
+
+from lib.services import ServiceCalendar
+from lib.timetable import Timetable
+
+# 2025-06-02 は月曜日
+MONDAY = datetime.date(2025, 6, 2)
+# 6 月 1 日から、例外のいちばん遅い 7 月 5 日まで
+DAYS = 35
+
+CALENDAR = [
+    # 6 月の平日と、6 月後半の土日
+    ("WD", "1", "1", "1", "1", "1", "0", "0", "20250601", "20250630"),
+    ("WE", "0", "0", "0", "0", "0", "1", "1", "20250614", "20250630"),
+    # 期間のない行は読まない
+    ("BROKEN", "1", "1", "1", "1", "1", "1", "1", "", ""),
+]
+CALENDAR_DATES = [
+    # 水曜日は祝日で平日ダイヤが運休し、土日ダイヤで走る
+    ("WD", "20250604", "2"),
+    ("WE", "20250604", "1"),
+    # 土日ダイヤの期間より前の土曜日にも走る
+    ("WE", "20250607", "1"),
+    # calendar にないサービスは例外の日だけ走る
+    ("EVENT", "20250705", "1"),
+    # 運行しない日の運休は何も変えない
+    ("WD", "20250608", "2"),
+]
+
+
+def _day(days: int) -> datetime.date:
+    return MONDAY + datetime.timedelta(days=days)
+
+
+def test_calendar_dates_override_the_weekly_pattern() -> None:
+    calendar = ServiceCalendar.build(CALENDAR, CALENDAR_DATES)
+    # 期間は calendar の両端と例外の日付のうち、いちばん早い日から遅い日まで
+    assert calendar.first_date == datetime.date(2025, 6, 1)
+    assert calendar.days == DAYS
+    assert [calendar.active(_day(days)) for days in range(7)] == [
+        {"WD"},
+        {"WD"},
+        {"WE"},
+        {"WD"},
+        {"WD"},
+        {"WE"},
+        frozenset(),
+    ]
+    assert [calendar.active(_day(days)) for days in range(14, 21)] == [
+        {"WD"},
+        {"WD"},
+        {"WD"},
+        {"WD"},
+        {"WD"},
+        {"WE"},
+        {"WE"},
+    ]
+    # calendar の end_date を過ぎたら曜日が合っても走らない
+    assert calendar.active(datetime.date(2025, 7, 1)) == frozenset()
+    assert calendar.active(datetime.date(2025, 7, 5)) == {"EVENT"}
+    # 期間の外と、時刻付きの日付
+    assert calendar.active(datetime.date(2025, 5, 31)) == frozenset()
+    assert calendar.active(datetime.date(2025, 7, 6)) == frozenset()
+    assert calendar.active(
+        datetime.datetime.combine(_day(2), datetime.time(23, 59)),
+    ) == {"WE"}
+    assert not ServiceCalendar.build([], []).active(MONDAY)
+
+
+def test_loaded_calendar_matches_the_timetable(
+    session: Session,
+    db_path: str,
+    target_date: datetime.datetime,
+) -> None:
+    calendar = ServiceCalendar.load(session)
+    timetable = Timetable.load(db_path)
+    # 合成フィードでは target_date の翌日が、平日ダイヤが運休して土日ダイヤで走る例外日
+    for days, expected in ((0, {"WD"}), (1, {"WE"})):
+        day = target_date + datetime.timedelta(days=days)
+        assert calendar.active(day) == expected
+        assert {
+            timetable.services.values[service]
+            for service in timetable.active_services(day)
+        } == expected
+    assert calendar.active(calendar.first_date - datetime.timedelta(days=1)) == set()
@@ -0,0 +1,39 @@
+import asyncio
+import fcntl
+import time
+from pathlib import Path
+
+from lib.poller import RealtimePoller, RealtimeSnapshot
+from lib.shared import CHECK_INTERVAL, SharedRealtime
+
+
+async def _wake_reader(path: Path) -> float:
+    # 書き手が新しい版を書いてから、読み手の wait_for_update() が返るまでの秒数
+    writer = SharedRealtime(RealtimePoller(None), path)
+    writer.write(RealtimeSnapshot(version=1), {})
+    reader = SharedRealtime(RealtimePoller(None), path)
+    reader.start()
+    await asyncio.sleep(0)
+    assert not reader.is_writer
+    assert reader.snapshot.version == 1
+
+    waiting = asyncio.create_task(reader.wait_for_update(30))
+    await asyncio.sleep(CHECK_INTERVAL * 3)
+    assert not waiting.done()
+    latest = RealtimeSnapshot(version=2)
+    writer.write(latest, {})
+    started = time.monotonic()
+    await waiting
+    elapsed = time.monotonic() - started
+    assert reader.snapshot.version == latest.version
+    await reader.stop()
+    return elapsed
+
+
+def test_reader_wakes_on_a_new_version(tmp_path: Path) -> None:
+    path = tmp_path / "realtime.snapshot"
+    # ほかのプロセスが書き手のまま
+    with Path(f"{path}.lock").open("w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elapsed = asyncio.run(_wake_reader(path))
+    assert elapsed < CHECK_INTERVAL * 3
@@ -0,0 +1,110 @@
+from collections.abc import Iterator
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from lib.geo import BUCKET_DEGREES, GridIndex, distance_meters
+from lib.static_models import Stops
+from lib.stops import StopIndex, stop_group
+
+# 広島駅付近。緯度 0.001 度はおよそ 111 m
+ORIGIN = (34.3970, 132.4750)
+
+# 標柱ごとに stop_id・stop_name・緯度のずれ・location_type・parent_station
+STOPS = [
+    # 親の停留所があるのりばは、stop_id が似ていなくてもまとめる
+    ("P1", "広島駅", 0.0, "1", None),
+    ("A", "広島駅 1 番", 0.0, "0", "P1"),
+    ("B", "広島駅 2 番", 0.0004, "", "P1"),
+    # 親がなければ stop_id の空白より前が同じものをまとめる
+    ("22030 1", "的場町", 0.002, None, None),
+    ("22030 2", "的場町", 0.0022, None, None),
+    ("22031", "段原", 0.02, None, None),
+    # 親の停留所と出入口は標柱ではないので索引に入れない
+    ("E1", "広島駅 南口", 0.0001, "2", "P1"),
+]
+
+
+@pytest.fixture
+def stops_session() -> Iterator[Session]:
+    engine = create_engine("sqlite://")
+    Stops.__table__.create(engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(
+            Stops(
+                stop_id=stop_id,
+                stop_name=stop_name,
+                stop_lat=f"{ORIGIN[0] + offset:.6f}",
+                stop_lon=f"{ORIGIN[1]:.6f}",
+                location_type=location_type,
+                parent_station=parent_station,
+            )
+            for stop_id, stop_name, offset, location_type, parent_station in STOPS
+        )
+        session.commit()
+        yield session
+
+
+def test_stop_group_prefers_parent_station() -> None:
+    assert stop_group("A", "P1") == "P1"
+    assert stop_group("22030 1", None) == "22030"
+    assert stop_group("22030 1", "") == "22030"
+    assert stop_group("22031", None) == "22031"
+
+
+def test_stops_are_grouped(stops_session: Session) -> None:
+    index = StopIndex.load(stops_session)
+    assert sorted(index.by_id) == ["22030 1", "22030 2", "22031", "A", "B"]
+    assert {
+        group.group: (group.name, [stop.stop_id for stop in group.stops])
+        for group in index.groups.values()
+    } == {
+        # 親の停留所があれば、その名前を停留所の名前にする
+        "P1": ("広島駅", ["A", "B"]),
+        "22030": ("的場町", ["22030 1", "22030 2"]),
+        "22031": ("段原", ["22031"]),
+    }
+
+
+def test_near_returns_whole_groups_in_order(stops_session: Session) -> None:
+    index = StopIndex.load(stops_session)
+    # 的場町の 1 番だけが半径に入っても、2 番も一緒に返す
+    found = index.near(ORIGIN[0] + 0.0015, ORIGIN[1], 70)
+    assert [group.group for _, group in found] == ["22030"]
+    assert [stop.stop_id for stop in found[0][1].stops] == ["22030 1", "22030 2"]
+    # 停留所はいちばん近いのりばの距離で並べる
+    found = index.near(ORIGIN[0] + 0.0015, ORIGIN[1], 500)
+    assert [group.group for _, group in found] == ["22030", "P1"]
+    assert found[0][0] == pytest.approx(
+        distance_meters(ORIGIN[0] + 0.0015, ORIGIN[1], ORIGIN[0] + 0.002, ORIGIN[1]),
+    )
+    assert found[1][0] == pytest.approx(
+        distance_meters(ORIGIN[0] + 0.0015, ORIGIN[1], ORIGIN[0] + 0.0004, ORIGIN[1]),
+    )
+    assert [group.group for _, group in index.near(*ORIGIN, 3000, limit=2)] == [
+        "P1",
+        "22030",
+    ]
+
+
+def test_grid_near_checks_neighbouring_buckets() -> None:
+    # マスの境界をはさんだ点と、いくつか先のマスの点
+    edge = BUCKET_DEGREES * 3439
+    points = [
+        (edge - 0.0001, ORIGIN[1], "south"),
+        (edge + 0.0002, ORIGIN[1], "north"),
+        (edge + 0.0001, ORIGIN[1] + 0.0001, "north-east"),
+        (edge + BUCKET_DEGREES * 3, ORIGIN[1], "far"),
+    ]
+    grid = GridIndex(points)
+    radius = 30
+    found = grid.near(edge, ORIGIN[1], radius)
+    assert [item for _, item in found] == ["south", "north-east", "north"]
+    distances = [distance for distance, _ in found]
+    assert distances == sorted(distances)
+    assert all(distance <= radius for distance in distances)
+    # 半径がマスより大きければ、いくつ先のマスでも見つける
+    radius = distance_meters(edge, ORIGIN[1], edge + BUCKET_DEGREES * 3, ORIGIN[1])
+    assert [item for _, item in grid.near(edge, ORIGIN[1], radius + 1)][-1] == "far"
+    assert "far" not in [item for _, item in grid.near(edge, ORIGIN[1], radius - 1)]
@@ -0,0 +1,181 @@
+import asyncio
+import itertools
+import zipfile
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from lib import database
+from lib.database import build_database, update_database
+from lib.stops import StopIndexCache
+from lib.store import StaticStore, session_generation
+from tools.synthetic_feed import FeedConfig, make_static, stop_id
+
+FEED = FeedConfig(routes=2, stops=20, stops_per_trip=5, trips_per_route=4)
+WATCHED = ("stops", "routes", "calendar")
+MOVED = {"stops.txt": ("Stop 10000,", "Moved,")}
+RENAMED = {"routes.txt": ("Route 0,", "Renamed,")}
+
+# メンバー -> (置き換える文字列, 置き換え後)。そのテーブルだけが変わる
+type Edits = dict[str, tuple[str, str]]
+
+
+class _Invalidated:
+    # on_swap() で登録したテーブルごとに、呼ばれたものを記録する
+    def __init__(self, store: StaticStore) -> None:
+        self.called: set[str] = set()
+        for table in WATCHED:
+            store.on_swap(
+                lambda _, table=table: self.called.add(table),
+                [table],
+            )
+
+    def take(self) -> set[str]:
+        called, self.called = self.called, set()
+        return called
+
+
+def _write_zip(path: Path, edits: Edits) -> str:
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in make_static(FEED).items():
+            old, new = edits.get(name, ("", ""))
+            archive.writestr(name, content.replace(old, new) if old else content)
+    return str(path)
+
+
+@pytest.fixture
+def static_db(tmp_path: Path, schema_path: str) -> str:
+    db_path = str(tmp_path / "nowhere.db")
+    build_database(_write_zip(tmp_path / "0.zip", {}), db_path, schema_path)
+    return db_path
+
+
+@pytest.fixture
+def update(
+    tmp_path: Path,
+    static_db: str,
+    schema_path: str,
+) -> Callable[[Edits], None]:
+    # 合成フィードを書き換えた zip で update_database() する関数
+    zips = itertools.count(1)
+    return lambda edits: update_database(
+        _write_zip(tmp_path / f"{next(zips)}.zip", edits),
+        static_db,
+        schema_path,
+    )
+
+
+@pytest.fixture
+def store(static_db: str) -> StaticStore:
+    return StaticStore(static_db)
+
+
+def test_each_swap_invalidates_its_tables(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    invalidated = _Invalidated(store)
+    update(MOVED)
+    assert store.refresh()
+    assert invalidated.take() == {"stops"}
+
+
+def test_missed_swaps_are_accumulated(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    invalidated = _Invalidated(store)
+    update(MOVED)
+    # 2 回目の取り込みで変わるのは routes だけ
+    update({**MOVED, **RENAMED})
+    assert store.refresh()
+    assert invalidated.take() == {"stops", "routes"}
+    assert not store.refresh()
+
+
+def test_too_many_missed_swaps_invalidate_everything(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    invalidated = _Invalidated(store)
+    monkeypatch.setattr(database, "CHANGE_HISTORY", 1)
+    update(MOVED)
+    update({**MOVED, **RENAMED})
+    assert store.refresh()
+    assert invalidated.take() == set(WATCHED)
+
+
+def test_sessions_keep_their_generation_until_refresh(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    update(MOVED)
+    # リクエストのセッションは差し替えを待たずに今の世代を開く
+    with store.session() as session:
+        assert session_generation(session) == 0
+    assert store.refresh()
+    with store.session() as session:
+        assert session_generation(session) == 1
+
+
+def test_old_sessions_do_not_refill_caches(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    stops = StopIndexCache()
+    store.on_swap(stops.invalidate, stops.tables)
+    with store.session() as old:
+        # 差し替え前のファイルの接続をつかんでおく
+        assert stops.get(old).by_id[stop_id(0)].stop_name == "Stop 10000"
+        update(MOVED)
+        assert store.refresh()
+        assert stops.get(old).by_id[stop_id(0)].stop_name == "Stop 10000"
+        with store.session() as new:
+            assert stops.get(new).by_id[stop_id(0)].stop_name == "Moved"
+        assert stops.get(old) is stops.get(new)
+
+
+def test_failed_rebuild_is_not_published(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    invalidated = _Invalidated(store)
+    published = []
+    failures = iter([RuntimeError("disk full")])
+
+    def rebuild() -> Callable[[], None]:
+        for failure in failures:
+            raise failure
+        return lambda: published.append(store.generation)
+
+    store.on_rebuild(rebuild, ["stops"])
+    update(MOVED)
+    assert not store.refresh()
+    assert store.generation == 0
+    assert not invalidated.take()
+    # 次の確認でやり直す
+    assert store.refresh()
+    assert published == [0]
+    assert store.generation == 1
+    assert invalidated.take() == {"stops"}
+
+
+def test_background_task_publishes_swaps(
+    store: StaticStore,
+    update: Callable[[Edits], None],
+) -> None:
+    async def run() -> int:
+        store.start(interval=0.01)
+        update(MOVED)
+        try:
+            for _ in range(1000):
+                if store.generation:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await store.stop()
+        return store.generation
+
+    assert asyncio.run(run()) == 1
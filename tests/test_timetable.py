@@ -0,0 +1,79 @@
+import datetime
+import random
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from lib.static import departure_boards, get_bus_schedule_flexible
+from lib.static_models import Stops
+from lib.timetable import Timetable
+from tools.check_timetable import WINDOWS, departure_times, normalize
+
+
+@pytest.fixture(scope="module")
+def timetable(db_path: str) -> Timetable:
+    return Timetable.load(db_path)
+
+
+def _queries(
+    session: Session,
+    target_date: datetime.datetime,
+) -> list[dict]:
+    # 平日・運休の例外日・土休日と、いくつかの停留所の組
+    rng = random.Random(0)  # noqa: S311
+    all_stops = session.scalars(select(Stops.stop_id)).all()
+    stop_sets = [rng.sample(all_stops, rng.randint(1, 6)) for _ in range(8)]
+    return [
+        {
+            "stop_ids": stop_ids,
+            "target_date": target_date + datetime.timedelta(days=days),
+            "start_time": start_time,
+            "stop_time": stop_time,
+        }
+        for days in (0, 1, 3)
+        for stop_ids in stop_sets
+        for start_time, stop_time in WINDOWS
+    ]
+
+
+def test_timetable_matches_sql(
+    session: Session,
+    timetable: Timetable,
+    target_date: datetime.datetime,
+) -> None:
+    for window in _queries(session, target_date):
+        expected = get_bus_schedule_flexible(session, limit=10**9, **window)
+        actual = timetable.get_bus_schedule_flexible(limit=10**9, **window)
+        assert normalize(actual) == normalize(expected), window
+        # 件数で打ち切ると同じ発車秒の行の選び方が違いうるので発車時刻で比べる
+        assert departure_times(
+            timetable.get_bus_schedule_flexible(**window, limit=20),
+        ) == departure_times(get_bus_schedule_flexible(session, limit=20, **window))
+
+
+def test_departure_board_cache_matches_sql(
+    session: Session,
+    target_date: datetime.datetime,
+) -> None:
+    departure_boards.invalidate()
+    for window in _queries(session, target_date):
+        assert normalize(departure_boards.get(session, limit=10**9, **window)) == (
+            normalize(get_bus_schedule_flexible(session, limit=10**9, **window))
+        ), window
+
+
+def test_saved_timetable_matches(
+    session: Session,
+    timetable: Timetable,
+    target_date: datetime.datetime,
+    tmp_path: Path,
+) -> None:
+    timetable.save(tmp_path / "timetable")
+    opened = Timetable.open(tmp_path / "timetable")
+    assert opened is not None
+    for window in _queries(session, target_date)[:: len(WINDOWS) + 1]:
+        assert normalize(opened.get_bus_schedule_flexible(**window)) == normalize(
+            timetable.get_bus_schedule_flexible(**window),
+        )
@@ -0,0 +1,130 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from google.transit import gtfs_realtime_pb2
+
+import main
+from lib.dynamic import RealtimeIndex, build_realtime_index, update_realtime_index
+from lib.feeds import dated_trip_id, frequency_trip_id
+from lib.geo import distance_meters
+from lib.poller import RealtimeSnapshot
+from lib.vehicles import VehicleIndex, parse_vehicle_positions
+
+# 広島駅付近。緯度 0.001 度はおよそ 111 m
+ORIGIN = (34.3970, 132.4750)
+
+
+def _feed(*vehicles: dict) -> gtfs_realtime_pb2.FeedMessage:
+    # vehicles: 車両ごとの trip_id・route_id・stop_id・start_time・start_date・緯度のずれ・時刻
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    for number, fields in enumerate(vehicles):
+        vehicle = feed.entity.add(id=str(number)).vehicle
+        vehicle.vehicle.id = f"V{number}"
+        for name in ("trip_id", "route_id", "start_time", "start_date"):
+            if name in fields:
+                setattr(vehicle.trip, name, fields[name])
+        if "stop_id" in fields:
+            vehicle.stop_id = fields["stop_id"]
+        if "offset" in fields:
+            vehicle.position.latitude = ORIGIN[0] + fields["offset"]
+            vehicle.position.longitude = ORIGIN[1]
+        if "timestamp" in fields:
+            vehicle.timestamp = fields["timestamp"]
+    return feed
+
+
+def _vehicles(*vehicles: dict) -> VehicleIndex:
+    return VehicleIndex(parse_vehicle_positions(_feed(*vehicles)))
+
+
+@pytest.fixture
+def vehicles() -> VehicleIndex:
+    return _vehicles(
+        {"trip_id": "T1", "route_id": "R1", "stop_id": "S1", "offset": 0.003},
+        {"trip_id": "T2", "route_id": "R1", "stop_id": "S2", "offset": 0.001},
+        {"trip_id": "T3", "route_id": "R2", "stop_id": "S1", "offset": 0.02},
+        {"trip_id": "T4", "route_id": "R2", "start_date": "20251022"},
+        {"trip_id": "F1", "route_id": "R3", "start_time": "8:00:00"},
+    )
+
+
+def _ids(found: list) -> list[str]:
+    return [position.vehicle_id for _, position in found]
+
+
+def test_by_trip_uses_every_run_key(vehicles: VehicleIndex) -> None:
+    assert vehicles.by_trip["T1"].vehicle_id == "V0"
+    assert vehicles.by_trip[dated_trip_id("T4", "20251022")].vehicle_id == "V3"
+    instance = frequency_trip_id("F1", "08:00:00")
+    assert vehicles.by_trip[instance].vehicle_id == "V4"
+
+
+def test_by_route_and_stop(vehicles: VehicleIndex) -> None:
+    assert [position.vehicle_id for position in vehicles.by_route["R1"]] == [
+        "V0",
+        "V1",
+    ]
+    assert [position.vehicle_id for position in vehicles.by_stop["S1"]] == [
+        "V0",
+        "V2",
+    ]
+    # 位置のない車両は空間の索引に入らない
+    positioned = [
+        position.vehicle_id
+        for bucket in vehicles.grid.buckets.values()
+        for *_, position in bucket
+    ]
+    assert sorted(positioned) == ["V0", "V1", "V2"]
+
+
+def test_near_is_within_radius_and_ordered(vehicles: VehicleIndex) -> None:
+    found = vehicles.near(*ORIGIN, 500)
+    assert _ids(found) == ["V1", "V0"]
+    distances = [distance for distance, _ in found]
+    assert distances == sorted(distances)
+    position = found[0][1]
+    assert distances[0] == pytest.approx(
+        distance_meters(*ORIGIN, position.latitude, position.longitude),
+    )
+    # 2 km 先の車両は半径を広げれば見つかる
+    assert _ids(vehicles.near(*ORIGIN, 3000)) == ["V1", "V0", "V2"]
+
+
+def test_find_combines_conditions(vehicles: VehicleIndex) -> None:
+    assert _ids(vehicles.find()) == ["V0", "V1", "V2", "V3", "V4"]
+    assert _ids(vehicles.find(route_ids=["R1"])) == ["V0", "V1"]
+    assert _ids(vehicles.find(route_ids=["R1"], stop_ids=["S1"])) == ["V0"]
+    assert _ids(vehicles.find(stop_ids=["S1"], near=(*ORIGIN, 3000))) == ["V0", "V2"]
+    assert all(distance is None for distance, _ in vehicles.find(stop_ids=["S1"]))
+
+
+def test_vehicles_endpoint(
+    vehicles: VehicleIndex,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    snapshot = RealtimeSnapshot(realtime=RealtimeIndex(0, {}, vehicles))
+    monkeypatch.setattr(main, "realtime", SimpleNamespace(snapshot=snapshot))
+    response = main.api_vehicles(route_id=["R1"], lat=ORIGIN[0], lon=ORIGIN[1])
+    result = json.loads(response.body)["result"]
+    assert [vehicle["trip_id"] for vehicle in result] == ["T2", "T1"]
+    assert [vehicle["distance"] for vehicle in result] == [111, 334]
+    with pytest.raises(HTTPException):
+        main.api_vehicles(lat=ORIGIN[0])
+
+
+def test_new_timestamp_alone_does_not_change_the_trip() -> None:
+    fields = {"trip_id": "T1", "stop_id": "S1", "offset": 0.001, "timestamp": 100}
+    previous = build_realtime_index(_feed(fields))
+    later = {**fields, "timestamp": 115}
+    delta = update_realtime_index(_feed(later), previous, {})
+    assert delta.changed == frozenset()
+    assert delta.index.vehicles.by_trip["T1"].timestamp == later["timestamp"]
+    # 動いた車両と消えた車両の便は変わる
+    moved = {**fields, "offset": 0.002, "timestamp": 130}
+    delta = update_realtime_index(_feed(moved), delta.index, {})
+    assert delta.changed == {"T1"}
+    delta = update_realtime_index(_feed(), delta.index, {})
+    assert delta.changed == {"T1"}
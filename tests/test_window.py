@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from main import _window
+
+NOW = datetime.datetime(2025, 10, 22, 8, 15, 30)  # noqa: DTZ001
+
+
+@pytest.mark.parametrize(
+    ("from_time", "start_secs"),
+    [
+        ("08:30", 8 * 3600 + 30 * 60),
+        ("8:30:15", 8 * 3600 + 30 * 60 + 15),
+        ("25:10", 25 * 3600 + 10 * 60),
+        (None, 8 * 3600 + 15 * 60),
+    ],
+)
+def test_window_from(from_time: str | None, start_secs: int) -> None:
+    assert _window("20251022", from_time, NOW)[1] == start_secs
+
+
+@pytest.mark.parametrize(
+    "from_time",
+    ["25:99", "08:30:60", "48:00", "abc", "8", "08:30:"],
+)
+def test_window_rejects_invalid_from(from_time: str) -> None:
+    with pytest.raises(HTTPException) as raised:
+        _window("20251022", from_time, NOW)
+    assert raised.value.status_code == 422  # noqa: PLR2004
+    assert raised.value.detail.startswith("Invalid from:")
+
+
+def test_window_rejects_invalid_date() -> None:
+    with pytest.raises(HTTPException) as raised:
+        _window("20251399", "08:00", NOW)
+    assert raised.value.detail.startswith("Invalid date:")
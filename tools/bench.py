@@ -0,0 +1,338 @@
+"""
+静的データの取り込み・時刻表の検索・リアルタイムの解析とマージ・/api/ のリクエストを、
+合成した GTFS (tools.synthetic_feed) で段階ごとに測る。ネットワークには接続しない。
+
+段階ごとに 1 回あたりのレイテンシの分布 (p50/p90/p99)、スループット (件/秒) と
+Python ヒープのピーク (tracemalloc) を表示する。--save で結果を JSON に保存し、
+--compare で保存した結果と比べ、p50 が --tolerance より悪化した段階があれば
+終了コード 1 で終わる。
+
+    uv run python -m tools.bench
+    uv run python -m tools.bench --routes 200 --updates 5000 --save bench-baseline.json
+    uv run python -m tools.bench --compare bench-baseline.json --stages query_sql api
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import datetime
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from lib.database import build_database
+from lib.dynamic import (
+    RealtimeIndex,
+    build_realtime_index,
+    load_feed_message,
+    parse_gtfs_realtime,
+)
+from lib.merger import merge_gtfs_realtime
+from lib.static import departure_boards, get_bus_schedule_flexible
+from lib.timetable import Timetable
+from tools.synthetic_feed import (
+    TARGET_DATE,
+    FeedConfig,
+    make_trip_updates,
+    make_vehicle_positions,
+    write_static_zip,
+)
+
+BOARD_STOPS = 5
+BOARD_LIMIT = 50
+
+
+@dataclasses.dataclass
+class Stage:
+    # run は 1 回分の処理。items は 1 回で処理する件数 (行・便・リクエスト)
+    run: Callable[[int], object]
+    items: int = 1
+    repeat: int = 200
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) < 2:  # noqa: PLR2004
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+
+def measure(stage: Stage, repeat: int, warmup: int) -> dict[str, float]:
+    for i in range(warmup):
+        stage.run(i)
+    latencies = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        stage.run(warmup + i)
+        latencies.append(time.perf_counter() - started)
+
+    # ピークの計測は遅くなるので時間の計測とは別に 1 回だけ行う
+    tracemalloc.start()
+    stage.run(warmup + repeat)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = statistics.fmean(latencies)
+    return {
+        "runs": repeat,
+        "items": stage.items,
+        "mean_ms": mean * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "items_per_sec": stage.items / mean,
+        "peak_kib": peak / 1024,
+    }
+
+
+def _start_time(i: int) -> tuple[str, str]:
+    # 毎回違う時間帯 (06:00 から 7 分刻み) を引いてキャッシュの当たり方を散らす
+    minutes = 6 * 60 + (i * 7) % (18 * 60)
+    start = f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+    end = f"{(minutes + 45) // 60:02d}:{(minutes + 45) % 60:02d}:00"
+    return start, end
+
+
+@contextlib.contextmanager
+def _quiet() -> Iterator[None]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def make_stages(
+    config: FeedConfig,
+    workdir: Path,
+    engine: str,
+    stack: contextlib.ExitStack,
+) -> dict[str, Stage]:
+    zip_path = write_static_zip(config, workdir / "static.zip")
+    db_path = str(workdir / "bench.db")
+    with _quiet():
+        build_database(str(zip_path), db_path)
+
+    feed = make_trip_updates(config)
+    feed_bytes = feed.SerializeToString()
+    realtime = build_realtime_index(feed)
+    vehicle_index = build_realtime_index(make_vehicle_positions(config))
+    enriched = realtime._replace(
+        vehicles=vehicle_index.vehicles,
+        alerts=vehicle_index.alerts,
+    )
+
+    session_factory = sessionmaker(bind=create_engine(f"sqlite:///{db_path}"))
+    session = stack.enter_context(session_factory())
+    # 発車の多い停留所を掲示板にする
+    stop_ids = list(
+        session.scalars(
+            text(
+                "SELECT stop_id FROM stop_times GROUP BY stop_id "
+                f"ORDER BY count(*) DESC, stop_id LIMIT {BOARD_STOPS}",
+            ),
+        ),
+    )
+    target_date = datetime.datetime.combine(TARGET_DATE, datetime.time())
+    timetable = Timetable.load(db_path)
+    (stop_time_rows,) = session.execute(text("SELECT count(*) FROM stop_times")).one()
+
+    board = timetable.get_bus_schedule_flexible(
+        stop_ids,
+        target_date,
+        BOARD_LIMIT,
+        "08:00:00",
+        "08:45:00",
+    )
+    patterns = timetable.patterns(board)
+
+    def query(get: Callable) -> Callable[[int], object]:
+        return lambda i: get(
+            stop_ids=stop_ids,
+            target_date=target_date,
+            limit=BOARD_LIMIT,
+            start_time=_start_time(i)[0],
+            stop_time=_start_time(i)[1],
+        )
+
+    def import_static(_: int) -> None:
+        with _quiet():
+            build_database(str(zip_path), str(workdir / "import.db"))
+
+    stages = {
+        "import": Stage(import_static, items=stop_time_rows, repeat=3),
+        "query_sql": Stage(
+            query(lambda **kwargs: get_bus_schedule_flexible(session, **kwargs)),
+        ),
+        "query_cached": Stage(
+            query(lambda **kwargs: departure_boards.get(session, **kwargs)),
+        ),
+        "query_memory": Stage(query(timetable.get_bus_schedule_flexible)),
+        "parse": Stage(
+            lambda _: build_realtime_index(load_feed_message(feed_bytes)),
+            items=len(feed.entity),
+            repeat=20,
+        ),
+        "parse_dict": Stage(
+            lambda _: parse_gtfs_realtime(feed_bytes),
+            items=len(feed.entity),
+            repeat=5,
+        ),
+        "merge": Stage(
+            lambda _: merge_gtfs_realtime(board, realtime, patterns),
+            items=len(board),
+            repeat=1000,
+        ),
+        # 車両の位置と Alert も付ける場合。フィードの大きさによらないことを見る
+        "merge_enriched": Stage(
+            lambda _: merge_gtfs_realtime(board, enriched, patterns),
+            items=len(board),
+            repeat=1000,
+        ),
+    }
+    stages.update(_api_stages(db_path, workdir, stop_ids, realtime, engine, stack))
+    return stages
+
+
+def _api_stages(
+    db_path: str,
+    workdir: Path,
+    stop_ids: list[str],
+    realtime: RealtimeIndex,
+    engine: str,
+    stack: contextlib.ExitStack,
+) -> dict[str, Stage]:
+    # main は読み込み時に環境変数を読むので、設定してから import する
+    boards_path = workdir / "boards.json"
+    boards_path.write_text(json.dumps({"default": {"stop_ids": stop_ids}}))
+    os.environ.update(
+        {
+            "DATABASE_PATH": db_path,
+            "BOARDS_PATH": str(boards_path),
+            "TIMETABLE_ENGINE": engine,
+            "GTFS_DYNAMIC_URL": "",
+        },
+    )
+    from fastapi.testclient import TestClient  # noqa: PLC0415
+
+    import main  # noqa: PLC0415
+    from lib.poller import RealtimeSnapshot  # noqa: PLC0415
+
+    with _quiet():
+        client = stack.enter_context(TestClient(main.app))
+    main.poller._snapshot = RealtimeSnapshot(  # noqa: SLF001
+        version=1,
+        feed_timestamp=realtime.timestamp,
+        fetched_at=time.time(),
+        realtime=realtime,
+    )
+    date = TARGET_DATE.strftime("%Y%m%d")
+
+    def request(url: str) -> None:
+        response = client.get(url)
+        response.raise_for_status()
+
+    def uncached(i: int) -> None:
+        main.responses.invalidate()
+        request(f"/api/boards/default?date={date}&from={_start_time(i)[0][:5]}")
+
+    return {
+        # 同じ分の /api/ と同じく、組み立て済みのレスポンスが返る場合
+        "api": Stage(lambda _: request(f"/api/boards/default?date={date}&from=08:00")),
+        # レスポンスのキャッシュを外し、掲示板の組み立てから行う場合
+        "api_uncached": Stage(uncached),
+    }
+
+
+def compare(
+    results: dict[str, dict],
+    baseline: dict[str, dict],
+    tolerance: float,
+) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"]
+        peak_ratio = result["peak_kib"] / max(before["peak_kib"], 1)
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:<14} p50 {before['p50_ms']:9.3f} -> {result['p50_ms']:9.3f} ms "
+            f"(x{ratio:.2f})  peak x{peak_ratio:.2f}{flag}",
+        )
+    return regressions
+
+
+def main(args: argparse.Namespace) -> int:
+    config = FeedConfig(
+        routes=args.routes,
+        stops=args.stops,
+        stops_per_trip=args.stops_per_trip,
+        trips_per_route=args.trips_per_route,
+        updates=args.updates,
+        seed=args.seed,
+    )
+    print(f"Config: {config}")
+    with (
+        tempfile.TemporaryDirectory() as workdir,
+        contextlib.ExitStack() as stack,
+    ):
+        stages = make_stages(config, Path(workdir), args.engine, stack)
+        names = args.stages or list(stages)
+        results = {}
+        for name in names:
+            stage = stages[name]
+            repeat = max(1, round(stage.repeat * args.scale))
+            results[name] = result = measure(stage, repeat, min(repeat, 3))
+            print(
+                f"{name:<14} p50 {result['p50_ms']:9.3f} ms  "
+                f"p90 {result['p90_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+                f"{result['items_per_sec']:12.1f} items/s  "
+                f"peak {result['peak_kib']:10.1f} KiB",
+            )
+
+    report = {"config": dataclasses.asdict(config), "results": results}
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, indent=2))
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline["config"] != report["config"]:
+            print(f"Warning: baseline was measured with {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", type=int, default=FeedConfig.routes)
+    parser.add_argument("--stops", type=int, default=FeedConfig.stops)
+    parser.add_argument("--stops-per-trip", type=int, default=FeedConfig.stops_per_trip)
+    parser.add_argument(
+        "--trips-per-route",
+        type=int,
+        default=FeedConfig.trips_per_route,
+    )
+    parser.add_argument("--updates", type=int, default=FeedConfig.updates)
+    parser.add_argument("--seed", type=int, default=FeedConfig.seed)
+    parser.add_argument("--engine", choices=["sql", "memory"], default="sql")
+    parser.add_argument("--stages", nargs="+")
+    # 各段階の繰り返し回数に掛ける倍率
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    sys.exit(main(parser.parse_args()))
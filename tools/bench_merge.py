@@ -0,0 +1,87 @@
+"""
+merge_gtfs_realtime がフィードの大きさに対してどう伸びるかを測る。
+
+掲示板に載る便の数を固定し、TripUpdate の便数だけを増やして 1 回あたりの時間を表示する。
+マージは両方にある便だけを処理するので、フィードが大きくなっても時間はほぼ変わらない。
+
+    uv run python -m tools.bench_merge
+"""
+
+import argparse
+import time
+
+from lib.dynamic import RealtimeIndex, StopTimeEvent, StopTimeUpdate, TripRecord
+from lib.merger import merge_gtfs_realtime
+
+STOPS_PER_TRIP = 30
+
+
+def make_realtime(trips: int) -> RealtimeIndex:
+    records = {}
+    for trip in range(trips):
+        trip_id = f"T{trip}"
+        updates = tuple(
+            StopTimeUpdate(
+                f"S{stop}",
+                stop + 1,
+                StopTimeEvent(60, 1_761_130_000 + trip * 60 + stop * 120, None),
+                StopTimeEvent(60, 1_761_130_000 + trip * 60 + stop * 120, None),
+                None,
+            )
+            for stop in range(STOPS_PER_TRIP)
+        )
+        records[trip_id] = TripRecord(
+            trip_id,
+            None,
+            None,
+            {update.stop_id: update for update in updates},
+            updates,
+        )
+    return RealtimeIndex(0, records)
+
+
+def make_board(trips: int) -> dict:
+    return {
+        f"T{trip}": {
+            "trip_info": {"trip_id": f"T{trip}", "route_id": "R1"},
+            "stops": [
+                {
+                    "departure_scheduled_time": "08:00:00",
+                    "stop_id": f"S{stop}",
+                    "stop_name": f"Stop {stop}",
+                    "stop_headsign": "Terminal",
+                }
+                for stop in (0, STOPS_PER_TRIP // 2)
+            ],
+        }
+        for trip in range(0, trips * 7, 7)
+    }
+
+
+def measure(static_data: dict, realtime: RealtimeIndex, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        merge_gtfs_realtime(static_data, realtime)
+    return (time.perf_counter() - started) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--board-trips", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument(
+        "--feed-trips",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 50_000],
+    )
+    args = parser.parse_args()
+
+    static_data = make_board(args.board_trips)
+    for feed_trips in args.feed_trips:
+        realtime = make_realtime(feed_trips)
+        elapsed = measure(static_data, realtime, args.repeat)
+        print(
+            f"feed={feed_trips:>7} trips  board={args.board_trips} trips  "
+            f"{elapsed * 1e6:8.1f} us/merge",
+        )
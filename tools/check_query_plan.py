@@ -0,0 +1,58 @@
+"""
+get_bus_schedule_flexible のクエリが索引を使っているかを確認する。
+
+stop_times を全件走査したり、calendar や calendar_dates を問い合わせたりする計画になっていたら終了コード 1 で終わる。
+
+    uv run python -m tools.check_query_plan [nowhere.db]
+"""
+
+import datetime
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from lib.static import explain_departures, stops_ids
+
+# 計画に含まれていなければならない行と、含まれてはいけない行
+REQUIRED = [
+    "SEARCH stop_times USING COVERING INDEX stop_times_stop_departure",
+]
+FORBIDDEN = [
+    "SCAN stop_times",
+    # 運行サービスは lib.services の運行表から引くので、カレンダーの表は読まない
+    "SCAN calendar",
+    "SEARCH calendar",
+]
+
+
+def check_query_plan(plan: list[str]) -> list[str]:
+    problems = [
+        f"missing: {required}"
+        for required in REQUIRED
+        if not any(line.startswith(required) for line in plan)
+    ]
+    problems.extend(
+        f"found: {line}"
+        for line in plan
+        if any(line.startswith(forbidden) for forbidden in FORBIDDEN)
+    )
+    return problems
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "nowhere.db"
+    engine = create_engine(f"sqlite:///{db_path}")
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    with session_factory() as session:
+        plan = explain_departures(
+            session,
+            stop_ids=stops_ids,
+            target_date=datetime.datetime(2025, 10, 22),  # noqa: DTZ001
+        )
+    print("\n".join(plan))
+    problems = check_query_plan(plan)
+    for problem in problems:
+        print(f"Query plan regression: {problem}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,127 @@
+"""
+メモリ上の時刻表 (lib.timetable) が SQL の get_bus_schedule_flexible と同じ結果を返すかを確かめる。
+
+フィードの有効期間から日付を、停留所からいくつかの組を選び、時間帯を変えて両者を比べる。
+食い違いがあれば終了コード 1 で終わる。最後に時刻表のメモリ使用量を表示する。
+
+    uv run python -m tools.check_timetable [nowhere.db] [--samples 50]
+"""
+
+import argparse
+import datetime
+import random
+import sys
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from lib.static import get_bus_schedule_flexible, stops_ids
+from lib.static_models import Calendar, CalendarDates, Stops
+from lib.timetable import Timetable
+
+WINDOWS = [
+    ("00:00:00", "23:59:59"),
+    ("05:00:00", "09:00:00"),
+    ("12:30:00", "13:15:00"),
+    ("22:00:00", "26:00:00"),
+]
+
+
+def normalize(result: dict) -> dict:
+    # 同じ発車秒の行は SQL 側の並びが定まらないので、便ごとに停留所を並べ替えて比べる
+    return {
+        trip_id: (
+            trip["trip_info"],
+            sorted(tuple(sorted(stop.items())) for stop in trip["stops"]),
+        )
+        for trip_id, trip in result.items()
+    }
+
+
+def departure_times(result: dict) -> list[str]:
+    return sorted(
+        stop["departure_scheduled_time"]
+        for trip in result.values()
+        for stop in trip["stops"]
+    )
+
+
+def sample_dates(session, count: int) -> list[datetime.datetime]:  # noqa: ANN001
+    dates = [
+        value
+        for value in session.scalars(select(Calendar.start_date)).all()
+        + session.scalars(select(Calendar.end_date)).all()
+        + session.scalars(select(CalendarDates.date)).all()
+        if value
+    ]
+    if not dates:
+        return [datetime.datetime(2025, 10, 22)]  # noqa: DTZ001
+    first = datetime.datetime.strptime(min(dates), "%Y%m%d")  # noqa: DTZ007
+    last = datetime.datetime.strptime(max(dates), "%Y%m%d")  # noqa: DTZ007
+    days = (last - first).days
+    return sorted(
+        {
+            first + datetime.timedelta(days=random.randint(0, days))
+            for _ in range(count)
+        },
+    )
+
+
+def main(db_path: str, samples: int) -> int:
+    started = time.perf_counter()
+    timetable = Timetable.load(db_path)
+    print(f"Loaded timetable in {time.perf_counter() - started:.2f}s")
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    mismatches = 0
+    checked = 0
+    with session_factory() as session:
+        all_stops = session.scalars(select(Stops.stop_id)).all()
+        stop_sets = [stops_ids] + [
+            random.sample(all_stops, min(len(all_stops), random.randint(1, 6)))
+            for _ in range(samples)
+        ]
+        for target_date in sample_dates(session, max(1, samples // 5)):
+            for stop_ids in stop_sets:
+                for start_time, stop_time in WINDOWS:
+                    window = {
+                        "stop_ids": stop_ids,
+                        "target_date": target_date,
+                        "start_time": start_time,
+                        "stop_time": stop_time,
+                    }
+                    # 件数で打ち切らない場合は行の集合がそのまま一致するはず
+                    expected = get_bus_schedule_flexible(session, limit=10**9, **window)
+                    actual = timetable.get_bus_schedule_flexible(limit=10**9, **window)
+                    same = normalize(expected) == normalize(actual)
+                    # 打ち切る場合は同時刻の行の選び方が違いうるので発車時刻の並びで比べる
+                    expected = get_bus_schedule_flexible(session, limit=50, **window)
+                    actual = timetable.get_bus_schedule_flexible(limit=50, **window)
+                    same = same and departure_times(expected) == departure_times(actual)
+                    checked += 1
+                    if not same:
+                        mismatches += 1
+                        print(
+                            f"Mismatch: {target_date:%Y%m%d} {start_time}-{stop_time} "
+                            f"{stop_ids}",
+                        )
+
+    print(f"{checked} queries checked, {mismatches} mismatches")
+    print(
+        f"Timetable: {len(timetable.stops.values)} stops, "
+        f"{len(timetable.trips.values)} trips, {len(timetable.st_trip)} stop times, "
+        f"{timetable.memory_usage() / 2**20:.1f} MiB",
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", nargs="?", default="nowhere.db")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.exit(main(args.db_path, args.samples))
@@ -0,0 +1,101 @@
+"""
+ローカルの uvicorn に同時リクエストを送り、レイテンシの分布を測る。
+
+--url を省略すると main:app を uvicorn で起動してから測定し、終わったら止める。
+
+    uv run python -m tools.load_test --concurrency 32 --requests 2000
+    uv run python -m tools.load_test --url http://127.0.0.1:8000/api/
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+
+@contextmanager
+def run_uvicorn(port: int, workers: int) -> Iterator[str]:
+    process = subprocess.Popen(  # noqa: S603
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # 起動を待つ
+        for _ in range(100):
+            try:
+                requests.get(base_url + "/api/", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        yield base_url + "/api/"
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def worker(url: str, count: int) -> tuple[list[float], int]:
+    latencies = []
+    errors = 0
+    with requests.Session() as http:
+        for _ in range(count):
+            started = time.perf_counter()
+            response = http.get(url, timeout=30)
+            latencies.append(time.perf_counter() - started)
+            if not response.ok or not response.json().get("status", True):
+                errors += 1
+    return latencies, errors
+
+
+def percentile(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=1000, method="inclusive")[int(p * 10) - 1]
+
+
+def run(url: str, concurrency: int, total: int) -> None:
+    per_worker = max(1, total // concurrency)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(
+            pool.map(worker, [url] * concurrency, [per_worker] * concurrency),
+        )
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for result in results for latency in result[0]]
+    errors = sum(result[1] for result in results)
+    print(f"{len(latencies)} requests, concurrency {concurrency}, {errors} errors")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s")
+    for p in (50, 90, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1000:.1f} ms")
+    print(f"max: {max(latencies) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.url:
+        run(args.url, args.concurrency, args.requests)
+    else:
+        with run_uvicorn(args.port, args.workers) as url:
+            run(url, args.concurrency, args.requests)
@@ -0,0 +1,144 @@
+"""
+REALTIME_ARCHIVE_DIR に保存した GTFS-Realtime を取得した順に再生し、1 日分の遅延を集計する。
+ネットワークには接続しない。
+
+アーカイブの差分 (変わった FeedEntity) だけを解析するので、1 日分でも数秒で終わる。
+便ごとに最後に見えた遅延 (最後の停留所の更新のもの) の分布と、遅延が大きかった便を
+表示する。--key で取得先 ("<feed_id>/<種類>") を絞る。--check を付けると、フィード全体に
+戻した内容をポーラーと同じ差分更新にかけ、差分だけの集計と一致するか確かめる (遅い)。
+
+    uv run python -m tools.replay_archive archive/20251022.rta
+    uv run python -m tools.replay_archive archive/20251022.rta --key "/trip_updates" --top 20
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from collections import Counter
+
+from google.transit import gtfs_realtime_pb2
+
+from lib.archive import read_archive
+from lib.dynamic import (
+    RealtimeIndex,
+    StopTimeUpdate,
+    TripRecord,
+    load_feed_message,
+    update_realtime_index,
+)
+from lib.feeds import namespaced
+
+
+def _delay(trip: TripRecord) -> int | None:
+    if not trip.updates:
+        return None
+    update: StopTimeUpdate = trip.updates[-1]
+    for event in (update.departure, update.arrival):
+        if event is not None and event.delay is not None:
+            return event.delay
+    return None
+
+
+def _last_delay(trip_update: gtfs_realtime_pb2.TripUpdate) -> int | None:
+    # _delay() と同じものを TripRecord を作らずに protobuf から直接読む
+    if not trip_update.stop_time_update:
+        return None
+    update = trip_update.stop_time_update[-1]
+    for name in ("departure", "arrival"):
+        if update.HasField(name) and getattr(update, name).HasField("delay"):
+            return getattr(update, name).delay
+    return None
+
+
+def _namespace(key: str) -> str:
+    return key.rsplit("/", 1)[0]
+
+
+def replay(path: str, key: str | None) -> tuple[dict[str, int], Counter, int]:
+    # 便ごとの最後の遅延、取得先ごとの記録の数、解析した TripUpdate の延べ数
+    delays: dict[str, int] = {}
+    records: Counter = Counter()
+    updates = 0
+    for record in read_archive(path, key, full=False):
+        records[record.key] += 1
+        namespace = _namespace(record.key)
+        for entity in load_feed_message(record.content).entity:
+            if not entity.HasField("trip_update"):
+                continue
+            updates += 1
+            delay = _last_delay(entity.trip_update)
+            if delay is not None:
+                trip_id = namespaced(namespace, entity.trip_update.trip.trip_id)
+                delays[trip_id] = delay
+    return delays, records, updates
+
+
+def replay_full(path: str, key: str | None) -> dict[str, int]:
+    # ポーラーと同じく、フィード全体を前回の索引との差分で更新していく
+    states: dict[str, tuple[RealtimeIndex, dict[str, int]]] = {}
+    delays: dict[str, int] = {}
+    for record in read_archive(path, key):
+        previous, fingerprints = states.get(record.key, (RealtimeIndex(0, {}), {}))
+        delta = update_realtime_index(
+            load_feed_message(record.content),
+            previous,
+            fingerprints,
+            namespace=_namespace(record.key),
+        )
+        states[record.key] = (delta.index, delta.fingerprints)
+        for trip_id in delta.changed:
+            trip = delta.index.trips.get(trip_id)
+            # 始発時刻や運行日を付けた trip_id でも引けるが、replay() と同じく元の trip_id で
+            if trip is None or trip.trip_id != trip_id:
+                continue
+            delay = _delay(trip)
+            if delay is not None:
+                delays[trip_id] = delay
+    return delays
+
+
+def main(args: argparse.Namespace) -> int:
+    started = time.perf_counter()
+    delays, records, updates = replay(args.path, args.key)
+    elapsed = time.perf_counter() - started
+    total = sum(records.values())
+    if not total:
+        print(f"No records in {args.path}")
+        return 1
+    print(
+        f"Replayed {total} records ({updates} trip updates) in {elapsed:.2f}s "
+        f"({total / elapsed:.1f} records/s)",
+    )
+    for record_key, count in sorted(records.items()):
+        print(f"  {record_key}: {count} records")
+
+    if args.check:
+        started = time.perf_counter()
+        full_delays = replay_full(args.path, args.key)
+        elapsed = time.perf_counter() - started
+        if full_delays != delays:
+            print(f"Full replay disagrees ({elapsed:.2f}s)")
+            return 1
+        print(f"Full replay agrees ({elapsed:.2f}s)")
+
+    if not delays:
+        return 0
+    values = sorted(delays.values())
+    deciles = statistics.quantiles(values, n=10) if len(values) > 1 else values * 9
+    print(
+        f"Trips with delays: {len(values)}  mean {statistics.fmean(values):.0f}s  "
+        f"p50 {deciles[4]:.0f}s  p90 {deciles[8]:.0f}s  max {values[-1]}s",
+    )
+    for trip_id, delay in sorted(delays.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"  {trip_id}: {delay}s")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--key")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--check", action="store_true")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,52 @@
+"""
+GTFS-Realtime フィードのローカル代替サーバー。
+
+指定した .pb ファイルをリクエストのたびに読み直して返すので、
+ファイルを差し替えればフィードの更新を再現できる。ETag / Last-Modified に対応。
+
+    uv run tools/serve_feed.py trip_updates.pb --port 8001
+    GTFS_DYNAMIC_URL=http://127.0.0.1:8001/ uv run uvicorn main:app
+"""
+
+import argparse
+import email.utils
+import hashlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+def make_handler(feed_path: Path) -> type[BaseHTTPRequestHandler]:
+    class FeedHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            content = feed_path.read_bytes()
+            etag = '"' + hashlib.sha1(content).hexdigest() + '"'  # noqa: S324
+            last_modified = email.utils.formatdate(
+                feed_path.stat().st_mtime,
+                usegmt=True,
+            )
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.end_headers()
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            self.wfile.write(content)
+
+    return FeedHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("feed", type=Path)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.feed))
+    print(f"Serving {args.feed} on http://{args.host}:{args.port}/")
+    server.serve_forever()
@@ -0,0 +1,374 @@
+"""
+ベンチマーク用に、大きさを指定して静的 GTFS の zip と GTFS-RT の TripUpdates、
+VehiclePositions (と Alerts) を合成する。
+
+停留所は広島市付近の格子の上に並べ、経路は連続した停留所をたどる。便は 05:00 から
+24 時過ぎまで一定間隔で走らせ、平日・土休日のサービスと運休・臨時運行の例外を持たせる。
+--frequency-routes を指定すると、最後のその数の経路は frequencies.txt の便
+(06:00 から 22:00 まで一定間隔) にし、TripUpdate には始発時刻を付ける。
+同じ引数 (と seed) からは同じフィードができる。
+
+    uv run python -m tools.synthetic_feed --routes 50 --updates 2000 --out /tmp/bench
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import random
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+
+from google.transit import gtfs_realtime_pb2
+
+TARGET_DATE = datetime.date(2025, 10, 22)
+# 格子の原点 (広島市中心部) と間隔
+ORIGIN = (34.3853, 132.4553)
+SPACING = 0.004
+# frequencies.txt の便の運行時間帯
+FREQUENCY_START = 6 * 3600
+FREQUENCY_END = 22 * 3600
+
+
+@dataclass(frozen=True)
+class FeedConfig:
+    routes: int = 50
+    stops: int = 1000
+    stops_per_trip: int = 30
+    trips_per_route: int = 80
+    updates: int = 2000
+    frequency_routes: int = 0
+    seed: int = 0
+
+
+def stop_id(index: int) -> str:
+    # 実データと同じ "<停留所番号> <のりば>" の形
+    return f"{10000 + index // 2} {index % 2 + 1}"
+
+
+def _csv(header: list[str], rows: list[list]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def _hhmmss(secs: int) -> str:
+    return f"{secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+
+
+def make_static(config: FeedConfig) -> dict[str, str]:
+    """ファイル名 -> CSV の中身。"""
+    rng = random.Random(config.seed)
+    side = max(1, int(config.stops**0.5))
+    stops = [
+        [
+            stop_id(i),
+            f"Stop {10000 + i // 2}",
+            f"{ORIGIN[0] + (i // 2) // side * SPACING:.6f}",
+            f"{ORIGIN[1] + (i // 2) % side * SPACING:.6f}",
+            "",
+        ]
+        for i in range(config.stops)
+    ]
+
+    routes = []
+    trips = []
+    stop_times = []
+    frequencies = []
+    for route in range(config.routes):
+        route_id = f"R{route}"
+        start = rng.randrange(config.stops)
+        pattern = [
+            (start + step * 2) % config.stops for step in range(config.stops_per_trip)
+        ]
+        headsign = f"Stop {10000 + pattern[-1] // 2}"
+        routes.append([route_id, "A1", str(route), f"Route {route}", "3"])
+        headway = (24 * 3600 - 5 * 3600) // config.trips_per_route
+        if route >= config.routes - config.frequency_routes:
+            # 平日・土休日の便を 1 つずつ作り、stop_times は始発 06:00 の雛形にする
+            for service_id in ("WD", "WE"):
+                trip_id = f"{route_id}_{service_id}"
+                trips.append([trip_id, route_id, service_id, headsign])
+                frequencies.append(
+                    [
+                        trip_id,
+                        _hhmmss(FREQUENCY_START),
+                        _hhmmss(FREQUENCY_END),
+                        headway,
+                        1,
+                    ],
+                )
+                secs = FREQUENCY_START
+                for sequence, stop in enumerate(pattern, start=1):
+                    time = _hhmmss(secs)
+                    stop_times.append(
+                        [trip_id, time, time, stop_id(stop), sequence, headsign],
+                    )
+                    secs += 60 + rng.randrange(120)
+            continue
+        for trip in range(config.trips_per_route):
+            trip_id = f"{route_id}_{trip}"
+            service_id = "WE" if trip % 3 == 2 else "WD"  # noqa: PLR2004
+            trips.append([trip_id, route_id, service_id, headsign])
+            secs = 5 * 3600 + trip * headway + rng.randrange(60)
+            for sequence, stop in enumerate(pattern, start=1):
+                time = _hhmmss(secs)
+                stop_times.append(
+                    [trip_id, time, time, stop_id(stop), sequence, headsign],
+                )
+                secs += 60 + rng.randrange(120)
+
+    dates = [f"{TARGET_DATE.year}0101", f"{TARGET_DATE.year}1231"]
+    exception_date = (TARGET_DATE + datetime.timedelta(days=1)).strftime("%Y%m%d")
+    files = {}
+    if frequencies:
+        files["frequencies.txt"] = _csv(
+            ["trip_id", "start_time", "end_time", "headway_secs", "exact_times"],
+            frequencies,
+        )
+    return files | {
+        "agency.txt": _csv(
+            [
+                "agency_id",
+                "agency_name",
+                "agency_url",
+                "agency_timezone",
+                "agency_lang",
+            ],
+            [["A1", "Agency", "http://example.com", "Asia/Tokyo", "ja"]],
+        ),
+        "stops.txt": _csv(
+            ["stop_id", "stop_name", "stop_lat", "stop_lon", "parent_station"],
+            stops,
+        ),
+        "routes.txt": _csv(
+            [
+                "route_id",
+                "agency_id",
+                "route_short_name",
+                "route_long_name",
+                "route_type",
+            ],
+            routes,
+        ),
+        "trips.txt": _csv(
+            ["trip_id", "route_id", "service_id", "trip_headsign"],
+            trips,
+        ),
+        "stop_times.txt": _csv(
+            [
+                "trip_id",
+                "arrival_time",
+                "departure_time",
+                "stop_id",
+                "stop_sequence",
+                "stop_headsign",
+            ],
+            stop_times,
+        ),
+        "calendar.txt": _csv(
+            [
+                "service_id",
+                "monday",
+                "tuesday",
+                "wednesday",
+                "thursday",
+                "friday",
+                "saturday",
+                "sunday",
+                "start_date",
+                "end_date",
+            ],
+            [
+                ["WD", 1, 1, 1, 1, 1, 0, 0, *dates],
+                ["WE", 0, 0, 0, 0, 0, 1, 1, *dates],
+            ],
+        ),
+        "calendar_dates.txt": _csv(
+            ["service_id", "date", "exception_type"],
+            [["WD", exception_date, 2], ["WE", exception_date, 1]],
+        ),
+        "feed_info.txt": _csv(
+            [
+                "feed_publisher_name",
+                "feed_publisher_url",
+                "feed_lang",
+                "feed_start_date",
+                "feed_end_date",
+                "feed_version",
+            ],
+            [["Publisher", "http://example.com", "ja", *dates, "1"]],
+        ),
+    }
+
+
+def write_static_zip(config: FeedConfig, path: Path) -> Path:
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in make_static(config).items():
+            archive.writestr(name, content)
+    return path
+
+
+def make_trip_updates(
+    config: FeedConfig,
+    timestamp: int | None = None,
+) -> gtfs_realtime_pb2.FeedMessage:
+    """TARGET_DATE の平日ダイヤの便から config.updates 便分の TripUpdate を作る。"""
+    rng = random.Random(config.seed + 1)
+    midnight = int(
+        datetime.datetime.combine(
+            TARGET_DATE,
+            datetime.time(),
+            datetime.timezone(datetime.timedelta(hours=9)),
+        ).timestamp(),
+    )
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = timestamp or midnight + 12 * 3600
+
+    static = make_static(config)
+    rows = list(csv.reader(io.StringIO(static["stop_times.txt"])))[1:]
+    by_trip: dict[str, list[list[str]]] = {}
+    for row in rows:
+        by_trip.setdefault(row[0], []).append(row)
+    # frequencies.txt の便は 1 本ごとに (trip_id, 始発の雛形からのずれ)
+    headways = {
+        row[0]: int(row[3])
+        for row in list(
+            csv.reader(io.StringIO(static.get("frequencies.txt", "trip_id\n"))),
+        )[1:]
+    }
+    runs = [
+        (trip_id, start - FREQUENCY_START)
+        for trip_id in by_trip
+        for start in (
+            range(FREQUENCY_START, FREQUENCY_END, headways[trip_id])
+            if trip_id in headways
+            else (FREQUENCY_START,)
+        )
+    ]
+    rng.shuffle(runs)
+    for trip_id, offset in runs[: config.updates]:
+        entity = feed.entity.add()
+        entity.id = f"{trip_id}@{offset}" if trip_id in headways else trip_id
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = trip_id
+        if trip_id in headways:
+            trip_update.trip.start_time = _hhmmss(FREQUENCY_START + offset)
+        delay = rng.randrange(-60, 600)
+        # 先頭のいくつかは発車済みとして省き、残りの停留所に遅延を載せる
+        for row in by_trip[trip_id][rng.randrange(5) :]:
+            hours, minutes, seconds = map(int, row[2].split(":"))
+            scheduled = midnight + hours * 3600 + minutes * 60 + seconds + offset
+            update = trip_update.stop_time_update.add()
+            update.stop_sequence = int(row[4])
+            update.stop_id = row[3]
+            update.arrival.delay = delay
+            update.arrival.time = scheduled + delay
+            update.departure.delay = delay
+            update.departure.time = scheduled + delay
+    return feed
+
+
+def make_vehicle_positions(
+    config: FeedConfig,
+    timestamp: int | None = None,
+) -> gtfs_realtime_pb2.FeedMessage:
+    """
+    make_trip_updates() と同じ便の VehiclePosition と、系統・停留所への Alert を作る。
+
+    車両は TripUpdate の最初の停留所に向かっている (停車している) ことにする。
+    """
+    rng = random.Random(config.seed + 2)
+    trip_updates = make_trip_updates(config, timestamp)
+    static = make_static(config)
+    coordinates = {
+        row[0]: (float(row[2]), float(row[3]))
+        for row in list(csv.reader(io.StringIO(static["stops.txt"])))[1:]
+    }
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.CopyFrom(trip_updates.header)
+    for entity in trip_updates.entity:
+        trip_update = entity.trip_update
+        first = trip_update.stop_time_update[0]
+        vehicle_entity = feed.entity.add()
+        vehicle_entity.id = f"vehicle-{entity.id}"
+        vehicle = vehicle_entity.vehicle
+        vehicle.trip.CopyFrom(trip_update.trip)
+        vehicle.vehicle.id = f"V{entity.id}"
+        latitude, longitude = coordinates[first.stop_id]
+        vehicle.position.latitude = latitude
+        vehicle.position.longitude = longitude
+        vehicle.stop_id = first.stop_id
+        vehicle.current_stop_sequence = first.stop_sequence
+        vehicle.current_status = rng.choice(
+            [
+                gtfs_realtime_pb2.VehiclePosition.IN_TRANSIT_TO,
+                gtfs_realtime_pb2.VehiclePosition.STOPPED_AT,
+            ],
+        )
+        vehicle.timestamp = feed.header.timestamp
+
+    # 系統の 1 割と停留所の 1 割に Alert を出す
+    for route in range(0, config.routes, 10):
+        alert_entity = feed.entity.add()
+        alert_entity.id = f"alert-R{route}"
+        alert = alert_entity.alert
+        alert.informed_entity.add().route_id = f"R{route}"
+        alert.effect = gtfs_realtime_pb2.Alert.SIGNIFICANT_DELAYS
+        alert.header_text.translation.add(text=f"Route {route} delayed", language="ja")
+    for index in range(0, config.stops, 10):
+        alert_entity = feed.entity.add()
+        alert_entity.id = f"alert-{stop_id(index)}"
+        alert = alert_entity.alert
+        alert.informed_entity.add().stop_id = stop_id(index)
+        alert.effect = gtfs_realtime_pb2.Alert.STOP_MOVED
+        alert.header_text.translation.add(text="Stop moved", language="ja")
+    return feed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", type=int, default=FeedConfig.routes)
+    parser.add_argument("--stops", type=int, default=FeedConfig.stops)
+    parser.add_argument("--stops-per-trip", type=int, default=FeedConfig.stops_per_trip)
+    parser.add_argument(
+        "--trips-per-route",
+        type=int,
+        default=FeedConfig.trips_per_route,
+    )
+    parser.add_argument("--updates", type=int, default=FeedConfig.updates)
+    parser.add_argument(
+        "--frequency-routes",
+        type=int,
+        default=FeedConfig.frequency_routes,
+    )
+    parser.add_argument("--seed", type=int, default=FeedConfig.seed)
+    parser.add_argument("--out", default=".")
+    args = parser.parse_args()
+
+    config = FeedConfig(
+        routes=args.routes,
+        stops=args.stops,
+        stops_per_trip=args.stops_per_trip,
+        trips_per_route=args.trips_per_route,
+        updates=args.updates,
+        frequency_routes=args.frequency_routes,
+        seed=args.seed,
+    )
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    write_static_zip(config, out / "static.zip")
+    (out / "trip_updates.pb").write_bytes(
+        make_trip_updates(config).SerializeToString(),
+    )
+    (out / "vehicle_positions.pb").write_bytes(
+        make_vehicle_positions(config).SerializeToString(),
+    )
+    print(
+        f"Wrote {out / 'static.zip'}, {out / 'trip_updates.pb'} "
+        f"and {out / 'vehicle_positions.pb'}",
+    )